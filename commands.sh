@@ -3,8 +3,28 @@
 # Start the web server
 daphne -b 0.0.0.0 -p 8000 rg_server.asgi:application &
 
-# Start the celery worker
-celery -A rg_server worker --loglevel=info &
+# Start one inference worker per GPU, each with a single process that keeps its model loaded
+GPU_COUNT=$(nvidia-smi -L 2>/dev/null | wc -l)
+if [ "$GPU_COUNT" -lt 1 ]; then
+    GPU_COUNT=1
+fi
+for ((i = 0; i < GPU_COUNT; i++)); do
+    if [ "$GPU_COUNT" -gt 1 ]; then
+        DEVICES="cuda:$i"
+    else
+        DEVICES="${INFERENCE_DEVICES:-auto}"
+    fi
+    INFERENCE_DEVICES="$DEVICES" celery -A rg_server worker --loglevel=info \
+        -Q gpu -c 1 --prefetch-multiplier 1 -n "gpu$i@%h" &
+done
+
+# Start the worker extracting volumes
+INFERENCE_WARM_UP=0 celery -A rg_server worker --loglevel=info \
+    -Q cpu -c "${CELERY_CPU_CONCURRENCY:-2}" --prefetch-multiplier 1 -n "cpu@%h" &
+
+# Start the worker for library scans, progress and job orchestration
+INFERENCE_WARM_UP=0 celery -A rg_server worker --loglevel=info \
+    -Q io -c "${CELERY_IO_CONCURRENCY:-4}" -n "io@%h" &
 
 # Wait for any process to exit
 wait -n
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import threading
+from abc import ABC, abstractmethod
+
+
+class Aborted(Exception):
+    """Raised by `Progress.check_aborted` and `Progress.suspend` once the work was aborted."""
+
+
+class Progress(ABC):
+    """
+    Lets long running work (e.g. upscaling a page tile by tile) be paused, resumed and aborted from outside.
+
+    The work calls `check_aborted` between units of work, e.g. tiles and pages, and `suspend` while `paused`.
+    Both are called very often, so implementations should answer from a cached state.
+    """
+
+    @property
+    @abstractmethod
+    def paused(self) -> bool: ...
+
+    @property
+    @abstractmethod
+    def aborted(self) -> bool: ...
+
+    @abstractmethod
+    def suspend(self) -> None:
+        """Blocks while paused, raises `Aborted` if the work is aborted in the meantime."""
+
+    def check_aborted(self) -> None:
+        if self.aborted:
+            raise Aborted()
+
+
+class ProgressController(Progress):
+    """A `Progress` that is controlled from another thread of the same process."""
+
+    def __init__(self) -> None:
+        self._aborted = False
+        self._running = threading.Event()
+        self._running.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    @property
+    def aborted(self) -> bool:
+        return self._aborted
+
+    def pause(self) -> None:
+        self._running.clear()
+
+    def resume(self) -> None:
+        self._running.set()
+
+    def abort(self) -> None:
+        self._aborted = True
+        # wake up suspended work, so that it can stop
+        self._running.set()
+
+    def suspend(self) -> None:
+        self._running.wait()
+        self.check_aborted()
+
+
+__all__ = ["Aborted", "Progress", "ProgressController"]
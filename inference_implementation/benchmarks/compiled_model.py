@@ -0,0 +1,98 @@
+"""
+Compares eager and compiled execution of an upscale model on repeated tile shapes.
+
+    python -m inference_implementation.benchmarks.compiled_model --device cpu
+    python -m inference_implementation.benchmarks.compiled_model --model model.pth --device cuda:0 --dtype fp16
+
+Without `--model`, a small Compact (SRVGGNet) model with random weights is used.
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import torch
+from spandrel import ImageModelDescriptor, ModelLoader
+
+from ..pytorch.compiled import CompiledModel
+from ..tools.settings import CompileMode
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def _load_model(model_file: str | None, device: torch.device, dtype: torch.dtype) -> ImageModelDescriptor:
+    if model_file is not None:
+        model = ModelLoader().load_from_file(model_file)
+        assert isinstance(model, ImageModelDescriptor)
+    else:
+        from spandrel.architectures.Compact import CompactArch
+        from spandrel.architectures.Compact.__arch.SRVGG import SRVGGNetCompact
+
+        module = SRVGGNetCompact(num_in_ch=1, num_out_ch=1, num_feat=64, num_conv=16, upscale=4)
+        model = CompactArch().load(module.state_dict())
+    model.to(device, dtype)
+    model.eval()
+    return model
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def _time(model, x: torch.Tensor, iterations: int, warmup: int) -> tuple[float, float]:
+    """Returns the time of the first `warmup` calls (including compilation) and the mean time per call after them."""
+    start = time.perf_counter()
+    for _ in range(warmup):
+        model(x)
+    _synchronize(x.device)
+    warmup_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        model(x)
+    _synchronize(x.device)
+    return warmup_seconds, (time.perf_counter() - start) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=str, default=None, help="Path to the model file.")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, choices=DTYPES.keys(), default="fp32")
+    parser.add_argument("--tile-size", type=int, default=None, help="Input tile size, defaults to 512 on GPU and 128 on CPU.")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = DTYPES[args.dtype]
+    tile_size = args.tile_size or (512 if device.type == "cuda" else 128)
+
+    model = _load_model(args.model, device, dtype)
+    x = torch.rand((args.batch_size, model.input_channels, tile_size, tile_size), device=device, dtype=dtype)
+
+    modes = [CompileMode.COMPILE]
+    if device.type == "cuda":
+        modes.append(CompileMode.CUDA_GRAPHS)
+
+    print(f"{model.architecture.name} on {device} ({dtype}), {args.batch_size}x{tile_size}x{tile_size} tiles")
+    _, eager = _time(model, x, args.iterations, warmup=2)
+    print(f"{'eager':>12}: {eager * 1000:8.1f} ms/tile")
+
+    for mode in modes:
+        # compile on the first call (min_hits=1), the warm-up pays for compilation
+        compiled = CompiledModel(model, mode, min_hits=1)
+        compile_seconds, seconds = _time(compiled, x, args.iterations, warmup=3)
+        torch.testing.assert_close(compiled(x), model(x), atol=2 / 255, rtol=0)
+        print(
+            f"{mode.value:>12}: {seconds * 1000:8.1f} ms/tile, {eager / seconds:.2f}x"
+            f" (compiled in {compile_seconds:.1f} s)"
+        )
+        torch._dynamo.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Times the seams of the tile blender for X and Y directions at typical manga tile sizes.
+
+    python -m inference_implementation.benchmarks.tile_blending
+    python -m inference_implementation.benchmarks.tile_blending --scale 2 --channels 3 --iterations 50
+
+Every seam is timed with the current blend engine (broadcast weights, in-place mixing) and with the
+previous one (full-size weights, three temporaries per seam) as a reference.
+Pages are 2420px on the long side, like `InferenceImplementation.read_page` produces them.
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import numpy as np
+
+from ..upscale.tile_blending import (
+    BlendDirection,
+    TileBlender,
+    TileOverlap,
+    _fast_mix,
+    get_blend_curve,
+    half_sin_blend_fn,
+)
+
+DTYPES = {"uint8": np.uint8, "fp32": np.float32}
+
+
+def _reference_blend(direction: BlendDirection, shape: tuple[int, int, int], blend_size: int) -> np.ndarray:
+    blend = half_sin_blend_fn(np.arange(blend_size, dtype=np.float32) / (blend_size - 1))
+    h, w, c = shape
+    if direction == BlendDirection.X:
+        blend = np.repeat(blend.reshape((1, blend_size, 1)), repeats=h, axis=0)
+    else:
+        blend = np.repeat(blend.reshape((blend_size, 1, 1)), repeats=w, axis=1)
+    return np.repeat(blend, repeats=c, axis=2)
+
+
+def _reference_seam(direction: BlendDirection, left: np.ndarray, right: np.ndarray, blend_size: int) -> None:
+    blend = _reference_blend(direction, left.shape, blend_size)  # type: ignore
+    r = right * blend
+    r += left
+    r -= left * blend
+    if left.dtype.kind in "ui":
+        np.rint(r, out=r)
+    left[...] = r
+
+
+def _current_seam(direction: BlendDirection, left: np.ndarray, right: np.ndarray, blend_size: int) -> None:
+    curve = get_blend_curve(half_sin_blend_fn, blend_size)
+    blend = curve.reshape((1, blend_size, 1) if direction == BlendDirection.X else (blend_size, 1, 1))
+    _fast_mix(left, right, blend, out=left)
+
+
+def _time(fn, iterations: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def _seam_shapes(tile_size: int, overlap: int, scale: int, page_w: int) -> dict[BlendDirection, tuple[int, int]]:
+    """The (h, w) of the seam region for X (inside a row of tiles) and Y (between rows) seams."""
+    blend_size = overlap * 2 * scale
+    return {
+        BlendDirection.X: ((tile_size + overlap * 2) * scale, blend_size),
+        BlendDirection.Y: (blend_size, page_w * scale),
+    }
+
+
+def _row_assembly(tile_size: int, overlap: int, scale: int, page_w: int, channels: int, dtype) -> float:
+    """Blends a whole row of tiles with `TileBlender`, returns the seconds it took."""
+    h = (tile_size + overlap * 2) * scale
+    count = -(-page_w // tile_size)
+    tile_w = -(-page_w // count)
+    tiles = []
+    for x in range(count):
+        left = overlap if x > 0 else 0
+        right = overlap if x < count - 1 else 0
+        width = min(tile_w, page_w - x * tile_w)
+        tiles.append((np.ones((h, (width + left + right) * scale, channels), dtype=dtype), TileOverlap(left * scale, right * scale)))
+
+    start = time.perf_counter()
+    blender = TileBlender(page_w * scale, h, channels, BlendDirection.X, half_sin_blend_fn, dtype=dtype)
+    for tile, tile_overlap in tiles:
+        blender.add_tile(tile, tile_overlap)
+    blender.get_result()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=4)
+    parser.add_argument("--overlap", type=int, default=16)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--page-width", type=int, default=1720, help="Width of a page at the working size.")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    page_w = args.page_width
+    blend_size = args.overlap * 2 * args.scale
+    rng = np.random.default_rng(0)
+
+    print(f"{'dtype':>6} {'tile':>5} {'seam':>4} {'shape':>12} {'before ms':>10} {'after ms':>9} {'speedup':>8}")
+    for dtype_name, dtype in DTYPES.items():
+        for tile_size in (256, 384, 512, 768):
+            for direction, (h, w) in _seam_shapes(tile_size, args.overlap, args.scale, page_w).items():
+                shape = (h, w, args.channels)
+                if dtype == np.uint8:
+                    left = rng.integers(0, 256, shape, dtype=np.uint8)
+                    right = rng.integers(0, 256, shape, dtype=np.uint8)
+                else:
+                    left = rng.random(shape, dtype=np.float32)
+                    right = rng.random(shape, dtype=np.float32)
+
+                before = _time(lambda: _reference_seam(direction, left, right, blend_size), args.iterations)
+                after = _time(lambda: _current_seam(direction, left, right, blend_size), args.iterations)
+                print(
+                    f"{dtype_name:>6} {tile_size:>5} {direction.name:>4} {f'{h}x{w}':>12}"
+                    f" {before * 1000:>10.3f} {after * 1000:>9.3f} {before / after:>7.2f}x"
+                )
+
+    print()
+    print(f"{'dtype':>6} {'tile':>5} {'row of tiles ms':>16}")
+    for dtype_name, dtype in DTYPES.items():
+        for tile_size in (256, 512):
+            seconds = _row_assembly(tile_size, args.overlap, args.scale, page_w, args.channels, dtype)
+            print(f"{dtype_name:>6} {tile_size:>5} {seconds * 1000:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
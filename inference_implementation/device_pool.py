@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Sequence
+
+import numpy as np
+import psutil
+import torch
+from sanic.log import logger
+
+from .api.progress import Progress
+from .inference import InferenceImplementation
+from .pipeline import PagePipeline
+from .tools.gpu import nvidia
+from .tools.settings import Precision, get_settings
+
+
+@dataclass
+class DeviceSlot:
+    """A device of a `DevicePool`, with its own inference implementation (and model replica)."""
+
+    name: str
+    device: torch.device
+    implementation: InferenceImplementation
+    # batches currently running on this device
+    in_flight: int = 0
+    # batches run on this device so far
+    completed: int = 0
+
+    def headroom(self) -> float:
+        """The fraction of the memory of this device that is free, in [0, 1]."""
+        try:
+            if self.device.type == "cuda":
+                index = self.device.index if self.device.index is not None else 0
+                if index < len(nvidia.devices):
+                    usage = nvidia.devices[index].get_current_vram_usage()
+                    return usage.free / usage.total
+                free, total = torch.cuda.mem_get_info(self.device)  # type: ignore
+                return free / total
+            memory = psutil.virtual_memory()
+            return memory.available / memory.total
+        except Exception:
+            return 0.0
+
+
+def parse_devices(spec: str) -> list[torch.device]:
+    """
+    Parses a comma separated list of devices, e.g. "cuda:0,cuda:1".
+
+    "auto" selects every CUDA device, or the default device of the worker if there are none.
+    A CPU device may be listed several times, e.g. "cpu,cpu,cpu" for three CPU backed devices,
+    see `DevicePool` for why CUDA devices may not.
+    """
+    spec = spec.strip()
+    if spec == "auto":
+        count = torch.cuda.device_count() if torch.cuda.is_available() else 0
+        if count > 0:
+            return [torch.device(f"cuda:{i}") for i in range(count)]
+        return [get_settings().device]
+    return [torch.device(part.strip()) for part in spec.split(",") if part.strip()]
+
+
+class DevicePool:
+    """
+    Distributes batches of pages over several devices.
+
+    Every device gets its own `InferenceImplementation`, which keeps a warm replica of the model on it.
+    A batch runs on the device with the fewest batches in flight, ties are broken by the memory
+    headroom of the device, which also accounts for other workers using the same GPU.
+
+    The CPU device may be part of the pool several times (e.g. CPU backed "devices" for testing),
+    such slots share the model replica but are scheduled independently. CUDA devices may not: slots of
+    the same CUDA device would share its pinned staging buffers while they copy to and from it concurrently.
+    """
+
+    def __init__(self, devices: Sequence[torch.device], **implementation_kwargs) -> None:
+        assert len(devices) > 0, "A device pool needs at least one device"
+        cuda_devices = [device for device in devices if device.type == "cuda"]
+        if len(set(cuda_devices)) != len(cuda_devices):
+            raise ValueError(f"CUDA devices can only be part of a device pool once: {', '.join(map(str, devices))}")
+        self.slots: list[DeviceSlot] = []
+        for index, device in enumerate(devices):
+            name = str(device) if list(devices).count(device) == 1 else f"{device}#{index}"
+            self.slots.append(DeviceSlot(name, device, InferenceImplementation(device=device, **implementation_kwargs)))
+        self._lock = threading.Lock()
+        logger.info(f"Device pool: {', '.join(slot.name for slot in self.slots)}.")
+
+    @staticmethod
+    def from_spec(spec: str, **implementation_kwargs) -> DevicePool:
+        return DevicePool(parse_devices(spec), **implementation_kwargs)
+
+    @property
+    def devices(self) -> list[torch.device]:
+        return [slot.device for slot in self.slots]
+
+    def _select(self) -> DeviceSlot:
+        with self._lock:
+            if len(self.slots) == 1:
+                slot = self.slots[0]
+            else:
+                headroom = {slot.name: slot.headroom() for slot in self.slots}
+                slot = min(self.slots, key=lambda s: (s.in_flight, -headroom[s.name]))
+            slot.in_flight += 1
+            return slot
+
+    @contextmanager
+    def acquire(self) -> Iterator[DeviceSlot]:
+        """Reserves the least busy device for one batch."""
+        slot = self._select()
+        try:
+            yield slot
+        finally:
+            with self._lock:
+                slot.in_flight -= 1
+                slot.completed += 1
+
+    def warm_up(self, model_file: str, precision: Precision | None = None) -> None:
+        """Loads (and calibrates) the model on every device of the pool."""
+        for slot in self.slots:
+            slot.implementation.warm_up(model_file, precision)
+
+    def upscale_pages(
+        self,
+        pages: Sequence[np.ndarray],
+        model_file: str,
+        precision: Precision | None = None,
+        progress: Progress | None = None,
+    ) -> list[np.ndarray]:
+        """Upscales the given pages on the least busy device, see `InferenceImplementation.upscale_pages`."""
+        with self.acquire() as slot:
+            return slot.implementation.upscale_pages(pages, model_file, precision, progress)
+
+    def create_pipeline(
+        self,
+        model_file: str,
+        precision: Precision | None = None,
+        prefetch_depth: int = 2,
+        encode_depth: int = 2,
+        batch_size: int | None = None,
+        progress: Progress | None = None,
+    ) -> PagePipeline:
+        """
+        Returns a decode / infer / encode pipeline that keeps every device of the pool busy.
+
+        See `InferenceImplementation.create_pipeline` for the arguments.
+        """
+        implementation = self.slots[0].implementation
+        return PagePipeline(
+            decode=implementation.read_page,
+            infer=lambda pages: self.upscale_pages(pages, model_file, precision, progress),
+            encode=lambda img_out, output_file: implementation.write_page(img_out, model_file, output_file),
+            prefetch_depth=prefetch_depth,
+            encode_depth=encode_depth,
+            batch_size=batch_size if batch_size is not None else implementation.max_batch_size,
+            infer_workers=len(self.slots),
+        )
+
+    def stats(self) -> list[dict[str, object]]:
+        with self._lock:
+            return [
+                {
+                    "name": slot.name,
+                    "in_flight": slot.in_flight,
+                    "completed": slot.completed,
+                    "tiles": slot.implementation.flat_tiles.tiles,
+                    "flat_tiles_skipped": slot.implementation.flat_tiles.skipped,
+                }
+                for slot in self.slots
+            ]
+
+
+__all__ = ["DevicePool", "DeviceSlot", "parse_devices"]
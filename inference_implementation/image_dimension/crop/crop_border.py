@@ -15,26 +15,37 @@ class SelectMode(Enum):
 def crop_border_node(
     img: np.ndarray, tolerance: float, select: SelectMode, padding: int
 ) -> np.ndarray:
+    return get_content_region(img, tolerance, select, padding).read_from(img)
+
+
+def get_content_region(
+    img: np.ndarray, tolerance: float, select: SelectMode, padding: int
+) -> Region:
+    """
+    Returns the region of the image inside its border, plus the given padding.
+
+    `tolerance` is in percent of the value range of the image, which is [0, 255] for uint8 images.
+    """
     tolerance /= 100
+    if img.dtype == np.uint8:
+        tolerance *= 255
 
-    h, w, c = get_h_w_c(img)
+    h, w, _ = get_h_w_c(img)
 
     # find the border color of the border
-    border_color = get_border_color(img)
+    border_color = get_border_color(img).astype(np.float32)
 
     # figure out which pixels are likely part of the border
-    diff: np.ndarray = np.abs(img - border_color)
-    if c > 1:
-        # make grayscale
+    diff: np.ndarray = np.abs(img.astype(np.float32) - border_color)
+    if diff.ndim == 3:
+        # make grayscale (single channel images may still have a channel axis)
         diff = np.mean(diff, axis=-1)
     is_content = diff > tolerance
 
     # get crop region crop bounds
     crop = get_crop_region(is_content, select)
     crop = crop.add_padding(Padding.all(padding))
-    crop = crop.intersect(Region(0, 0, w, h))
-
-    return crop.read_from(img)
+    return crop.intersect(Region(0, 0, w, h))
 
 
 def get_crop_region(is_content: np.ndarray, select: SelectMode) -> Region:
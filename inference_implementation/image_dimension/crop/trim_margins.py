@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+import numpy as np
+from ...tools.utils import Region, get_h_w_c
+from .crop_border import SelectMode, get_border_color, get_content_region
+
+
+@dataclass(frozen=True)
+class MarginTrim:
+    """
+    The content box of a page and the color of the (uniform) margins around it.
+
+    Only the content box is upscaled, `pad` puts the margins back at the scale of the result, so that
+    the result has exactly the size the whole page would have had.
+    """
+
+    width: int
+    height: int
+    # the part of the page that is upscaled, including some margin as context for the model
+    content: Region
+    # the color of the margins, one value per channel, in the value range of the page
+    color: np.ndarray
+
+    @property
+    def saving(self) -> float:
+        """The fraction of the pixels of the page that don't have to be upscaled."""
+        return 1 - (self.content.width * self.content.height) / (self.width * self.height)
+
+    def crop(self, img: np.ndarray) -> np.ndarray:
+        h, w, _ = get_h_w_c(img)
+        assert (w, h) == (self.width, self.height)
+        return self.content.read_from(img)
+
+    def pad(self, upscaled: np.ndarray, scale: int) -> np.ndarray:
+        """Returns the upscaled content box surrounded by margins of the border color, at the given scale."""
+        h, w, c = get_h_w_c(upscaled)
+        assert (w, h) == (self.content.width * scale, self.content.height * scale)
+        assert c == len(self.color)
+
+        color = self.color
+        if upscaled.dtype == np.uint8:
+            color = np.clip(np.rint(color), 0, 255)
+        shape = (self.height * scale, self.width * scale) + upscaled.shape[2:]
+        result = np.empty(shape, dtype=upscaled.dtype)
+        result[...] = color.astype(upscaled.dtype).reshape(upscaled.shape[2:])
+
+        box = self.content.scale(scale)
+        result[box.y : box.y + h, box.x : box.x + w] = upscaled
+        return result
+
+
+def find_margin_trim(
+    img: np.ndarray, tolerance: float = 4, padding: int = 16, min_saving: float = 0.1
+) -> MarginTrim | None:
+    """
+    Finds the uniform margins of a page, see `get_content_region` for the `tolerance` (in percent).
+
+    The content box is padded by `padding` pixels of margin, so that the model sees the edge of the content
+    like it would on the whole page. Returns None if trimming would save less than `min_saving` of the pixels.
+    """
+    h, w, c = get_h_w_c(img)
+    # blank pages are all content, they are left to the flat tile detection
+    content = get_content_region(img, tolerance, SelectMode.ALL_SECTIONS, padding)
+    color = np.atleast_1d(get_border_color(img)).astype(np.float32)
+    trim = MarginTrim(w, h, content, color.reshape((c,)))
+    if trim.saving < min_saving:
+        return None
+    return trim
+
+
+__all__ = ["MarginTrim", "find_margin_trim"]
@@ -1,23 +1,108 @@
 from __future__ import annotations
+from typing import Sequence
 import numpy as np
 import torch
 from PIL import Image
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
 from .pytorch import auto_split
+from .pytorch.precision import check_precision_parity, get_inference_dtype
 from .tools import resize, save_image
-from .upscale.tiler import MaxTileSize
-from spandrel import ImageModelDescriptor, ModelLoader
+from .tools.utils import get_h_w_c
+from .tools.image_utils import to_uint8
+from .pytorch.compiled import CompiledModel
+from .pytorch.memory_profile import MemoryProfile, get_memory_budget, get_memory_profile
+from .pytorch.model_registry import model_hash, model_registry
+from .pipeline import PagePipeline
+from .upscale.passthrough import FlatTileStats
+from .upscale.tile_size_memory import TileSizeKey, TileSizeMemory
+from .upscale.tiler import LearnedTileSize
+from .tools.settings import CompileMode, Precision, get_settings
+from .image_dimension.crop.trim_margins import MarginTrim, find_margin_trim
 from .image_dimension.resize import resize_to_side
 from .api.lazy import Lazy
+from .api.progress import Progress
 from pathlib import Path
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
 
 class InferenceImplementation:
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        device: torch.device | None = None,
+        max_batch_size: int = 4,
+        precision: Precision | None = None,
+        model_precisions: dict[str, Precision] | None = None,
+        tile_size_memory: TileSizeMemory | None = None,
+        calibrate_memory: bool = True,
+        compile_mode: CompileMode | None = None,
+        tile_batch_size: int = 1,
+        device_blend: bool = False,
+        flat_tolerance: float | None = None,
+        margin_tolerance: float | None = None,
+    ):
+        self._device: torch.device | None = device
+        self.max_batch_size: int = max_batch_size
+        # batch sizes known to fit on the device, per page shape
+        self._batch_sizes: dict[tuple[int, int, int], int] = {}
+        self._precision: Precision | None = precision
+        # per model overrides of the default precision, keyed by model file
+        self.model_precisions: dict[str, Precision] = model_precisions or {}
+        # dtypes that passed the parity check, per model, device and requested precision
+        self._dtypes: dict[tuple[str, str, Precision], torch.dtype] = {}
+        # tile sizes known to fit on the device, only kept in memory unless a path is given
+        self.tile_size_memory: TileSizeMemory = tile_size_memory or TileSizeMemory()
+        # whether to calibrate the memory usage of models, to pick the first tile size of unknown page sizes
+        self.calibrate_memory: bool = calibrate_memory
+        self._profiles: dict[tuple[str, str, torch.dtype], MemoryProfile | None] = {}
+        self._compile_mode: CompileMode | None = compile_mode
+        self._compiled: dict[tuple[str, str, torch.dtype], CompiledModel] = {}
+        # tiles of the same size sent through the model at once, when a page has to be split
+        self.tile_batch_size: int = tile_batch_size
+        # whether tiles are blended on the device, so that a split page is downloaded only once
+        self.device_blend: bool = device_blend
+        # tiles that are flat within this tolerance are filled instead of upscaled, None upscales every tile
+        self.flat_tolerance: float | None = flat_tolerance
+        # tiles upscaled and skipped so far, over all pages
+        self.flat_tiles: FlatTileStats = FlatTileStats()
+        # uniform page margins (within this tolerance, in percent) are trimmed before and restored after
+        # upscaling, None upscales whole pages
+        self.margin_tolerance: float | None = margin_tolerance
 
-    def process_image(self, input_file: str, model_file: str, output_file: str):
+    @property
+    def device(self) -> torch.device:
+        # resolved lazily, so that importing this module in a pre-fork parent doesn't touch CUDA
+        if self._device is None:
+            self._device = get_settings().device
+        return self._device
+
+    @property
+    def precision(self) -> Precision:
+        if self._precision is None:
+            self._precision = get_settings().precision
+        return self._precision
+
+    @property
+    def compile_mode(self) -> CompileMode:
+        if self._compile_mode is None:
+            self._compile_mode = get_settings().compile_mode
+        return self._compile_mode
+
+    def warm_up(self, model_file: str, precision: Precision | None = None) -> None:
+        """
+        Loads the model onto the device ahead of the first page, and calibrates its memory usage
+        unless a profile is already stored next to the model.
+
+        Args:
+            model_file (str): Path to the model file.
+            precision (Precision | None): Requested precision, defaults to the precision of the model or worker.
+        """
+        model, dtype = self._get_model(model_file, precision)
+        self._get_memory_profile(model_file, model, dtype)
+        logger.info(f"Model {model_file} is warm on {self.device} ({dtype}).")
+
+    def process_image(self, input_file: str, model_file: str, output_file: str, precision: Precision | None = None):
         """
         Process an image using the specified model and save the output.
 
@@ -25,48 +110,284 @@ class InferenceImplementation:
             input_file (str): Path to the input image file.
             model_file (str): Path to the model file.
             output_file (str): Path to save the output image.
+            precision (Precision | None): Requested precision, defaults to the precision of the model or worker.
+        """
+
+        # the model is only read from disk once per worker, then stays resident
+        model, dtype = self._get_model(model_file, precision)
+
+        img_rts = self.read_page(input_file)
+        trim = self._find_margin_trim(img_rts, model)
+        if trim is not None:
+            img_rts = trim.crop(img_rts)
+
+        self._notify('Inference | Image resized, processing...')
+
+        # start at the last tile size that worked for this model and page size
+        key = self._tile_size_key(model_file, dtype, get_h_w_c(img_rts))
+        tiler = self._get_tiler(key, model_file, model, dtype)
+
+        # process image
+        stats = FlatTileStats()
+        img_out = auto_split.pytorch_auto_split(
+            img_rts, model, self.device, False, tiler, dtype=dtype, tile_batch_size=self.tile_batch_size,
+            device_blend=self.device_blend, flat_tolerance=self.flat_tolerance, flat_stats=stats,
+            result_dtype=np.uint8,
+        )
+        self.tile_size_memory.remember(key, tiler)
+        self._record_flat_tiles(input_file, stats)
+        if trim is not None:
+            img_out = trim.pad(img_out, model.scale)
+
+        self.write_page(img_out, model_file, output_file)
+
+    def process_batch(self, inputs: Sequence[str], model_file: str, outputs: Sequence[str], precision: Precision | None = None):
+        """
+        Process several images using the specified model and save the outputs.
+
+        Pages that have the same shape after resizing are sent through the model together
+        as one NCHW batch. The outputs are the same as calling `process_image` on every page.
+
+        Args:
+            inputs (Sequence[str]): Paths to the input image files.
+            model_file (str): Path to the model file.
+            outputs (Sequence[str]): Paths to save the output images, in the same order as `inputs`.
+            precision (Precision | None): Requested precision, defaults to the precision of the model or worker.
+        """
+
+        assert len(inputs) == len(outputs)
+
+        pages = [self.read_page(input_file) for input_file in inputs]
+
+        self._notify(f'Inference | {len(pages)} images resized, processing...')
+
+        imgs_out = self.upscale_pages(pages, model_file, precision)
+        del pages
+
+        for img_out, output_file in zip(imgs_out, outputs):
+            self.write_page(img_out, model_file, output_file)
+
+    def upscale_pages(
+        self,
+        pages: Sequence[np.ndarray],
+        model_file: str,
+        precision: Precision | None = None,
+        progress: Progress | None = None,
+    ) -> list[np.ndarray]:
+        """
+        Upscales already decoded pages, sending pages of the same shape through the model as one batch.
+
+        Args:
+            pages (Sequence[np.ndarray]): Decoded and resized pages, as returned by `read_page`.
+            model_file (str): Path to the model file.
+            precision (Precision | None): Requested precision, defaults to the precision of the model or worker.
+            progress (Progress | None): Checked between pages and tiles, raises `Aborted` once aborted and
+                waits while paused. The model stays loaded either way.
+
+        Returns:
+            list[np.ndarray]: The upscaled pages as uint8 (like `write_page` saves them), in the same order as `pages`.
         """
 
-        # loading GPU
-        device_gpu = torch.device("cuda:0")
+        model, dtype = self._get_model(model_file, precision)
+
+        # only the content boxes of pages with wide margins go through the model
+        trims = [self._find_margin_trim(page, model) for page in pages]
+        pages = [page if trim is None else trim.crop(page) for page, trim in zip(pages, trims)]
+
+        # group pages of identical shape, keeping the original order inside each group
+        groups: dict[tuple[int, int, int], list[int]] = {}
+        for index, page in enumerate(pages):
+            groups.setdefault(get_h_w_c(page), []).append(index)
+
+        imgs_out: list[np.ndarray | None] = [None] * len(pages)
+        page_stats = [FlatTileStats() for _ in pages]
+        for shape, indexes in groups.items():
+            h, w, _ = shape
+            key = self._tile_size_key(model_file, dtype, shape)
+            tiler = self._get_tiler(key, model_file, model, dtype)
+            group = [pages[i] for i in indexes]
 
-        # loads a model from disk
-        model = ModelLoader().load_from_file(model_file)
-        # making sure it's an image-to-image model before preparing it for inference
-        assert isinstance(model, ImageModelDescriptor)
-        _ = model.cuda().eval()
+            if tiler.tile_size < max(w, h) + 10:
+                # pages of this size are known not to fit in one go, so don't even try to batch them
+                group_out = [
+                    auto_split.pytorch_auto_split(
+                        pages[i], model, self.device, False, tiler, dtype=dtype, tile_batch_size=self.tile_batch_size,
+                        device_blend=self.device_blend, flat_tolerance=self.flat_tolerance, flat_stats=page_stats[i],
+                        progress=progress, result_dtype=np.uint8,
+                    )
+                    for i in indexes
+                ]
+            else:
+                batch_size = self._batch_sizes.get(shape, self.max_batch_size)
+                group_out, batch_size = auto_split.pytorch_batch_upscale(
+                    group, model, self.device, False, tiler, batch_size, dtype=dtype, tile_batch_size=self.tile_batch_size,
+                    device_blend=self.device_blend, flat_tolerance=self.flat_tolerance,
+                    flat_stats=[page_stats[i] for i in indexes], progress=progress, result_dtype=np.uint8,
+                )
+                self._batch_sizes[shape] = batch_size
 
-        # set tile size to maximum possible (low VRAM usage is the default)
-        tiler = MaxTileSize()
+            if tiler.last_tile_size is None:
+                # every page fit in one go
+                if self.tile_size_memory.get(key) is None:
+                    self.tile_size_memory.record(key, max(w, h) + 10)
+            else:
+                self.tile_size_memory.remember(key, tiler)
+            del group
+
+            for index, img_out in zip(indexes, group_out):
+                imgs_out[index] = img_out
+
+        for index, stats in enumerate(page_stats):
+            self._record_flat_tiles(f"Page {index + 1} of {len(pages)}", stats)
+        for index, trim in enumerate(trims):
+            if trim is not None:
+                imgs_out[index] = trim.pad(imgs_out[index], model.scale)  # type: ignore
+
+        return imgs_out  # type: ignore
+
+    def create_pipeline(
+        self,
+        model_file: str,
+        precision: Precision | None = None,
+        prefetch_depth: int = 2,
+        encode_depth: int = 2,
+        batch_size: int | None = None,
+        progress: Progress | None = None,
+    ) -> PagePipeline:
+        """
+        Returns a decode / infer / encode pipeline for the given model.
+
+        Args:
+            model_file (str): Path to the model file.
+            precision (Precision | None): Requested precision, defaults to the precision of the model or worker.
+            prefetch_depth (int): Number of pages decoded ahead of the model.
+            encode_depth (int): Number of finished pages that may wait for or be in encoding.
+            batch_size (int | None): Number of pages handed to the model at once, defaults to `max_batch_size`.
+            progress (Progress | None): Lets the pipeline be paused and aborted, see `upscale_pages`.
+        """
+
+        return PagePipeline(
+            decode=self.read_page,
+            infer=lambda pages: self.upscale_pages(pages, model_file, precision, progress),
+            encode=lambda img_out, output_file: self.write_page(img_out, model_file, output_file),
+            prefetch_depth=prefetch_depth,
+            encode_depth=encode_depth,
+            batch_size=batch_size if batch_size is not None else self.max_batch_size,
+        )
+
+    def _get_model(self, model_file: str, precision: Precision | None) -> tuple[ImageModelDescriptor, torch.dtype]:
+        if precision is None:
+            precision = self.model_precisions.get(model_file, self.precision)
+
+        key = (model_file, str(self.device), precision)
+        dtype = self._dtypes.get(key)
+        if dtype is None:
+            reference = model_registry.get(model_file, self.device, torch.float32)
+            dtype = get_inference_dtype(precision, reference, self.device)
+            if dtype != torch.float32:
+                # only trust reduced precision if it produces (almost) the same pages as FP32
+                model = model_registry.get(model_file, self.device, dtype)
+                if check_precision_parity(reference, model, self.device):
+                    model_registry.discard(model_file, self.device, torch.float32)
+                else:
+                    logger.warning(f"Falling back to FP32 mode for {model_file}.")
+                    model_registry.discard(model_file, self.device, dtype)
+                    dtype = torch.float32
+            self._dtypes[key] = dtype
+
+        model = model_registry.get(model_file, self.device, dtype)
+        if self.compile_mode == CompileMode.OFF:
+            return model, dtype
+
+        compiled_key = (model_file, str(self.device), dtype)
+        compiled = self._compiled.get(compiled_key)
+        if compiled is None or compiled.eager is not model:
+            # (re)compile whenever the registry loaded a new copy of the model
+            compiled = CompiledModel(model, self.compile_mode)
+            self._compiled[compiled_key] = compiled
+        return compiled, dtype  # type: ignore
+
+    def _find_margin_trim(self, page: np.ndarray, model: ImageModelDescriptor) -> MarginTrim | None:
+        if self.margin_tolerance is None or model.input_channels != model.output_channels:
+            return None
+        trim = find_margin_trim(page, self.margin_tolerance)
+        if trim is not None:
+            logger.debug(f"Trimmed the margins of a {trim.width}x{trim.height}px page, {trim.saving:.0%} fewer pixels.")
+        return trim
+
+    def _record_flat_tiles(self, page: str, stats: FlatTileStats) -> None:
+        self.flat_tiles.add(stats)
+        if stats.skipped > 0:
+            logger.debug(f"{page}: skipped {stats.skipped} of {stats.tiles} tiles, they were flat.")
+
+    def _tile_size_key(self, model_file: str, dtype: torch.dtype, shape: tuple[int, int, int]) -> TileSizeKey:
+        h, w, c = shape
+        return self.tile_size_memory.key_for(model_hash(model_file), self.device, dtype, w, h, c)
+
+    def _get_tiler(self, key: TileSizeKey, model_file: str, model: ImageModelDescriptor, dtype: torch.dtype) -> LearnedTileSize:
+        # a tile size learned from earlier pages beats any estimation
+        if self.tile_size_memory.get(key) is not None:
+            return self.tile_size_memory.tiler_for(key)
+
+        profile = self._get_memory_profile(model_file, model, dtype)
+        if profile is None:
+            # try the whole page first
+            return LearnedTileSize()
+        budget = get_memory_budget(self.device, get_settings().budget_limit)
+        return LearnedTileSize(profile.tile_size_for(budget))
+
+    def _get_memory_profile(self, model_file: str, model: ImageModelDescriptor, dtype: torch.dtype) -> MemoryProfile | None:
+        if not self.calibrate_memory:
+            return None
+
+        if isinstance(model, CompiledModel):
+            # calibration runs odd tile sizes, which are not worth compiling
+            model = model.eager
+
+        key = (model_file, str(self.device), dtype)
+        if key not in self._profiles:
+            try:
+                self._profiles[key] = get_memory_profile(model_file, model, self.device, dtype, model_hash(model_file))
+            except Exception as e:
+                logger.warning(f"Unable to calibrate memory usage of {model_file}, trying whole pages first: {e}")
+                self._profiles[key] = None
+        return self._profiles[key]
+
+    def read_page(self, input_file: str) -> np.ndarray:
+        """
+        Decodes a page as a grayscale uint8 image and resizes it to the working size.
+
+        The page stays uint8, it is normalized on the device. Only pages that have to be
+        resized go through float32 (at the working size) on the host.
+        """
         # open image and convert to grayscale
-        img_pil = Image.open(input_file).convert("L")
-        img_np = np.array(img_pil, dtype=np.float32) / 255.0
+        img_np = np.array(Image.open(input_file).convert("L"), dtype=np.uint8)
 
         # resize image to a standard size keeping aspect ratio (the 2nd argument is the longest side of the screen)
-        img_rts = resize_to_side.resize_to_side_node(
-            img_np,
+        h, w, _ = get_h_w_c(img_np)
+        out_dims = resize_to_side.resize_to_side_conditional(
+            w,
+            h,
             2420,
             resize_to_side.SideSelection.LONGER_SIDE,
             resize_to_side.ResizeCondition.DOWNSCALE,
-            resize.ResizeFilter.LANCZOS,
         )
+        if out_dims == (w, h):
+            return img_np
 
-        channel_layer = get_channel_layer()
-        if channel_layer:
-            async_to_sync(channel_layer.group_send)(
-                'process_group',
-                {
-                    'type': 'process.message',
-                    'message': 'Inference | Image resized, processing...'
-                }
-            )
+        img_rts = resize.resize(img_np.astype(np.float32) / 255.0, out_dims, resize.ResizeFilter.LANCZOS)
+        return to_uint8(img_rts, normalized=True)
 
-        # process image
-        img_out = auto_split.pytorch_auto_split(img_rts, model, device_gpu, False, tiler)
-
-        # computing output image after upscaling
-        output_img = img_out * 255.0
-        output_np_uint8 = np.clip(output_img, 0, 255).astype(np.uint8)
+    def write_page(self, img_out: np.ndarray, model_file: str, output_file: str):
+        """
+        Quantizes an upscaled page and encodes it as a JPEG.
+        """
+        # computing output image after upscaling (uint8 pages were already quantized on the device)
+        if img_out.dtype == np.uint8:
+            output_np_uint8 = img_out
+        else:
+            output_img = img_out * 255.0
+            output_np_uint8 = np.clip(output_img, 0, 255).astype(np.uint8)
         output_np_2d = output_np_uint8.squeeze()
 
         # saving image
@@ -93,6 +414,17 @@ class InferenceImplementation:
             False,  # ignore if output file already exists
         )
 
+    def _notify(self, message: str):
+        channel_layer = get_channel_layer()
+        if channel_layer:
+            async_to_sync(channel_layer.group_send)(
+                'process_group',
+                {
+                    'type': 'process.message',
+                    'message': message
+                }
+            )
+
 
     # if __name__ == "__main__":
     #     import argparse
@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Generic, Iterable, Iterator, Sequence, TypeVar
+
+import numpy as np
+from sanic.log import logger
+
+T = TypeVar("T")
+
+DecodeFn = Callable[[str], np.ndarray]
+InferFn = Callable[[Sequence[np.ndarray]], Sequence[np.ndarray]]
+EncodeFn = Callable[[np.ndarray, str], None]
+
+
+@dataclass
+class StageTimer:
+    seconds: float = 0.0
+    count: int = 0
+
+    @property
+    def average(self) -> float:
+        return self.seconds / self.count if self.count > 0 else 0.0
+
+
+@dataclass
+class PipelineStats:
+    """
+    Per-stage timing counters of a `PagePipeline`.
+
+    `infer_wait` is the time the inference stage spent waiting for decoded pages,
+    i.e. the time the device was idle because of the decode stage.
+    """
+
+    decode: StageTimer = field(default_factory=StageTimer)
+    infer: StageTimer = field(default_factory=StageTimer)
+    infer_wait: StageTimer = field(default_factory=StageTimer)
+    encode: StageTimer = field(default_factory=StageTimer)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, stage: str, seconds: float, count: int = 1) -> None:
+        with self._lock:
+            timer: StageTimer = getattr(self, stage)
+            timer.seconds += seconds
+            timer.count += count
+
+    def as_dict(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {
+                stage: {"seconds": timer.seconds, "count": timer.count, "average": timer.average}
+                for stage, timer in (
+                    ("decode", self.decode),
+                    ("infer", self.infer),
+                    ("infer_wait", self.infer_wait),
+                    ("encode", self.encode),
+                )
+            }
+
+
+class _Done:
+    pass
+
+
+class PagePipeline(Generic[T]):
+    """
+    A bounded decode / infer / encode pipeline for pages.
+
+    A pool of decoder threads reads and resizes the next `prefetch_depth` pages while the model runs
+    on the current batch. Finished outputs are handed to a separate pool of encoder threads, at most
+    `encode_depth` of them are in flight at any time.
+
+    The model runs on `infer_workers` threads, e.g. one per device of a `DevicePool`, each working
+    on its own batch. With a single infer worker, the model only ever runs on one thread.
+
+    Pages are yielded in order, once their output has been written.
+    """
+
+    def __init__(
+        self,
+        decode: DecodeFn,
+        infer: InferFn,
+        encode: EncodeFn,
+        prefetch_depth: int = 2,
+        encode_depth: int = 2,
+        batch_size: int = 1,
+        infer_workers: int = 1,
+    ) -> None:
+        assert prefetch_depth >= 0
+        assert encode_depth > 0
+        assert batch_size > 0
+        assert infer_workers > 0
+        self.decode = decode
+        self.infer = infer
+        self.encode = encode
+        self.prefetch_depth: int = prefetch_depth
+        self.encode_depth: int = encode_depth
+        self.batch_size: int = batch_size
+        self.infer_workers: int = infer_workers
+        self.stats = PipelineStats()
+
+    def _timed_decode(self, input_file: str) -> np.ndarray:
+        start = time.perf_counter()
+        img = self.decode(input_file)
+        self.stats.add("decode", time.perf_counter() - start)
+        return img
+
+    def _timed_encode(self, img: np.ndarray, output_file: str) -> None:
+        start = time.perf_counter()
+        self.encode(img, output_file)
+        self.stats.add("encode", time.perf_counter() - start)
+
+    def run(self, items: Iterable[tuple[str, str, T]]) -> Iterator[T]:
+        """
+        Processes the given `(input_file, output_file, tag)` items and yields the tag of
+        every page, in order, once its output file has been written.
+        """
+        decode_pool = ThreadPoolExecutor(
+            max_workers=max(1, self.prefetch_depth), thread_name_prefix="page-decode"
+        )
+        infer_pool = ThreadPoolExecutor(
+            max_workers=self.infer_workers, thread_name_prefix="page-infer"
+        )
+        encode_pool = ThreadPoolExecutor(
+            max_workers=self.encode_depth, thread_name_prefix="page-encode"
+        )
+        infer_slots = threading.Semaphore(self.infer_workers)
+        encode_slots = threading.Semaphore(self.encode_depth)
+        # one entry per batch, in order: the tags of its pages and the future of their encoders
+        results: queue.Queue[tuple[list[T], Future[list[Future[None]]]] | BaseException | _Done] = queue.Queue()
+        stopped = threading.Event()
+
+        def acquire(slots: threading.Semaphore) -> bool:
+            # wait for a free slot, but don't hang if the consumer went away
+            while not slots.acquire(timeout=0.1):
+                if stopped.is_set():
+                    return False
+            return True
+
+        def infer_batch(batch: list[tuple[str, T, Future[np.ndarray]]]) -> list[Future[None]]:
+            try:
+                start = time.perf_counter()
+                imgs = [future.result() for _, _, future in batch]
+                self.stats.add("infer_wait", time.perf_counter() - start)
+
+                start = time.perf_counter()
+                outputs = self.infer(imgs)
+                self.stats.add("infer", time.perf_counter() - start, len(imgs))
+                del imgs
+            finally:
+                infer_slots.release()
+
+            encoders: list[Future[None]] = []
+            for (output_file, _, _), output in zip(batch, outputs):
+                if not acquire(encode_slots):
+                    break
+                encoder = encode_pool.submit(self._timed_encode, output, output_file)
+                # slots are freed as soon as a page is written, not when the consumer gets to it,
+                # so that a later batch can't hold all slots while an earlier one waits for them
+                encoder.add_done_callback(lambda _: encode_slots.release())
+                encoders.append(encoder)
+            return encoders
+
+        def infer_stage() -> None:
+            try:
+                item_iter = iter(items)
+                pending: deque[tuple[str, T, Future[np.ndarray]]] = deque()
+
+                def prefetch() -> None:
+                    while len(pending) < self.batch_size * self.infer_workers + self.prefetch_depth:
+                        item = next(item_iter, None)
+                        if item is None:
+                            return
+                        input_file, output_file, tag = item
+                        pending.append((output_file, tag, decode_pool.submit(self._timed_decode, input_file)))
+
+                prefetch()
+                while pending and not stopped.is_set():
+                    if not acquire(infer_slots):
+                        return
+                    batch = [pending.popleft() for _ in range(min(self.batch_size, len(pending)))]
+                    results.put(([tag for _, tag, _ in batch], infer_pool.submit(infer_batch, batch)))
+                    del batch
+                    # start decoding the next pages while the model is busy with this batch
+                    prefetch()
+            except BaseException as e:
+                results.put(e)
+            finally:
+                results.put(_Done())
+
+        infer_thread = threading.Thread(target=infer_stage, name="page-schedule", daemon=True)
+        infer_thread.start()
+
+        try:
+            while True:
+                entry = results.get()
+                if isinstance(entry, _Done):
+                    break
+                if isinstance(entry, BaseException):
+                    raise entry
+                tags, batch_future = entry
+                encoders = batch_future.result()
+                for tag, encoder in zip(tags, encoders):
+                    encoder.result()
+                    yield tag
+        finally:
+            stopped.set()
+            infer_thread.join()
+            decode_pool.shutdown(wait=True, cancel_futures=True)
+            infer_pool.shutdown(wait=True, cancel_futures=True)
+            encode_pool.shutdown(wait=True)
+            logger.debug(f"Page pipeline stats: {self.stats.as_dict()}")
+
+
+__all__ = ["PagePipeline", "PipelineStats", "StageTimer"]
@@ -1,14 +1,22 @@
 from __future__ import annotations
 
 import gc
+from typing import Callable, Sequence
+
 import numpy as np
 import torch
+from sanic.log import logger
 from spandrel import ImageModelDescriptor
 
-# from api import Progress
-
+from ..api.progress import Progress
+from ..tools.utils import get_h_w_c
 from ..upscale.auto_split import Split, Tiler, auto_split
+from ..upscale.passthrough import FlatTileStats, fill_flat, flat_color
+from ..upscale.tile_blending import RowCollector, RowSink
 from ..pytorch.utils import safe_cuda_cache_empty
+from .cpu_backend import as_cpu_input
+from .device_blending import device_auto_split
+from .staging import PinnedBufferPool, download, get_pinned_pool, upload
 
 
 def _into_standard_image_form(t: torch.Tensor) -> torch.Tensor:
@@ -68,6 +76,252 @@ def _into_tensor(
         img.flags.writeable = writeable
 
 
+def _get_staging_pool(device: torch.device) -> PinnedBufferPool | None:
+    # pinned memory only helps (and only exists) for CUDA devices
+    if device.type == "cuda":
+        return get_pinned_pool(device)
+    return None
+
+
+def _upload(
+    img: np.ndarray,
+    device: torch.device,
+    dtype: torch.dtype,
+    pool: PinnedBufferPool | None,
+    purpose: str = "upload",
+) -> torch.Tensor:
+    if pool is None:
+        t = _into_tensor(img, device, dtype)
+    else:
+        t = upload(np.ascontiguousarray(img), device, dtype, pool, purpose)
+    if img.dtype == np.uint8:
+        # uint8 images are uploaded as is and normalized on the device
+        t = t.div_(255)
+    return t
+
+
+def _quantize(t: torch.Tensor) -> torch.Tensor:
+    """
+    Converts a [0, 1] tensor to uint8 on the device, clipping and truncating like the host path.
+    """
+    return (t.float() * 255).clamp_(0, 255).to(torch.uint8)
+
+
+def _download(t: torch.Tensor, pool: PinnedBufferPool | None) -> np.ndarray:
+    """
+    Copies the given tensor to the host as uint8 if it is quantized, and as float32 otherwise.
+
+    With a staging pool, the result is a view of a pinned buffer that is reused by the next download.
+    """
+    t = t.detach()
+    if t.dtype != torch.uint8:
+        t = t.float()
+    if pool is None:
+        return t.cpu().numpy()
+    return download(t, pool)
+
+
+def _get_dtype(use_fp16: bool, dtype: torch.dtype | None) -> torch.dtype:
+    if dtype is not None:
+        return dtype
+    return torch.float16 if use_fp16 else torch.float32
+
+
+def _is_out_of_memory(e: RuntimeError) -> bool:
+    # Check to see if its actually the CUDA out of memory error
+    return "allocate" in str(e) or "CUDA" in str(e)
+
+
+def _free_after_out_of_memory(input_tensor: torch.Tensor | None) -> None:
+    # Collect garbage (clear VRAM)
+    if input_tensor is not None:
+        try:
+            input_tensor.detach().cpu()
+        except Exception:
+            pass
+        del input_tensor
+    gc.collect()
+    safe_cuda_cache_empty()
+
+
+class _FlatTiles:
+    """
+    Fills flat tiles (see `flat_color`) directly at the output scale of the model instead of upscaling them,
+    and counts the tiles of a page in `stats`.
+
+    Only models that keep the number of channels can be skipped, and a `tolerance` of None disables skipping.
+    """
+
+    def __init__(
+        self, model: ImageModelDescriptor[torch.nn.Module], tolerance: float | None, stats: FlatTileStats | None
+    ) -> None:
+        self.scale: int = model.scale
+        self.tolerance: float | None = tolerance if model.input_channels == model.output_channels else None
+        self.stats: FlatTileStats = stats if stats is not None else FlatTileStats()
+
+    def fill(self, img: np.ndarray) -> np.ndarray | None:
+        """The upscaled tile if the given tile is flat, None if it has to go through the model."""
+        if self.tolerance is None:
+            return None
+        color = flat_color(img, self.tolerance)
+        if color is None:
+            return None
+
+        self.stats.tiles += 1
+        self.stats.skipped += 1
+        h, w, _ = get_h_w_c(img)
+        return fill_flat(color, w * self.scale, h * self.scale, np.uint8 if img.dtype == np.uint8 else np.float32)
+
+    def fill_batch(self, batch: torch.Tensor) -> tuple[list[bool], torch.Tensor | None]:
+        """
+        Finds the flat tiles of a (N, C, H, W) batch on its device.
+
+        Returns which tiles are flat and their mean colors as a (N, C) tensor, None if no tile is flat.
+        """
+        n = batch.shape[0]
+        if self.tolerance is None:
+            return [False] * n, None
+        spread = batch.amax(dim=(2, 3)) - batch.amin(dim=(2, 3))
+        flat = (spread <= self.tolerance).all(dim=1).tolist()
+        if not any(flat):
+            return flat, None
+
+        self.stats.tiles += sum(flat)
+        self.stats.skipped += sum(flat)
+        return flat, batch.mean(dim=(2, 3), dtype=torch.float32)
+
+
+def _batch_upscaler(
+    model: ImageModelDescriptor[torch.nn.Module],
+    device: torch.device,
+    dtype: torch.dtype,
+    pool: PinnedBufferPool | None,
+) -> Callable[[Sequence[np.ndarray]], list[np.ndarray] | Split]:
+    """
+    Returns a function that sends images of identical shape through the model as one NCHW batch.
+    """
+
+    def upscale(batch: Sequence[np.ndarray]) -> list[np.ndarray] | Split:
+        input_tensor = None
+        try:
+            # convert to a (N, C, H, W) tensor
+            input_tensor = as_cpu_input(
+                torch.cat(
+                    [
+                        _into_batched_form(
+                            _rgb_to_bgr(_upload(img, device, dtype, pool, f"upload-{i}"))
+                        )
+                        for i, img in enumerate(batch)
+                    ]
+                )
+            )
+
+            # inference
+            output_tensor = model(input_tensor)
+
+            # convert every (C, H, W) result back to numpy
+            results: list[np.ndarray] = []
+            for t in output_tensor:
+                t = _rgb_to_bgr(_into_standard_image_form(t))
+                if batch[0].dtype == np.uint8:
+                    t = _quantize(t)
+                # the results outlive the staging buffers
+                results.append(np.array(_download(t, pool), copy=True))
+            return results
+        except RuntimeError as e:
+            if _is_out_of_memory(e):
+                _free_after_out_of_memory(input_tensor)
+                input_tensor = None
+                return Split()
+            else:
+                # Re-raise the exception if not an OOM error
+                raise
+
+    return upscale
+
+
+def _as_result_dtype(img: np.ndarray, result_dtype: np.dtype | type | None) -> np.ndarray:
+    """Converts an image that wasn't collected row by row like `RowCollector(result_dtype)` would."""
+    if result_dtype is None:
+        return img
+    collector = RowCollector(result_dtype)
+    collector.write_image(img)
+    return collector.get_result()
+
+
+def _check_progress(progress: Progress | None) -> None:
+    """Raises `Aborted` if the work was aborted, blocks while it is paused."""
+    if progress is None:
+        return
+    progress.check_aborted()
+    if progress.paused:
+        # clear resources before pausing
+        gc.collect()
+        safe_cuda_cache_empty()
+        progress.suspend()
+
+
+def _device_blend_upscale(
+    img: np.ndarray,
+    model: ImageModelDescriptor[torch.nn.Module],
+    device: torch.device,
+    dtype: torch.dtype,
+    tiler: Tiler,
+    tile_batch_size: int,
+    pool: PinnedBufferPool | None,
+    flat: _FlatTiles,
+    progress: Progress | None = None,
+) -> np.ndarray | None:
+    """
+    Upscales the image with `device_auto_split`, None if the output canvas doesn't fit on the device.
+    """
+
+    def upscale_batch(batch: torch.Tensor) -> torch.Tensor | Split:
+        _check_progress(progress)
+        try:
+            is_flat, colors = flat.fill_batch(batch)
+            if colors is None:
+                flat.stats.tiles += len(is_flat)
+                return model(as_cpu_input(batch))
+
+            n, c, h, w = batch.shape
+            output = torch.empty((n, c, h * flat.scale, w * flat.scale), device=batch.device, dtype=batch.dtype)
+            rest = [i for i, f in enumerate(is_flat) if not f]
+            if len(rest) > 0:
+                output[rest] = model(as_cpu_input(batch[rest]))
+                flat.stats.tiles += len(rest)
+            for i, f in enumerate(is_flat):
+                if f:
+                    output[i].copy_(colors[i].reshape((c, 1, 1)).expand((c, h * flat.scale, w * flat.scale)))
+            return output
+        except RuntimeError as e:
+            if _is_out_of_memory(e):
+                _free_after_out_of_memory(None)
+                return Split()
+            else:
+                # Re-raise the exception if not an OOM error
+                raise
+
+    input_tensor = None
+    try:
+        input_tensor = _rgb_to_bgr(_upload(img, device, dtype, pool))
+        if input_tensor.dim() == 2:
+            input_tensor = input_tensor.unsqueeze(2)
+        output_tensor = _rgb_to_bgr(
+            device_auto_split(input_tensor, upscale_batch, tiler, batch_size=tile_batch_size)
+        )
+        if img.dtype == np.uint8:
+            output_tensor = _quantize(output_tensor)
+        result = _download(output_tensor, pool)
+        return result.copy() if pool is not None and pool.owns(result) else result
+    except RuntimeError as e:
+        if _is_out_of_memory(e):
+            logger.warning("The output canvas doesn't fit on the device, blending tiles on the host.")
+            _free_after_out_of_memory(input_tensor)
+            return None
+        raise
+
+
 @torch.inference_mode()
 def pytorch_auto_split(
     img: np.ndarray,
@@ -75,26 +329,68 @@ def pytorch_auto_split(
     device: torch.device,
     use_fp16: bool,
     tiler: Tiler,
-    # progress: Progress,
-) -> np.ndarray:
-    dtype = torch.float16 if use_fp16 else torch.float32
+    dtype: torch.dtype | None = None,
+    tile_batch_size: int = 1,
+    row_sink: RowSink | None = None,
+    device_blend: bool = False,
+    flat_tolerance: float | None = None,
+    flat_stats: FlatTileStats | None = None,
+    progress: Progress | None = None,
+    result_dtype: np.dtype | type | None = None,
+) -> np.ndarray | None:
+    """
+    Upscales the given image with the given model, splitting it into tiles if necessary.
+
+    The model runs in FP16 if `use_fp16` is set and in FP32 otherwise, unless `dtype` is given explicitly.
+
+    If the image is uint8, it is normalized and the result quantized on the device, so only uint8
+    data is transferred and the result is a uint8 image as well.
+
+    If `tile_batch_size` is larger than 1, tiles of the same size are sent through the model in
+    batches of up to that many tiles, see `auto_split`.
+
+    If `row_sink` is given, the rows of the result are handed to it as soon as they are blended
+    and None is returned.
+
+    If `result_dtype` is given, the result is stored as that dtype, see `RowCollector`. Callers that save
+    8 bit pages anyway pass `np.uint8`, so that float results are quantized row by row while they are
+    collected instead of being held as float32.
+
+    If `device_blend` is set, tiles are blended into an output canvas on the device instead of on
+    the host, and only the finished image is downloaded, see `device_auto_split`. If the canvas
+    doesn't fit on the device, tiles are blended on the host.
+
+    If `flat_tolerance` is given, tiles (or the whole image) that are flat within that tolerance, e.g. blank
+    margins, are filled at the output scale instead of being upscaled, see `flat_color`. How many tiles were
+    upscaled and skipped is added to `flat_stats`.
+
+    If `progress` is given, it is checked before every tile (or batch of tiles): `Aborted` is raised once it
+    is aborted, and the upscale waits (with the device cache emptied) while it is paused.
+    """
+    dtype = _get_dtype(use_fp16, dtype)
     if model.dtype != dtype or model.device != device:
         model = model.to(device, dtype)
+    pool = _get_staging_pool(device)
+    flat = _FlatTiles(model, flat_tolerance, flat_stats)
+
+    if device_blend and row_sink is None and tiler.allow_smaller_tile_size():
+        result = _device_blend_upscale(img, model, device, dtype, tiler, tile_batch_size, pool, flat, progress)
+        if result is not None:
+            return _as_result_dtype(result, result_dtype)
 
     def upscale(img: np.ndarray, _: object):
-        # progress.check_aborted()
-        # if progress.paused:
-        #     # clear resources before pausing
-        #     gc.collect()
-        #     safe_cuda_cache_empty()
-        #     progress.suspend()
+        _check_progress(progress)
+
+        filled = flat.fill(img)
+        if filled is not None:
+            return filled
 
         input_tensor = None
         try:
             # convert to tensor
-            input_tensor = _into_tensor(img, device, dtype)
+            input_tensor = _upload(img, device, dtype, pool)
             input_tensor = _rgb_to_bgr(input_tensor)
-            input_tensor = _into_batched_form(input_tensor)
+            input_tensor = as_cpu_input(_into_batched_form(input_tensor))
 
             # inference
             output_tensor = model(input_tensor)
@@ -102,24 +398,129 @@ def pytorch_auto_split(
             # convert back to numpy
             output_tensor = _into_standard_image_form(output_tensor)
             output_tensor = _rgb_to_bgr(output_tensor)
-            result = output_tensor.detach().cpu().detach().float().numpy()
+            if img.dtype == np.uint8:
+                output_tensor = _quantize(output_tensor)
+            result = _download(output_tensor, pool)
+            flat.stats.tiles += 1
 
             return result
         except RuntimeError as e:
-            # Check to see if its actually the CUDA out of memory error
-            if "allocate" in str(e) or "CUDA" in str(e):
-                # Collect garbage (clear VRAM)
-                if input_tensor is not None:
-                    try:
-                        input_tensor.detach().cpu()
-                    except Exception:
-                        pass
-                    del input_tensor
-                gc.collect()
-                safe_cuda_cache_empty()
+            if _is_out_of_memory(e):
+                _free_after_out_of_memory(input_tensor)
+                input_tensor = None
                 return Split()
             else:
                 # Re-raise the exception if not an OOM error
                 raise
 
-    return auto_split(img, upscale, tiler)
+    upscale_batch = None
+    if tile_batch_size > 1:
+        batch_upscale = _batch_upscaler(model, device, dtype, pool)
+
+        def upscale_batch(tiles: list[np.ndarray], _: object):
+            _check_progress(progress)
+            results: list[np.ndarray | None] = [flat.fill(tile) for tile in tiles]
+            rest = [i for i, result in enumerate(results) if result is None]
+            if len(rest) > 0:
+                upscaled = batch_upscale([tiles[i] for i in rest])
+                if isinstance(upscaled, Split):
+                    return upscaled
+                flat.stats.tiles += len(rest)
+                for i, result in zip(rest, upscaled):
+                    results[i] = result
+            return results
+
+    result = auto_split(
+        img, upscale, tiler, upscale_batch=upscale_batch, batch_size=tile_batch_size, row_sink=row_sink,
+        result_dtype=result_dtype,
+    )
+    if result is None:
+        return None
+    if pool is not None and pool.owns(result):
+        # the image was upscaled in one go, so the result still lives in a staging buffer
+        result = result.copy()
+    return result
+
+
+@torch.inference_mode()
+def pytorch_batch_upscale(
+    imgs: Sequence[np.ndarray],
+    model: ImageModelDescriptor[torch.nn.Module],
+    device: torch.device,
+    use_fp16: bool,
+    tiler: Tiler,
+    batch_size: int,
+    dtype: torch.dtype | None = None,
+    tile_batch_size: int = 1,
+    device_blend: bool = False,
+    flat_tolerance: float | None = None,
+    flat_stats: Sequence[FlatTileStats] | None = None,
+    progress: Progress | None = None,
+    result_dtype: np.dtype | type | None = None,
+) -> tuple[list[np.ndarray], int]:
+    """
+    Upscales images of identical shape by sending them through the model as NCHW batches.
+
+    If the device runs out of memory, the batch size is halved. If even a single image doesn't fit,
+    that image is upscaled with `pytorch_auto_split` and the given tiler, exactly like a single page would be.
+
+    Flat images (and flat tiles of split images) are skipped like `pytorch_auto_split` does, `flat_stats`
+    has one entry per image. `progress` is checked before every batch, and the results are stored as
+    `result_dtype`, see `pytorch_auto_split`.
+
+    Returns the upscaled images (in the given order) and the last batch size that fit on the device.
+    """
+    assert batch_size > 0
+    dtype = _get_dtype(use_fp16, dtype)
+    if model.dtype != dtype or model.device != device:
+        model = model.to(device, dtype)
+    pool = _get_staging_pool(device)
+
+    if len(imgs) > 0:
+        shape = imgs[0].shape
+        assert all(img.shape == shape for img in imgs), "All images of a batch must have the same shape"
+
+    if flat_stats is None:
+        flat_stats = [FlatTileStats() for _ in imgs]
+    assert len(flat_stats) == len(imgs)
+
+    # blank pages never reach the model
+    results: list[np.ndarray | None] = [
+        _FlatTiles(model, flat_tolerance, stats).fill(img) for img, stats in zip(imgs, flat_stats)
+    ]
+    rest = [i for i, result in enumerate(results) if result is None]
+    results = [result if result is None else _as_result_dtype(result, result_dtype) for result in results]
+
+    upscale = _batch_upscaler(model, device, dtype, pool)
+
+    start = 0
+    while start < len(rest):
+        indexes = rest[start : start + batch_size]
+        batch = [imgs[i] for i in indexes]
+        _check_progress(progress)
+        batch_result = upscale(batch)
+
+        if isinstance(batch_result, Split):
+            if batch_size > 1:
+                batch_size = batch_size // 2
+                logger.debug(f"Batch did not fit. Reduced batch size to {batch_size}.")
+                continue
+
+            # a single image is too large, so it has to be split into tiles
+            batch_result = [
+                pytorch_auto_split(
+                    batch[0], model, device, use_fp16, tiler, dtype=dtype, tile_batch_size=tile_batch_size,
+                    device_blend=device_blend, flat_tolerance=flat_tolerance, flat_stats=flat_stats[indexes[0]],
+                    progress=progress, result_dtype=result_dtype,
+                )
+            ]
+        else:
+            for i in indexes:
+                flat_stats[i].tiles += 1
+            batch_result = [_as_result_dtype(result, result_dtype) for result in batch_result]
+
+        for i, result in zip(indexes, batch_result):
+            results[i] = result
+        start += len(batch)
+
+    return results, batch_size  # type: ignore
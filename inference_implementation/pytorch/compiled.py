@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import copy
+import threading
+from collections import Counter
+
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+from ..tools.settings import CompileMode
+
+ShapeKey = tuple[tuple[int, ...], torch.dtype, torch.device]
+
+
+def _raise_recompile_limit(limit: int) -> None:
+    # every tile shape is its own graph, so dynamo must not give up on the model after a few shapes
+    config = torch._dynamo.config
+    name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit"
+    setattr(config, name, max(getattr(config, name), limit))
+
+
+def _is_out_of_memory(e: BaseException) -> bool:
+    return isinstance(e, RuntimeError) and ("allocate" in str(e) or "CUDA" in str(e))
+
+
+class CompiledModel:
+    """
+    Runs a model through `torch.compile`, with one specialized graph per input (tile) shape.
+
+    A shape is only compiled once it was seen `min_hits` times, and at most `max_graphs` shapes are
+    compiled. All other (odd) shapes run eagerly, as does every shape that fails to compile.
+    `backend` is passed on to `torch.compile`, e.g. "eager" to debug graph capture only.
+    With `CompileMode.CUDA_GRAPHS`, the compiled graphs on CUDA devices are replayed as CUDA graphs.
+
+    Everything but calling the model is forwarded to the eager model descriptor.
+    """
+
+    def __init__(
+        self,
+        model: ImageModelDescriptor,
+        mode: CompileMode = CompileMode.COMPILE,
+        min_hits: int = 2,
+        max_graphs: int = 8,
+        backend: str = "inductor",
+    ) -> None:
+        assert mode != CompileMode.OFF
+        assert min_hits > 0
+        assert max_graphs > 0
+        self.eager: ImageModelDescriptor = model
+        self.mode: CompileMode = mode
+        self.min_hits: int = min_hits
+        self.max_graphs: int = max_graphs
+        self.cuda_graphs: bool = mode == CompileMode.CUDA_GRAPHS and model.device.type == "cuda"
+
+        _raise_recompile_limit(max_graphs)
+        module = torch.compile(
+            model.model,
+            backend=backend,
+            dynamic=False,
+            mode="reduce-overhead" if self.cuda_graphs else None,
+        )
+        # the same descriptor (padding, clamping, ...), but calling the compiled module
+        self._compiled = copy.copy(model)
+        self._compiled._model = module  # type: ignore
+
+        self._hits: Counter[ShapeKey] = Counter()
+        self._compiled_shapes: set[ShapeKey] = set()
+        self._failed_shapes: set[ShapeKey] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def compiled_shapes(self) -> set[ShapeKey]:
+        return set(self._compiled_shapes)
+
+    def _use_compiled(self, key: ShapeKey) -> bool:
+        with self._lock:
+            if key in self._compiled_shapes:
+                return True
+            if key in self._failed_shapes or len(self._compiled_shapes) >= self.max_graphs:
+                return False
+            self._hits[key] += 1
+            if self._hits[key] < self.min_hits:
+                return False
+            self._compiled_shapes.add(key)
+            return True
+
+    def __call__(self, image: torch.Tensor) -> torch.Tensor:
+        key: ShapeKey = (tuple(image.shape), image.dtype, image.device)
+        if not self._use_compiled(key):
+            return self.eager(image)
+
+        try:
+            if self.cuda_graphs:
+                torch.compiler.cudagraph_mark_step_begin()
+                # the output lives in memory owned by the CUDA graph, which the next replay overwrites
+                return self._compiled(image).clone()
+            return self._compiled(image)
+        except Exception as e:
+            if _is_out_of_memory(e):
+                raise
+            logger.warning(f"Unable to compile {self.eager.architecture.name} for {key[0]}, running it eagerly: {e}")
+            with self._lock:
+                self._compiled_shapes.discard(key)
+                self._failed_shapes.add(key)
+            return self.eager(image)
+
+    def __getattr__(self, name: str):
+        if name == "eager":
+            # not initialized (yet), e.g. while copying
+            raise AttributeError(name)
+        return getattr(self.eager, name)
+
+
+__all__ = ["CompiledModel"]
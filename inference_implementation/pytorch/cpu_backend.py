@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+
+@dataclass(frozen=True)
+class CpuBackendSettings:
+    # intra-op threads per worker process, 0 uses every core the worker may run on
+    intra_op_threads: int = 0
+    # inter-op threads per worker process, models run one op after another, so 1 is usually best
+    inter_op_threads: int = 1
+    # run convolutions in NHWC, which oneDNN handles a lot faster than NCHW
+    channels_last: bool = True
+    # oneDNN (mkldnn) kernels, also used for BF16 inference on CPUs that support it
+    onednn: bool = True
+    # pin every worker process to its own range of cores, 0 disables pinning
+    cores_per_worker: int = 0
+
+
+# the settings this process was configured with, None if the CPU backend is not used
+_active: CpuBackendSettings | None = None
+
+
+def get_cpu_backend() -> CpuBackendSettings | None:
+    return _active
+
+
+def cpu_supports_native_bf16() -> bool:
+    """Whether the CPU has BF16 instructions (AVX512-BF16 or AMX), otherwise BF16 is emulated and slow."""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = set(line.split(":", 1)[1].split())
+                    return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        pass
+    return False
+
+
+def _worker_cores(cores_per_worker: int, worker_index: int) -> list[int]:
+    available = sorted(os.sched_getaffinity(0))
+    if cores_per_worker >= len(available):
+        return available
+    # wrap around if there are more workers than core ranges
+    ranges = len(available) // cores_per_worker
+    start = (worker_index % ranges) * cores_per_worker
+    return available[start : start + cores_per_worker]
+
+
+def configure_cpu_backend(settings: CpuBackendSettings, worker_index: int = 0) -> None:
+    """
+    Tunes PyTorch for CPU inference in this process: core pinning, thread pools and oneDNN.
+
+    Has to run before the first inference, ideally when the worker process starts.
+    `worker_index` selects the range of cores of this worker if pinning is enabled.
+    """
+    global _active
+
+    if settings.cores_per_worker > 0 and hasattr(os, "sched_setaffinity"):
+        cores = _worker_cores(settings.cores_per_worker, worker_index)
+        os.sched_setaffinity(0, cores)
+        logger.info(f"Pinned worker {worker_index} to cores {cores}.")
+
+    threads = settings.intra_op_threads
+    if threads <= 0:
+        threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(settings.inter_op_threads)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work started
+        logger.debug("Inter-op threads were already set, keeping them.")
+
+    torch.backends.mkldnn.enabled = settings.onednn
+    _active = settings
+
+    logger.info(
+        f"CPU backend: {torch.get_num_threads()} intra-op threads, {torch.get_num_interop_threads()} inter-op threads,"
+        f" channels_last={settings.channels_last}, oneDNN={settings.onednn},"
+        f" native BF16={cpu_supports_native_bf16()}."
+    )
+
+
+def prepare_cpu_model(model: ImageModelDescriptor) -> None:
+    """Converts a model that runs on the CPU to the memory format of the configured backend."""
+    if _active is not None and _active.channels_last and model.device.type == "cpu":
+        model.model.to(memory_format=torch.channels_last)  # type: ignore
+
+
+def as_cpu_input(t: torch.Tensor) -> torch.Tensor:
+    """Converts a batched (N, C, H, W) CPU tensor to the memory format of the configured backend."""
+    if _active is not None and _active.channels_last and t.device.type == "cpu" and t.dim() == 4:
+        return t.contiguous(memory_format=torch.channels_last)
+    return t
+
+
+__all__ = [
+    "CpuBackendSettings",
+    "get_cpu_backend",
+    "cpu_supports_native_bf16",
+    "configure_cpu_backend",
+    "prepare_cpu_model",
+    "as_cpu_input",
+]
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Callable, Union
+
+import torch
+from sanic.log import logger
+
+from ..tools.utils import Size
+from ..upscale.auto_split import Split
+from ..upscale.tile_blending import BlendDirection, TileOverlap, get_blend_curve, half_sin_blend_fn
+from ..upscale.tile_plan import PlannedTile, TilePlan, max_tile_plan
+from ..upscale.tiler import Tiler
+
+# runs a (N, C, H, W) batch of tiles through the model, Split if it doesn't fit on the device
+DeviceBatchOp = Callable[[torch.Tensor], Union[torch.Tensor, Split]]
+
+
+@lru_cache(maxsize=64)
+def _blend_weights(
+    blend_fn: Callable, blend_size: int, direction: BlendDirection, device: torch.device, dtype: torch.dtype
+) -> torch.Tensor:
+    # the same curve as the host blender, broadcast along the seam
+    curve = torch.from_numpy(get_blend_curve(blend_fn, blend_size).copy()).to(device, dtype)
+    if direction == BlendDirection.X:
+        return curve.reshape((1, blend_size, 1))
+    return curve.reshape((blend_size, 1, 1))
+
+
+class DeviceTileBlender:
+    """
+    A `TileBlender` for (H, W, C) tensors, the tiles are blended where they are, e.g. on the GPU.
+
+    Tiles are blended exactly like the host blender does, with the same overlaps and blend curve.
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        channels: int,
+        direction: BlendDirection,
+        device: torch.device,
+        dtype: torch.dtype,
+        blend_fn: Callable = half_sin_blend_fn,
+    ) -> None:
+        self.direction: BlendDirection = direction
+        self.blend_fn: Callable = blend_fn
+        self.offset: int = 0
+        self.last_end_overlap: int = 0
+        self.result: torch.Tensor = torch.empty((height, width, channels), device=device, dtype=dtype)
+
+    @property
+    def width(self) -> int:
+        return self.result.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.result.shape[0]
+
+    @property
+    def _axis(self) -> int:
+        return 1 if self.direction == BlendDirection.X else 0
+
+    def add_tile(self, tile: torch.Tensor, overlap: TileOverlap) -> None:
+        axis = self._axis
+        length = tile.shape[axis]
+        assert tile.shape[2] == self.result.shape[2]
+        assert tile.shape[1 - axis] == self.result.shape[1 - axis]
+        assert length > overlap.total
+        o = overlap
+
+        if self.offset == 0:
+            # the first tile is copied in as is
+            assert o.start == 0
+            self.result.narrow(axis, 0, length).copy_(tile)
+        else:
+            assert self.offset < self.result.shape[axis], "All tiles were filled in already"
+
+            if self.last_end_overlap < o.start:
+                # we can't use all the overlap of the current tile, so we have to cut it off
+                diff = o.start - self.last_end_overlap
+                tile = tile.narrow(axis, diff, length - diff)
+                length -= diff
+                o = TileOverlap(self.last_end_overlap, o.end)
+
+            # copy over the part that doesn't need blending (yet)
+            blend_size = o.start * 2
+            self.result.narrow(axis, self.offset + o.start, length - blend_size).copy_(
+                tile.narrow(axis, blend_size, length - blend_size)
+            )
+
+            # blend the overlapping part in place, a + (b - a) * blend
+            if blend_size > 0:
+                left = self.result.narrow(axis, self.offset - o.start, blend_size)
+                right = tile.narrow(axis, 0, blend_size)
+                blend = _blend_weights(self.blend_fn, blend_size, self.direction, left.device, left.dtype)
+                left.add_((right - left).mul_(blend))
+
+        self.offset += length - o.total
+        self.last_end_overlap = o.end
+
+    def get_result(self) -> torch.Tensor:
+        assert self.offset == self.result.shape[self._axis]
+        return self.result
+
+
+def _read_tile(img: torch.Tensor, tile: PlannedTile) -> torch.Tensor:
+    r = tile.padded
+    return img[r.y : r.y + r.height, r.x : r.x + r.width, :]
+
+
+def _upscale_row(
+    img: torch.Tensor, row: tuple[PlannedTile, ...], upscale_batch: DeviceBatchOp, batch_size: int
+) -> tuple[list[torch.Tensor] | Split, int]:
+    """
+    Upscales the tiles of a row, batching tiles of the same size.
+
+    Returns the (H, W, C) results in row order, or Split if a single tile doesn't fit, and the last batch size that fit.
+    """
+    groups: dict[Size, list[int]] = {}
+    for index, tile in enumerate(row):
+        groups.setdefault(tile.padded.size, []).append(index)
+
+    results: list[torch.Tensor | None] = [None] * len(row)
+    for indexes in groups.values():
+        start = 0
+        while start < len(indexes):
+            chunk = indexes[start : start + batch_size]
+            batch = torch.stack([_read_tile(img, row[i]).permute(2, 0, 1) for i in chunk])
+            output = upscale_batch(batch)
+            del batch
+            if isinstance(output, Split):
+                if len(chunk) == 1:
+                    return Split(), batch_size
+                batch_size = max(1, batch_size // 2)
+                logger.debug(f"Tile batch did not fit. Reduced batch size to {batch_size}.")
+                continue
+
+            for index, t in zip(chunk, output):
+                results[index] = t.permute(1, 2, 0)
+            start += len(chunk)
+
+    return results, batch_size  # type: ignore
+
+
+def _assemble(
+    img: torch.Tensor, plan: TilePlan, upscale_batch: DeviceBatchOp, batch_size: int
+) -> tuple[torch.Tensor | Split, int]:
+    h, w, _ = img.shape
+    canvas: DeviceTileBlender | None = None
+    scale = 0
+
+    for y, row in enumerate(plan.rows):
+        row_results, batch_size = _upscale_row(img, row, upscale_batch, batch_size)
+        if isinstance(row_results, Split):
+            return Split(), batch_size
+
+        if canvas is None:
+            up_h, _, up_c = row_results[0].shape
+            scale = up_h // row[0].padded.height
+            assert scale > 0
+            canvas = DeviceTileBlender(
+                w * scale, h * scale, up_c, BlendDirection.Y, img.device, row_results[0].dtype
+            )
+
+        row_blender = DeviceTileBlender(
+            w * scale, row[0].padded.height * scale, canvas.result.shape[2], BlendDirection.X,
+            img.device, canvas.result.dtype,
+        )
+        for tile, tile_result in zip(row, row_results):
+            assert tile_result.shape[0] == tile.padded.height * scale
+            assert tile_result.shape[1] == tile.padded.width * scale
+            row_blender.add_tile(tile_result, tile.overlap_x(scale))
+        del row_results
+        canvas.add_tile(row_blender.get_result(), plan.row_overlap(y, scale))
+
+    assert canvas is not None
+    return canvas.get_result(), batch_size
+
+
+def device_auto_split(
+    img: torch.Tensor,
+    upscale_batch: DeviceBatchOp,
+    tiler: Tiler,
+    overlap: int = 16,
+    batch_size: int = 1,
+) -> torch.Tensor:
+    """
+    Like `auto_split` for tilers that allow smaller tile sizes, but the image is a (H, W, C) tensor and tiles
+    never leave its device: they are read from the image, upscaled and blended into an output canvas on the device.
+
+    Tiles of a row that have the same size are upscaled together, up to `batch_size` at a time. If a batch
+    requests a split, the batch size is halved. If a single tile requests a split, the tile size is lowered
+    and the canvas is started over.
+    """
+    assert tiler.allow_smaller_tile_size()
+    h, w, c = img.shape
+    max_tile_size = tiler.starting_tile_size(w, h, c)
+
+    for _ in range(20):
+        plan = max_tile_plan(w, h, max_tile_size, overlap)
+        if len(plan.tiles) == 1:
+            # no need for a canvas
+            output = upscale_batch(img.permute(2, 0, 1).unsqueeze(0))
+            if not isinstance(output, Split):
+                return output[0].permute(1, 2, 0)
+        else:
+            count_x, count_y = plan.tile_count
+            logger.debug(f"Device split image ({w}x{h}px @ {c}) into {count_x}x{count_y} tiles.")
+            result, batch_size = _assemble(img, plan, upscale_batch, batch_size)
+            if not isinstance(result, Split):
+                return result
+
+        max_tile_size = tiler.split(max_tile_size)
+        logger.debug(f"Split occurred. New tile size is {max_tile_size}.")
+
+    raise ValueError("Aborting after 20 splits. Unable to upscale image.")
+
+
+__all__ = ["DeviceTileBlender", "device_auto_split"]
@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import weakref
+from dataclasses import asdict, dataclass, field
+
+import numpy as np
+import psutil
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+from .utils import safe_cuda_cache_empty
+
+_VERSION = 1
+
+# input tile sizes the model is run at during calibration
+CUDA_CALIBRATION_SIZES = (128, 192, 256, 384)
+CPU_CALIBRATION_SIZES = (64, 96, 128, 160)
+
+# profiles of models that are resident, so that callers without the model file can use them
+_PROFILES: weakref.WeakKeyDictionary[ImageModelDescriptor, MemoryProfile] = weakref.WeakKeyDictionary()
+
+
+@dataclass(frozen=True)
+class MemoryProfile:
+    """
+    How much memory a model needs on a device, as a function of the number of input pixels.
+
+    The peak memory of running one tile is modeled as `base_bytes + bytes_per_pixel * pixels`,
+    fitted to measurements of the model at a few tile sizes.
+    """
+
+    model_hash: str
+    device: str
+    dtype: str
+    base_bytes: float
+    bytes_per_pixel: float
+    # (input pixels, peak bytes) of every calibration run
+    samples: list[tuple[int, int]] = field(default_factory=list)
+
+    @staticmethod
+    def fit(model_hash: str, device: str, dtype: str, samples: list[tuple[int, int]]) -> MemoryProfile:
+        assert len(samples) >= 2, "At least two samples are required to fit a memory profile"
+        pixels = np.array([p for p, _ in samples], dtype=np.float64)
+        peaks = np.array([b for _, b in samples], dtype=np.float64)
+        bytes_per_pixel, base_bytes = np.polyfit(pixels, peaks, 1)
+        return MemoryProfile(
+            model_hash,
+            device,
+            dtype,
+            max(0.0, float(base_bytes)),
+            max(0.0, float(bytes_per_pixel)),
+            [(int(p), int(b)) for p, b in samples],
+        )
+
+    def estimate(self, pixels: int) -> float:
+        """The estimated peak memory of running a tile with the given number of input pixels."""
+        return self.base_bytes + self.bytes_per_pixel * pixels
+
+    def tile_size_for(self, budget: int) -> int:
+        """
+        The largest square tile size (a multiple of 16) whose estimated peak memory fits into the budget.
+        """
+        if self.bytes_per_pixel <= 0:
+            return 2**31
+        pixels = (budget - self.base_bytes) / self.bytes_per_pixel
+        if pixels <= 0:
+            return 16
+        return max(16, int(math.sqrt(pixels)) // 16 * 16)
+
+    def to_json(self) -> dict:
+        return {"version": _VERSION, **asdict(self)}
+
+    @staticmethod
+    def from_json(data: dict) -> MemoryProfile | None:
+        if data.get("version") != _VERSION:
+            return None
+        return MemoryProfile(
+            data["model_hash"],
+            data["device"],
+            data["dtype"],
+            float(data["base_bytes"]),
+            float(data["bytes_per_pixel"]),
+            [(int(p), int(b)) for p, b in data.get("samples", [])],
+        )
+
+
+def _device_name(device: torch.device) -> str:
+    if device.type == "cuda":
+        try:
+            return torch.cuda.get_device_name(device)
+        except Exception:
+            pass
+    return device.type
+
+
+class _RssSampler:
+    """Samples the resident set size of this process in the background and keeps the peak."""
+
+    def __init__(self, interval: float = 0.001) -> None:
+        self.interval = interval
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self.baseline = 0
+        self.peak = 0
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self) -> _RssSampler:
+        self.baseline = self._process.memory_info().rss
+        self.peak = self.baseline
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+
+@torch.inference_mode()
+def measure_peak_memory(
+    model: ImageModelDescriptor,
+    device: torch.device,
+    dtype: torch.dtype,
+    size: int,
+) -> int:
+    """
+    Runs the model once on a `size`x`size` tile and returns the additional memory it needed.
+
+    CUDA devices report the peak allocation of the caching allocator. On the CPU, the resident
+    set size of the process is sampled instead, which is noisier but good enough for testing.
+    """
+    x = torch.rand((1, model.input_channels, size, size), device=device, dtype=dtype)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+        out = model(x)
+        torch.cuda.synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device) - baseline
+        del out, x
+        return int(peak)
+
+    with _RssSampler() as sampler:
+        out = model(x)
+    del out, x
+    return int(sampler.peak - sampler.baseline)
+
+
+def calibrate(
+    model: ImageModelDescriptor,
+    device: torch.device,
+    dtype: torch.dtype,
+    model_hash: str,
+    sizes: tuple[int, ...] | None = None,
+) -> MemoryProfile:
+    """
+    Fits a memory profile of the model by running it at a few tile sizes on the given device.
+
+    Tile sizes that don't fit anymore are skipped, at least two have to succeed.
+    """
+    if sizes is None:
+        sizes = CUDA_CALIBRATION_SIZES if device.type == "cuda" else CPU_CALIBRATION_SIZES
+    if model.dtype != dtype or model.device != device:
+        model = model.to(device, dtype)
+
+    # warm-up run, so that one-time allocations (cuDNN workspaces etc.) are not attributed to a size
+    measure_peak_memory(model, device, dtype, sizes[0])
+
+    samples: list[tuple[int, int]] = []
+    for size in sizes:
+        try:
+            samples.append((size * size, measure_peak_memory(model, device, dtype, size)))
+        except RuntimeError as e:
+            if "allocate" in str(e) or "CUDA" in str(e):
+                logger.debug(f"Calibration stopped at tile size {size}: out of memory.")
+                break
+            raise
+        finally:
+            safe_cuda_cache_empty()
+
+    if len(samples) < 2:
+        raise ValueError(f"Unable to calibrate memory usage of {model.architecture.name} on {device}.")
+
+    profile = MemoryProfile.fit(model_hash, _device_name(device), str(dtype), samples)
+    logger.info(
+        f"Calibrated {model.architecture.name} on {device} ({dtype}):"
+        f" {profile.bytes_per_pixel:.0f} bytes per pixel, {profile.base_bytes / 1024**2:.0f} MB base."
+    )
+    return profile
+
+
+def profile_path(model_file: str | os.PathLike, device: torch.device, dtype: torch.dtype) -> str:
+    """Where the memory profile of the given model is stored, next to the model file."""
+    dtype_name = str(dtype).replace("torch.", "")
+    return f"{os.path.abspath(model_file)}.memory-{device.type}-{dtype_name}.json"
+
+
+def load_memory_profile(path: str, model_hash: str, device: torch.device, dtype: torch.dtype) -> MemoryProfile | None:
+    try:
+        with open(path, "r") as f:
+            profile = MemoryProfile.from_json(json.load(f))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable memory profile {path}: {e}")
+        return None
+
+    # a profile of another version of the model, or of another GPU, has to be measured again
+    if profile is None or profile.model_hash != model_hash:
+        return None
+    if profile.device != _device_name(device) or profile.dtype != str(dtype):
+        return None
+    return profile
+
+
+def save_memory_profile(path: str, profile: MemoryProfile) -> None:
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(profile.to_json(), f, indent=2)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def get_memory_profile(
+    model_file: str | os.PathLike,
+    model: ImageModelDescriptor,
+    device: torch.device,
+    dtype: torch.dtype,
+    model_hash: str,
+) -> MemoryProfile:
+    """
+    Returns the stored memory profile of the model, calibrating (and storing) it if necessary.
+    """
+    path = profile_path(model_file, device, dtype)
+    profile = load_memory_profile(path, model_hash, device, dtype)
+    if profile is None:
+        profile = calibrate(model, device, dtype, model_hash)
+        try:
+            save_memory_profile(path, profile)
+        except OSError as e:
+            # e.g. the model directory is read-only, the profile is still used for this worker
+            logger.warning(f"Unable to store memory profile {path}: {e}")
+
+    _PROFILES[model] = profile
+    return profile
+
+
+def get_resident_profile(model: ImageModelDescriptor) -> MemoryProfile | None:
+    """The memory profile of the given model, if it was calibrated or loaded by this process."""
+    return _PROFILES.get(model)
+
+
+def get_memory_budget(device: torch.device, budget_limit: int = 0) -> int:
+    """
+    The memory (in bytes) a single tile may use on the given device.
+
+    `budget_limit` caps the budget in GB, 0 means no limit.
+    """
+    if device.type == "cuda":
+        free, total = torch.cuda.mem_get_info(device)  # type: ignore
+        # memory cached by PyTorch is free for our purposes
+        free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        # only use 75% of the total memory
+        budget = min(free, int(total * 0.75))
+    else:
+        budget = psutil.virtual_memory().available
+    if budget_limit > 0:
+        budget = min(budget_limit * 1024**3, budget)
+    # 80% of the value to be more conservative
+    return int(budget * 0.8)
+
+
+__all__ = [
+    "MemoryProfile",
+    "measure_peak_memory",
+    "calibrate",
+    "profile_path",
+    "load_memory_profile",
+    "save_memory_profile",
+    "get_memory_profile",
+    "get_resident_profile",
+    "get_memory_budget",
+]
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor, ModelLoader
+
+from .cpu_backend import prepare_cpu_model
+from .utils import safe_cuda_cache_empty
+
+
+@dataclass(frozen=True)
+class ModelKey:
+    path: str
+    mtime_ns: int
+    device: str
+    dtype: str
+
+    @property
+    def slot(self) -> tuple[str, str, str]:
+        """The key without the modification time, i.e. where the model lives."""
+        return self.path, self.device, self.dtype
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of models that are loaded and ready for inference.
+
+    Models are keyed by their path, the modification time of the file, the device and the dtype.
+    Replacing a model file on disk therefore invalidates the resident copy on the next lookup.
+    At most `max_resident` models are kept per device, the least recently used one is evicted first.
+    Every device of a `DevicePool` thereby keeps its own warm replica of a model.
+    """
+
+    def __init__(self, max_resident: int = 2) -> None:
+        assert max_resident > 0
+        self.max_resident: int = max_resident
+        self._models: OrderedDict[ModelKey, ImageModelDescriptor] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(
+        model_file: str | os.PathLike, device: torch.device, dtype: torch.dtype
+    ) -> ModelKey:
+        path = os.path.abspath(model_file)
+        return ModelKey(path, os.stat(path).st_mtime_ns, str(device), str(dtype))
+
+    def get(
+        self,
+        model_file: str | os.PathLike,
+        device: torch.device,
+        dtype: torch.dtype = torch.float32,
+    ) -> ImageModelDescriptor:
+        """
+        Returns the resident model for the given file, loading it if necessary.
+        """
+        key = self.key_for(model_file, device, dtype)
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model
+
+            # the file changed on disk, so older copies are stale
+            for stale in [k for k in self._models if k.slot == key.slot]:
+                logger.info(f"Model {stale.path} changed on disk, dropping old copy.")
+                del self._models[stale]
+
+            model = self._load(key, device, dtype)
+            self._models[key] = model
+
+            on_device = [k for k in self._models if k.device == key.device]
+            for evicted in on_device[: max(0, len(on_device) - self.max_resident)]:
+                del self._models[evicted]
+                logger.info(f"Evicted model {evicted.path} from {evicted.device}.")
+                safe_cuda_cache_empty()
+
+            return model
+
+    def warm(
+        self,
+        model_file: str | os.PathLike,
+        device: torch.device,
+        dtype: torch.dtype = torch.float32,
+    ) -> ImageModelDescriptor:
+        """
+        Loads the given model ahead of time, e.g. when a worker boots.
+        """
+        model = self.get(model_file, device, dtype)
+        logger.info(f"Model {model_file} is warm on {device} ({dtype}).")
+        return model
+
+    def discard(
+        self,
+        model_file: str | os.PathLike,
+        device: torch.device,
+        dtype: torch.dtype = torch.float32,
+    ) -> None:
+        """
+        Drops the resident copy of the given model, if any.
+        """
+        slot = (os.path.abspath(model_file), str(device), str(dtype))
+        with self._lock:
+            for key in [k for k in self._models if k.slot == slot]:
+                del self._models[key]
+        safe_cuda_cache_empty()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+        safe_cuda_cache_empty()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, key: ModelKey) -> bool:
+        return key in self._models
+
+    @staticmethod
+    def _load(
+        key: ModelKey, device: torch.device, dtype: torch.dtype
+    ) -> ImageModelDescriptor:
+        logger.info(f"Loading model {key.path} onto {device} ({dtype}).")
+        model = ModelLoader().load_from_file(key.path)
+        # making sure it's an image-to-image model before preparing it for inference
+        if not isinstance(model, ImageModelDescriptor):
+            raise ValueError(f"Model {key.path} is not an image-to-image model.")
+        model.to(device, dtype)
+        model.eval()
+        prepare_cpu_model(model)
+        return model
+
+
+@functools.lru_cache(maxsize=16)
+def _hash_file(path: str, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_hash(model_file: str | os.PathLike) -> str:
+    """
+    Returns the SHA-256 of the given model file.
+
+    The hash is only computed once per file and modification time.
+    """
+    path = os.path.abspath(model_file)
+    return _hash_file(path, os.stat(path).st_mtime_ns)
+
+
+model_registry = ModelRegistry()
+
+
+__all__ = ["ModelKey", "ModelRegistry", "model_hash", "model_registry"]
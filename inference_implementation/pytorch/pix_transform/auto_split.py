@@ -71,7 +71,7 @@ def pix_transform_auto_split(
             tile_guide = region.scale(scale).read_from(guide)
             pix_op = to_op(pix_transform)(
                 guide_img=np.transpose(_as_3d(tile_guide), (2, 0, 1)),
-                device=torch.device("cuda:0"),
+                device=device,
                 params=params,
             )
             # passthrough single colors to speed up alpha channels
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import numpy as np
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+from ..tools.gpu import nvidia
+from ..tools.settings import Precision
+from ..upscale.tiler import NoTiling
+from .auto_split import pytorch_auto_split
+
+PRECISION_DTYPES: dict[Precision, torch.dtype] = {
+    Precision.FP32: torch.float32,
+    Precision.FP16: torch.float16,
+    Precision.BF16: torch.bfloat16,
+}
+
+# largest allowed difference to the FP32 output, in [0, 1] pixel values (2 levels of an 8 bit image)
+PARITY_TOLERANCE = 2 / 255
+
+
+def _device_supports_fp16(device: torch.device) -> bool:
+    index = device.index if device.index is not None else 0
+    if index < len(nvidia.devices):
+        return nvidia.devices[index].supports_fp16
+    # NVML is not available, so ask CUDA directly (Volta and newer)
+    try:
+        return torch.cuda.get_device_capability(device) >= (7, 0)
+    except Exception:
+        return False
+
+
+def _device_supports_bf16(device: torch.device) -> bool:
+    if device.type == "cpu":
+        return True
+    if device.type == "cuda":
+        try:
+            return torch.cuda.is_bf16_supported()
+        except Exception:
+            return False
+    return False
+
+
+def get_inference_dtype(
+    precision: Precision,
+    model: ImageModelDescriptor,
+    device: torch.device,
+) -> torch.dtype:
+    """
+    Returns the dtype to run the given model with on the given device.
+
+    `AUTO` selects FP16 on GPUs that support it and FP32 everywhere else.
+    If the model or the device doesn't support the requested precision, this falls back to FP32.
+    """
+    if precision == Precision.AUTO:
+        if device.type == "cuda" and _device_supports_fp16(device):
+            precision = Precision.FP16
+        else:
+            precision = Precision.FP32
+
+    if precision == Precision.FP16:
+        if device.type == "cpu":
+            # PyTorch does not support FP16 when using CPU
+            logger.info("FP16 is not supported on CPU. Falling back to FP32 mode.")
+            return torch.float32
+        if not model.supports_half:
+            logger.info(f"{model.architecture.name} does not support FP16. Falling back to FP32 mode.")
+            return torch.float32
+
+    if precision == Precision.BF16:
+        if not _device_supports_bf16(device):
+            logger.info(f"{device} does not support BF16. Falling back to FP32 mode.")
+            return torch.float32
+        if not model.supports_bfloat16:
+            logger.info(f"{model.architecture.name} does not support BF16. Falling back to FP32 mode.")
+            return torch.float32
+
+    return PRECISION_DTYPES[precision]
+
+
+def _parity_probe(size: int, channels: int) -> np.ndarray:
+    # a fixed pattern of flat areas, hard edges and noise, similar to a scanned page
+    rng = np.random.default_rng(0)
+    probe = np.ones((size, size, channels), dtype=np.float32)
+    probe[size // 4 : size * 3 // 4, size // 4 : size * 3 // 4, :] = 0
+    probe[:, : size // 4, :] = rng.random((size, size // 4, channels), dtype=np.float32)
+    return probe
+
+
+def measure_precision_parity(
+    reference: ImageModelDescriptor,
+    model: ImageModelDescriptor,
+    device: torch.device,
+    size: int = 64,
+) -> float:
+    """
+    Returns the largest absolute difference between the outputs of `model` (in its own dtype)
+    and `reference` (in FP32) on a small probe image. NaN or infinite outputs return `inf`.
+    """
+    assert reference.dtype == torch.float32
+
+    probe = _parity_probe(size, model.input_channels)
+    expected = pytorch_auto_split(probe, reference, device, False, NoTiling())
+    actual = pytorch_auto_split(probe, model, device, False, NoTiling(), dtype=model.dtype)
+
+    if not np.all(np.isfinite(actual)):
+        return float("inf")
+    return float(np.max(np.abs(np.clip(actual, 0, 1) - np.clip(expected, 0, 1))))
+
+
+def check_precision_parity(
+    reference: ImageModelDescriptor,
+    model: ImageModelDescriptor,
+    device: torch.device,
+    tolerance: float = PARITY_TOLERANCE,
+) -> bool:
+    """
+    Whether `model` produces the same output as its FP32 `reference`, within the given tolerance.
+    """
+    diff = measure_precision_parity(reference, model, device)
+    if diff > tolerance:
+        logger.warning(
+            f"{model.architecture.name} in {model.dtype} differs from FP32 by {diff:.4f} (tolerance {tolerance:.4f})."
+        )
+        return False
+    return True
+
+
+__all__ = [
+    "PRECISION_DTYPES",
+    "PARITY_TOLERANCE",
+    "get_inference_dtype",
+    "measure_precision_parity",
+    "check_precision_parity",
+]
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class PinnedBufferPool:
+    """
+    Reusable page-locked host buffers for host/device copies, keyed by purpose, shape and dtype.
+
+    Copies from and to pinned memory can run asynchronously (`non_blocking=True`), and reusing the
+    buffers avoids allocating (and pinning) fresh host memory for every tile.
+    A buffer is only valid until the next call to `get` with the same key.
+
+    `pin_memory=False` gives pageable buffers that are reused the same way, e.g. to test without CUDA.
+    """
+
+    def __init__(self, max_buffers: int = 8, pin_memory: bool = True) -> None:
+        assert max_buffers > 0
+        self.max_buffers: int = max_buffers
+        self.pin_memory: bool = pin_memory
+        self._buffers: OrderedDict[tuple[str, tuple[int, ...], torch.dtype], torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, purpose: str, shape: tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+        key = (purpose, tuple(shape), dtype)
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is not None:
+                self._buffers.move_to_end(key)
+                return buffer
+
+            buffer = torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory)
+            self._buffers[key] = buffer
+            while len(self._buffers) > self.max_buffers:
+                self._buffers.popitem(last=False)
+            return buffer
+
+    def owns(self, arr: np.ndarray) -> bool:
+        """Whether the given array is a view of one of the pooled buffers."""
+        with self._lock:
+            buffers = list(self._buffers.values())
+        return any(np.may_share_memory(arr, b.numpy()) for b in buffers)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buffers.clear()
+
+
+_POOLS: dict[torch.device, PinnedBufferPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pinned_pool(device: torch.device) -> PinnedBufferPool:
+    """Returns the staging buffer pool for the given CUDA device."""
+    with _POOLS_LOCK:
+        pool = _POOLS.get(device)
+        if pool is None:
+            pool = PinnedBufferPool()
+            _POOLS[device] = pool
+        return pool
+
+
+def numpy_to_torch_dtype(dtype: np.dtype) -> torch.dtype:
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+
+def upload(
+    img: np.ndarray,
+    device: torch.device,
+    dtype: torch.dtype,
+    pool: PinnedBufferPool,
+    purpose: str = "upload",
+) -> torch.Tensor:
+    """
+    Copies the given image to the device through a pinned staging buffer, without blocking the host.
+
+    Images that are uploaded together (e.g. the images of a batch) need different `purpose`s.
+    """
+    staging = pool.get(purpose, img.shape, numpy_to_torch_dtype(img.dtype))
+    np.copyto(staging.numpy(), img, casting="no")
+    return staging.to(device, non_blocking=True).to(dtype)
+
+
+def download(t: torch.Tensor, pool: PinnedBufferPool) -> np.ndarray:
+    """
+    Copies the given device tensor into a pinned staging buffer and waits for the copy (and
+    everything queued before it on the current stream) to finish.
+
+    The returned array is a view of the staging buffer, see `PinnedBufferPool.get`.
+    """
+    staging = pool.get("download", tuple(t.shape), t.dtype)
+    staging.copy_(t, non_blocking=True)
+    done = torch.cuda.Event()
+    done.record(torch.cuda.current_stream(t.device))
+    done.synchronize()
+    return staging.numpy()
+
+
+__all__ = [
+    "PinnedBufferPool",
+    "get_pinned_pool",
+    "numpy_to_torch_dtype",
+    "upload",
+    "download",
+]
@@ -0,0 +1 @@
+# Initializing directory as a module so the tests are loaded correctly
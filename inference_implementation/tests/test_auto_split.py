@@ -0,0 +1,89 @@
+import unittest
+
+import numpy as np
+
+from inference_implementation.upscale.auto_split import Split, auto_split
+from inference_implementation.upscale.tiler import ExactTileSize, MaxTileSize
+
+
+def _upscale_2x(img: np.ndarray) -> np.ndarray:
+    return np.repeat(np.repeat(img, 2, axis=0), 2, axis=1) * 0.5
+
+
+class _Model:
+    """A nearest 2x "model" that runs out of memory above a number of pixels per call."""
+
+    def __init__(self, max_pixels: int):
+        self.max_pixels = max_pixels
+        self.batch_sizes: list[int] = []
+        self.splits = 0
+
+    def upscale(self, tile: np.ndarray, _):
+        if tile.shape[0] * tile.shape[1] > self.max_pixels:
+            self.splits += 1
+            return Split()
+        self.batch_sizes.append(1)
+        return _upscale_2x(tile)
+
+    def upscale_batch(self, tiles, _):
+        if sum(t.shape[0] * t.shape[1] for t in tiles) > self.max_pixels:
+            return Split()
+        self.batch_sizes.append(len(tiles))
+        return [_upscale_2x(t) for t in tiles]
+
+
+class BatchedAutoSplitTests(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.default_rng(0).random((200, 150, 1), dtype=np.float32)
+
+    def test_max_split_batches_give_the_same_image(self):
+        expected = auto_split(self.img, _Model(10**9).upscale, MaxTileSize(64))
+
+        model = _Model(90 * 90 * 4)
+        actual = auto_split(self.img, model.upscale, MaxTileSize(64), upscale_batch=model.upscale_batch, batch_size=4)
+
+        np.testing.assert_array_equal(actual, expected)
+        self.assertGreater(max(model.batch_sizes), 1)
+
+    def test_batch_size_is_reduced_before_the_tile_size(self):
+        model = _Model(90 * 90 * 2)
+        auto_split(self.img, model.upscale, MaxTileSize(64), upscale_batch=model.upscale_batch, batch_size=8)
+
+        # the tiles themselves always fit, only the batches had to shrink
+        self.assertEqual(model.splits, 0)
+        self.assertLessEqual(max(model.batch_sizes), 2)
+
+    def test_tile_size_is_reduced_when_single_tiles_do_not_fit(self):
+        expected = auto_split(self.img, _Model(10**9).upscale, MaxTileSize(64))
+
+        model = _Model(50 * 50)
+        actual = auto_split(self.img, model.upscale, MaxTileSize(64), upscale_batch=model.upscale_batch, batch_size=4)
+
+        self.assertGreater(model.splits, 0)
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertLess(np.abs(actual - expected).max(), 1e-6)
+
+    def test_exact_split_batches_give_the_same_image(self):
+        expected = auto_split(self.img, _Model(10**9).upscale, ExactTileSize((64, 64)))
+
+        model = _Model(64 * 64 * 3)
+        actual = auto_split(self.img, model.upscale, ExactTileSize((64, 64)), upscale_batch=model.upscale_batch, batch_size=4)
+
+        np.testing.assert_array_equal(actual, expected)
+        self.assertEqual(max(model.batch_sizes), 2)
+
+    def test_results_are_collected_as_the_result_dtype(self):
+        expected = auto_split(self.img, _Model(10**9).upscale, MaxTileSize(64))
+
+        model = _Model(90 * 90 * 4)
+        actual = auto_split(
+            self.img, model.upscale, MaxTileSize(64), upscale_batch=model.upscale_batch, batch_size=4, result_dtype=np.uint8
+        )
+
+        # quantized like a saved page
+        self.assertEqual(actual.dtype, np.uint8)
+        np.testing.assert_array_equal(actual, np.clip(expected * 255.0, 0, 255).astype(np.uint8))
+
+
+if __name__ == "__main__":
+    unittest.main()
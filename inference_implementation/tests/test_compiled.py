@@ -0,0 +1,55 @@
+import unittest
+
+import torch
+from spandrel.architectures.Compact import CompactArch
+from spandrel.architectures.Compact.__arch.SRVGG import SRVGGNetCompact
+
+from inference_implementation.pytorch.compiled import CompiledModel
+from inference_implementation.tools.settings import CompileMode
+
+
+def _model():
+    module = SRVGGNetCompact(num_in_ch=1, num_out_ch=1, num_feat=8, num_conv=2, upscale=2)
+    model = CompactArch().load(module.state_dict())
+    model.eval()
+    return model
+
+
+class CompiledModelTests(unittest.TestCase):
+    def tearDown(self):
+        torch._dynamo.reset()
+
+    @torch.inference_mode()
+    def test_only_repeated_shapes_are_compiled(self):
+        model = _model()
+        compiled = CompiledModel(model, CompileMode.COMPILE, min_hits=2, backend="eager")
+        tile = torch.rand((1, 1, 32, 32))
+        odd = torch.rand((1, 1, 40, 24))
+
+        torch.testing.assert_close(compiled(tile), model(tile))
+        torch.testing.assert_close(compiled(odd), model(odd))
+        self.assertEqual(compiled.compiled_shapes, set())
+
+        torch.testing.assert_close(compiled(tile), model(tile))
+        self.assertEqual({shape for shape, _, _ in compiled.compiled_shapes}, {(1, 1, 32, 32)})
+
+    @torch.inference_mode()
+    def test_number_of_graphs_is_bounded(self):
+        model = _model()
+        compiled = CompiledModel(model, CompileMode.COMPILE, min_hits=1, max_graphs=2, backend="eager")
+        for size in (16, 32, 48):
+            x = torch.rand((1, 1, size, size))
+            torch.testing.assert_close(compiled(x), model(x))
+        self.assertEqual(len(compiled.compiled_shapes), 2)
+
+    def test_attributes_are_forwarded(self):
+        model = _model()
+        compiled = CompiledModel(model, CompileMode.CUDA_GRAPHS, backend="eager")
+        self.assertEqual(compiled.scale, 2)
+        self.assertEqual(compiled.dtype, torch.float32)
+        # CUDA graphs are only used on CUDA devices
+        self.assertFalse(compiled.cuda_graphs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import unittest
+
+import numpy as np
+import torch
+from spandrel.architectures.Compact import CompactArch
+from spandrel.architectures.Compact.__arch.SRVGG import SRVGGNetCompact
+
+from inference_implementation.pytorch import cpu_backend
+from inference_implementation.pytorch.auto_split import pytorch_auto_split
+from inference_implementation.pytorch.cpu_backend import (
+    CpuBackendSettings,
+    _worker_cores,
+    configure_cpu_backend,
+    prepare_cpu_model,
+)
+from inference_implementation.upscale.tiler import MaxTileSize
+
+CPU = torch.device("cpu")
+
+
+class CpuBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.threads = torch.get_num_threads()
+
+    def tearDown(self):
+        cpu_backend._active = None
+        torch.set_num_threads(self.threads)
+        torch.backends.mkldnn.enabled = True
+
+    def test_worker_cores_are_disjoint_and_wrap_around(self):
+        available = sorted(os.sched_getaffinity(0))
+        self.assertEqual(_worker_cores(len(available) + 1, 3), available)
+        self.assertEqual(_worker_cores(1, 0), available[:1])
+        self.assertEqual(_worker_cores(1, len(available)), available[:1])
+
+    def test_threads_are_configured(self):
+        configure_cpu_backend(CpuBackendSettings(intra_op_threads=1, onednn=False))
+        self.assertEqual(torch.get_num_threads(), 1)
+        self.assertFalse(torch.backends.mkldnn.enabled)
+
+    def test_channels_last_gives_the_same_pages(self):
+        torch.manual_seed(0)
+        module = SRVGGNetCompact(num_in_ch=1, num_out_ch=1, num_feat=8, num_conv=2, upscale=2)
+        page = np.random.default_rng(0).integers(0, 255, (48, 32, 1), dtype=np.uint8)
+
+        model = CompactArch().load(module.state_dict()).to(CPU).eval()
+        expected = pytorch_auto_split(page, model, CPU, False, MaxTileSize())
+
+        configure_cpu_backend(CpuBackendSettings(channels_last=True))
+        prepare_cpu_model(model)
+        conv = next(m for m in model.model.modules() if isinstance(m, torch.nn.Conv2d))
+        self.assertTrue(conv.weight.is_contiguous(memory_format=torch.channels_last))
+
+        actual = pytorch_auto_split(page, model, CPU, False, MaxTileSize())
+        self.assertLessEqual(np.abs(actual.astype(int) - expected).max(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+
+import numpy as np
+import torch
+
+from inference_implementation.pytorch.auto_split import pytorch_auto_split, pytorch_batch_upscale
+from inference_implementation.pytorch.device_blending import DeviceTileBlender, device_auto_split
+from inference_implementation.upscale.auto_split import Split, auto_split
+from inference_implementation.upscale.tile_blending import (
+    BlendDirection,
+    TileBlender,
+    TileOverlap,
+    half_sin_blend_fn,
+)
+from inference_implementation.upscale.tiler import MaxTileSize
+
+from .test_precision import CPU, _FakeDescriptor
+
+
+class _Model:
+    """A 2x "model" on (N, C, H, W) tensors that runs out of memory above a number of pixels per call."""
+
+    def __init__(self, max_pixels: int):
+        self.max_pixels = max_pixels
+        self.splits = 0
+
+    def __call__(self, batch: torch.Tensor):
+        if batch.shape[0] * batch.shape[2] * batch.shape[3] > self.max_pixels:
+            self.splits += 1
+            return Split()
+        return torch.nn.functional.interpolate(batch, scale_factor=2, mode="bilinear") * 0.5
+
+    def numpy(self, tile: np.ndarray, _):
+        t = torch.from_numpy(np.ascontiguousarray(tile)).permute(2, 0, 1).unsqueeze(0)
+        return self(t)[0].permute(1, 2, 0).numpy()
+
+
+class DeviceTileBlenderTests(unittest.TestCase):
+    def test_same_blend_as_the_host_blender(self):
+        rng = np.random.default_rng(0)
+        for direction in (BlendDirection.X, BlendDirection.Y):
+            tiles = [
+                (rng.random((80, 70, 2), dtype=np.float32), TileOverlap(0, 12)),
+                (rng.random((80, 70, 2), dtype=np.float32), TileOverlap(12, 8)),
+                (rng.random((80, 70, 2), dtype=np.float32), TileOverlap(16, 0)),
+            ]
+            # the start overlap of the last tile is cut down to the end overlap of the one before
+            length = 70 - 12 + (70 - 12 - 8) + (70 - 8 - 8)
+            w, h = (length, 80) if direction == BlendDirection.X else (80, length)
+
+            host = TileBlender(w, h, 2, direction, half_sin_blend_fn)
+            device = DeviceTileBlender(w, h, 2, direction, CPU, torch.float32)
+            for tile, overlap in tiles:
+                t = tile if direction == BlendDirection.X else tile.transpose(1, 0, 2).copy()
+                host.add_tile(t, overlap)
+                device.add_tile(torch.from_numpy(t), overlap)
+
+            np.testing.assert_allclose(device.get_result().numpy(), host.get_result(), atol=1e-6)
+
+
+class DeviceAutoSplitTests(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.default_rng(0).random((200, 150, 1), dtype=np.float32)
+
+    def test_same_image_as_host_blending(self):
+        model = _Model(10**9)
+        expected = auto_split(self.img, model.numpy, MaxTileSize(64))
+        actual = device_auto_split(torch.from_numpy(self.img), model, MaxTileSize(64), batch_size=4)
+
+        self.assertEqual(tuple(actual.shape), expected.shape)
+        np.testing.assert_allclose(actual.numpy(), expected, atol=1e-5)
+
+    def test_tile_size_is_lowered_when_tiles_do_not_fit(self):
+        model = _Model(60 * 60)
+        expected = auto_split(self.img, _Model(10**9).numpy, MaxTileSize(32))
+        actual = device_auto_split(torch.from_numpy(self.img), model, MaxTileSize(64), batch_size=4)
+
+        self.assertGreater(model.splits, 0)
+        np.testing.assert_allclose(actual.numpy(), expected, atol=1e-5)
+
+    def test_pytorch_auto_split_parity(self):
+        model = _FakeDescriptor(torch.float32)
+        page = (self.img * 255).astype(np.uint8)
+
+        for img, atol in ((self.img, 1e-5), (page, 2)):
+            host = pytorch_auto_split(img, model, CPU, False, MaxTileSize(64), tile_batch_size=4)
+            device = pytorch_auto_split(img, model, CPU, False, MaxTileSize(64), tile_batch_size=4, device_blend=True)
+
+            self.assertEqual(device.dtype, host.dtype)
+            self.assertEqual(device.shape, host.shape)
+            np.testing.assert_allclose(device.astype(np.float32), host.astype(np.float32), atol=atol)
+
+    def test_result_dtype(self):
+        model = _FakeDescriptor(torch.float32)
+        expected = pytorch_auto_split(self.img, model, CPU, False, MaxTileSize(64), tile_batch_size=4)
+        expected = np.clip(expected * 255.0, 0, 255).astype(np.uint8)
+
+        for device_blend in (False, True):
+            actual = pytorch_auto_split(
+                self.img, model, CPU, False, MaxTileSize(64), tile_batch_size=4, device_blend=device_blend,
+                result_dtype=np.uint8,
+            )
+            self.assertEqual(actual.dtype, np.uint8)
+            np.testing.assert_allclose(actual, expected, atol=1)
+
+        # whole images, in a batch
+        imgs = [self.img, 1 - self.img]
+        actual, _ = pytorch_batch_upscale(imgs, model, CPU, False, MaxTileSize(256), 2, result_dtype=np.uint8)
+        for img, result in zip(imgs, actual):
+            self.assertEqual(result.dtype, np.uint8)
+            reference = pytorch_auto_split(img, model, CPU, False, MaxTileSize(256))
+            np.testing.assert_array_equal(result, np.clip(reference * 255.0, 0, 255).astype(np.uint8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import torch
+from PIL import Image
+from spandrel.architectures.Compact.__arch.SRVGG import SRVGGNetCompact
+
+from inference_implementation.device_pool import DevicePool, parse_devices
+from inference_implementation.inference import InferenceImplementation
+from inference_implementation.tools.settings import Precision
+
+CPU = torch.device("cpu")
+
+
+class ParseDevicesTests(unittest.TestCase):
+    def test_repeated_devices(self):
+        self.assertEqual(parse_devices("cpu, cpu,cpu"), [CPU, CPU, CPU])
+
+    def test_explicit_devices(self):
+        self.assertEqual(parse_devices("cuda:0,cuda:1"), [torch.device("cuda:0"), torch.device("cuda:1")])
+
+
+class DevicePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.model_file = os.path.join(self.dir.name, "model.pth")
+        torch.manual_seed(0)
+        module = SRVGGNetCompact(num_in_ch=1, num_out_ch=1, num_feat=8, num_conv=2, upscale=2)
+        torch.save(module.state_dict(), self.model_file)
+        self.kwargs = {"precision": Precision.FP32, "calibrate_memory": False}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_repeated_cuda_devices_are_rejected(self):
+        with self.assertRaises(ValueError):
+            DevicePool([torch.device("cuda:0"), torch.device("cuda:1"), torch.device("cuda:0")], **self.kwargs)
+
+    def test_cpu_slots_are_named_apart(self):
+        pool = DevicePool([CPU, CPU], **self.kwargs)
+        self.assertEqual([slot.name for slot in pool.slots], ["cpu#0", "cpu#1"])
+
+    def test_batches_go_to_the_least_busy_device(self):
+        pool = DevicePool([CPU, CPU, CPU], **self.kwargs)
+        with pool.acquire() as first, pool.acquire() as second, pool.acquire() as third:
+            self.assertEqual(len({first.name, second.name, third.name}), 3)
+            self.assertEqual([s["in_flight"] for s in pool.stats()], [1, 1, 1])
+        self.assertEqual([s["in_flight"] for s in pool.stats()], [0, 0, 0])
+        self.assertEqual([s["completed"] for s in pool.stats()], [1, 1, 1])
+
+    def test_concurrent_batches_are_spread_over_devices(self):
+        pool = DevicePool([CPU, CPU], **self.kwargs)
+        pages = [np.full((32, 24), i * 10, dtype=np.uint8) for i in range(4)]
+        barrier = threading.Barrier(2)
+        used = []
+
+        def worker():
+            with pool.acquire() as slot:
+                used.append(slot.name)
+                barrier.wait(timeout=5)
+                slot.implementation.upscale_pages(pages, self.model_file)
+
+        threads = [threading.Thread(target=worker) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(used), ["cpu#0", "cpu#1"])
+
+    def test_pipeline_matches_a_single_device(self):
+        inputs, expected = [], []
+        rng = np.random.default_rng(0)
+        for i in range(6):
+            input_file = os.path.join(self.dir.name, f"{i}.png")
+            Image.fromarray(rng.integers(0, 255, (40 + (i % 2) * 8, 32), dtype=np.uint8)).save(input_file)
+            inputs.append(input_file)
+
+        single = InferenceImplementation(device=CPU, **self.kwargs)
+        for input_file in inputs:
+            expected.append(single.upscale_pages([single.read_page(input_file)], self.model_file)[0])
+
+        outputs = {}
+        pool = DevicePool([CPU, CPU, CPU], **self.kwargs)
+        pipeline = pool.create_pipeline(self.model_file, batch_size=1)
+        pipeline.encode = lambda img, output_file: outputs.__setitem__(output_file, img)
+        done = list(pipeline.run((input_file, str(i), i) for i, input_file in enumerate(inputs)))
+
+        self.assertEqual(done, list(range(6)))
+        for i in range(6):
+            np.testing.assert_array_equal(outputs[str(i)], expected[i])
+        self.assertEqual(sum(s["completed"] for s in pool.stats()), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+import numpy as np
+import torch
+
+from inference_implementation.pytorch.auto_split import pytorch_auto_split, pytorch_batch_upscale
+from inference_implementation.upscale.passthrough import FlatTileStats, fill_flat, flat_color
+from inference_implementation.upscale.tiler import MaxTileSize
+
+from .test_precision import CPU, _FakeDescriptor
+
+
+def _page(h: int = 96, w: int = 128) -> np.ndarray:
+    """A white page with JPEG-like noise, and some ink in its top left corner."""
+    rng = np.random.default_rng(0)
+    page = (255 - rng.integers(0, 3, (h, w, 1))).astype(np.uint8)
+    page[4:20, 4:20] = rng.integers(0, 255, (16, 16, 1), dtype=np.uint8)
+    return page
+
+
+class FlatColorTests(unittest.TestCase):
+    def test_noise_within_tolerance_is_flat(self):
+        page = _page()
+        color = flat_color(page[48:, 64:], 0.02)
+        self.assertIsNotNone(color)
+        self.assertAlmostEqual(float(color[0]), 254, delta=1)  # type: ignore
+
+    def test_ink_is_not_flat(self):
+        self.assertIsNone(flat_color(_page()[:48, :64], 0.02))
+        self.assertIsNone(flat_color(_page()[48:, 64:], 0.0))
+
+    def test_float_and_single_channel_images(self):
+        img = np.full((16, 16), 0.5, dtype=np.float32)
+        img[3, 5] = 0.505
+        self.assertIsNotNone(flat_color(img, 0.01))
+        self.assertIsNone(flat_color(img, 0.001))
+
+    def test_fill_rounds_for_uint8(self):
+        tile = fill_flat(np.array([254.6], dtype=np.float32), 6, 4, np.uint8)
+        self.assertEqual(tile.shape, (4, 6, 1))
+        self.assertTrue(np.all(tile == 255))
+
+
+class FlatTileSkippingTests(unittest.TestCase):
+    def setUp(self):
+        self.model = _FakeDescriptor(torch.float32)
+
+    def _upscale(self, page: np.ndarray, **kwargs) -> np.ndarray:
+        return pytorch_auto_split(page, self.model, CPU, False, MaxTileSize(48), **kwargs)  # type: ignore
+
+    def test_flat_tiles_are_skipped_and_counted(self):
+        page = _page()
+        stats = FlatTileStats()
+        result = self._upscale(page, flat_tolerance=0.02, flat_stats=stats)
+
+        self.assertEqual(result.shape, (192, 256, 1))
+        self.assertGreater(stats.skipped, 0)
+        self.assertLess(stats.skipped, stats.tiles)
+        # the ink is upscaled exactly like before, the margins are within the tolerance
+        # (apart from the outermost pixels, which the zero padded conv of the fake model darkens)
+        reference = self._upscale(page)
+        np.testing.assert_array_equal(result[:48, :48], reference[:48, :48])
+        self.assertLessEqual(np.abs(result.astype(int) - reference)[2:-2, 2:-2].max(), 6)
+
+    def test_nothing_is_skipped_without_a_tolerance(self):
+        stats = FlatTileStats()
+        self._upscale(_page(), flat_stats=stats)
+        self.assertEqual(stats.skipped, 0)
+        self.assertGreater(stats.tiles, 1)
+
+    def test_batched_tiles_and_device_blending(self):
+        page = _page()
+        expected = self._upscale(page, flat_tolerance=0.02)
+        for kwargs in ({"tile_batch_size": 4}, {"tile_batch_size": 4, "device_blend": True}):
+            stats = FlatTileStats()
+            result = self._upscale(page, flat_tolerance=0.02, flat_stats=stats, **kwargs)
+            self.assertGreater(stats.skipped, 0, kwargs)
+            self.assertLessEqual(np.abs(result.astype(int) - expected).max(), 1, kwargs)
+
+    def test_blank_pages_skip_the_batch(self):
+        blank = np.full((32, 32, 1), 255, dtype=np.uint8)
+        stats = [FlatTileStats(), FlatTileStats()]
+        results, _ = pytorch_batch_upscale(
+            [blank, _page(32, 32)], self.model, CPU, False, MaxTileSize(64), 2,  # type: ignore
+            flat_tolerance=0.02, flat_stats=stats,
+        )
+
+        self.assertTrue(np.all(results[0] == 255))
+        self.assertEqual(results[1].shape, (64, 64, 1))
+        self.assertEqual([(s.tiles, s.skipped) for s in stats], [(1, 1), (1, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
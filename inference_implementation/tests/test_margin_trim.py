@@ -0,0 +1,61 @@
+import unittest
+
+import numpy as np
+import torch
+
+from inference_implementation.image_dimension.crop.crop_border import SelectMode, crop_border_node
+from inference_implementation.image_dimension.crop.trim_margins import find_margin_trim
+from inference_implementation.pytorch.auto_split import pytorch_auto_split
+from inference_implementation.tools.utils import Region
+from inference_implementation.upscale.tiler import MaxTileSize
+
+from .test_precision import CPU, _FakeDescriptor
+
+
+def _scan(h: int = 120, w: int = 90) -> np.ndarray:
+    """A scan with noisy white margins around a panel."""
+    rng = np.random.default_rng(0)
+    page = (255 - rng.integers(0, 4, (h, w, 1))).astype(np.uint8)
+    page[30:80, 20:60] = rng.integers(0, 200, (50, 40, 1), dtype=np.uint8)
+    return page
+
+
+class MarginTrimTests(unittest.TestCase):
+    def test_content_box_is_padded(self):
+        trim = find_margin_trim(_scan(), tolerance=4, padding=8)
+        assert trim is not None
+        self.assertEqual(trim.content, Region(12, 22, 56, 66))
+        self.assertEqual((trim.width, trim.height), (90, 120))
+        self.assertAlmostEqual(float(trim.color[0]), 253.5, delta=1)
+        self.assertGreater(trim.saving, 0.6)
+
+    def test_pages_without_margins_are_not_trimmed(self):
+        self.assertIsNone(find_margin_trim(np.random.default_rng(0).integers(0, 255, (64, 64, 1), dtype=np.uint8)))
+        self.assertIsNone(find_margin_trim(np.full((64, 64, 1), 255, dtype=np.uint8)))
+
+    def test_uint8_tolerance_matches_float(self):
+        page = _scan()
+        expected = crop_border_node(page.astype(np.float32) / 255, 4, SelectMode.ALL_SECTIONS, 0)
+        self.assertEqual(crop_border_node(page, 4, SelectMode.ALL_SECTIONS, 0).shape, expected.shape)
+
+    def test_padded_result_has_the_size_of_the_whole_page(self):
+        page = _scan()
+        model = _FakeDescriptor(torch.float32)
+        trim = find_margin_trim(page, tolerance=4, padding=8)
+        assert trim is not None
+
+        upscaled = pytorch_auto_split(trim.crop(page), model, CPU, False, MaxTileSize(256))  # type: ignore
+        result = trim.pad(upscaled, 2)
+        reference = pytorch_auto_split(page, model, CPU, False, MaxTileSize(256))  # type: ignore
+
+        self.assertEqual(result.shape, reference.shape)
+        self.assertEqual(result.dtype, np.uint8)
+        # the panel is upscaled like it is on the whole page, the margins have the border color
+        # (up to rounding, the conv runs on a differently sized input)
+        np.testing.assert_allclose(result[60:160, 40:120], reference[60:160, 40:120], atol=1)
+        self.assertTrue(np.all(result[:40] == result[0, 0]))
+        self.assertLessEqual(abs(int(result[0, 0, 0]) - 254), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from inference_implementation.pytorch.memory_profile import (
+    MemoryProfile,
+    get_memory_profile,
+    get_resident_profile,
+    profile_path,
+)
+from inference_implementation.tests.test_precision import CPU, _FakeDescriptor
+
+
+class MemoryProfileTests(unittest.TestCase):
+    def test_fit_recovers_a_linear_curve(self):
+        samples = [(p, 1000 + 12 * p) for p in (64 * 64, 128 * 128, 256 * 256)]
+        profile = MemoryProfile.fit("hash", "cpu", "torch.float32", samples)
+        self.assertAlmostEqual(profile.bytes_per_pixel, 12, places=3)
+        self.assertAlmostEqual(profile.base_bytes, 1000, delta=1)
+        self.assertAlmostEqual(profile.estimate(100), 2200, delta=1)
+
+    def test_tile_size_fits_into_the_budget(self):
+        profile = MemoryProfile("hash", "cpu", "torch.float32", 1000, 12, [])
+        budget = 12 * 1024**3
+        tile_size = profile.tile_size_for(budget)
+        self.assertEqual(tile_size % 16, 0)
+        self.assertLessEqual(profile.estimate(tile_size * tile_size), budget)
+        self.assertGreater(profile.estimate((tile_size + 16) ** 2), budget)
+        # never below the smallest tile size
+        self.assertEqual(profile.tile_size_for(10), 16)
+
+    def test_json_round_trip(self):
+        profile = MemoryProfile("hash", "cpu", "torch.float32", 1000, 12, [(1, 2), (3, 4)])
+        self.assertEqual(MemoryProfile.from_json(profile.to_json()), profile)
+
+    def test_calibrated_profile_is_stored_next_to_the_model(self):
+        with tempfile.TemporaryDirectory() as directory:
+            model_file = os.path.join(directory, "model.pth")
+            model = _FakeDescriptor(torch.float32)
+
+            profile = get_memory_profile(model_file, model, CPU, torch.float32, "hash")
+            path = profile_path(model_file, CPU, torch.float32)
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(len(profile.samples), 4)
+            self.assertIs(get_resident_profile(model), profile)
+
+            self.assertEqual(get_memory_profile(model_file, model, CPU, torch.float32, "hash"), profile)
+            # a changed model file has to be calibrated again
+            other = get_memory_profile(model_file, model, CPU, torch.float32, "other")
+            self.assertEqual(other.model_hash, "other")
+
+
+if __name__ == "__main__":
+    unittest.main()
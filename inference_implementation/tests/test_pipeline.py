@@ -0,0 +1,87 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from inference_implementation.pipeline import PagePipeline
+
+
+class PagePipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.written = {}
+        self.lock = threading.Lock()
+
+    def _decode(self, input_file: str) -> np.ndarray:
+        # later pages decode faster, so that completion order differs from page order
+        value = int(input_file)
+        time.sleep(0.001 * (10 - value))
+        return np.full((4, 4), value, dtype=np.float32)
+
+    def _infer(self, pages):
+        return [page * 2 for page in pages]
+
+    def _encode(self, img: np.ndarray, output_file: str) -> None:
+        with self.lock:
+            self.written[output_file] = float(img[0, 0])
+
+    def test_pages_are_yielded_in_order_once_written(self):
+        pipeline = PagePipeline(self._decode, self._infer, self._encode, prefetch_depth=3, encode_depth=2, batch_size=2)
+        items = [(str(i), f"out{i}", i) for i in range(10)]
+
+        done = []
+        for tag in pipeline.run(items):
+            self.assertIn(f"out{tag}", self.written)
+            done.append(tag)
+
+        self.assertEqual(done, list(range(10)))
+        self.assertEqual(self.written, {f"out{i}": i * 2.0 for i in range(10)})
+
+    def test_stage_timings_are_counted(self):
+        pipeline = PagePipeline(self._decode, self._infer, self._encode, batch_size=3)
+        list(pipeline.run([(str(i), f"out{i}", i) for i in range(7)]))
+
+        stats = pipeline.stats.as_dict()
+        self.assertEqual(stats["decode"]["count"], 7)
+        self.assertEqual(stats["infer"]["count"], 7)
+        self.assertEqual(stats["infer_wait"]["count"], 3)
+        self.assertEqual(stats["encode"]["count"], 7)
+        self.assertGreater(stats["decode"]["seconds"], 0)
+
+    def test_inference_errors_are_raised_to_the_consumer(self):
+        def infer(pages):
+            raise RuntimeError("model failed")
+
+        pipeline = PagePipeline(self._decode, infer, self._encode)
+        with self.assertRaises(RuntimeError):
+            list(pipeline.run([(str(i), f"out{i}", i) for i in range(3)]))
+        self.assertEqual(self.written, {})
+
+    def test_encode_errors_are_raised_to_the_consumer(self):
+        def encode(img, output_file):
+            raise OSError("disk full")
+
+        pipeline = PagePipeline(self._decode, self._infer, encode)
+        with self.assertRaises(OSError):
+            list(pipeline.run([(str(i), f"out{i}", i) for i in range(3)]))
+
+    def test_several_infer_workers_keep_the_order(self):
+        running = []
+        peak = []
+
+        def infer(pages):
+            with self.lock:
+                running.append(1)
+                peak.append(len(running))
+            # earlier batches take longer, so that they finish after later ones
+            time.sleep(0.002 * (10 - int(pages[0][0, 0])))
+            with self.lock:
+                running.pop()
+            return self._infer(pages)
+
+        pipeline = PagePipeline(self._decode, infer, self._encode, prefetch_depth=2, encode_depth=1, infer_workers=3)
+        done = list(pipeline.run([(str(i), f"out{i}", i) for i in range(10)]))
+
+        self.assertEqual(done, list(range(10)))
+        self.assertEqual(self.written, {f"out{i}": i * 2.0 for i in range(10)})
+        self.assertGreater(max(peak), 1)
@@ -0,0 +1,76 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+
+from inference_implementation.pytorch.precision import (
+    check_precision_parity,
+    get_inference_dtype,
+    measure_precision_parity,
+)
+from inference_implementation.tools.settings import Precision
+
+CPU = torch.device("cpu")
+
+
+def _fake_model(supports_half=True, supports_bfloat16=True):
+    return SimpleNamespace(
+        supports_half=supports_half,
+        supports_bfloat16=supports_bfloat16,
+        architecture=SimpleNamespace(name="Test"),
+    )
+
+
+class _FakeDescriptor:
+    '''Minimal stand-in for an ImageModelDescriptor: a 2x nearest upscale followed by a smoothing conv.'''
+
+    def __init__(self, dtype: torch.dtype, broken: bool = False):
+        conv = torch.nn.Conv2d(1, 1, 3, padding=1, bias=False)
+        with torch.no_grad():
+            conv.weight.fill_(1 / 9)
+        self.module = torch.nn.Sequential(torch.nn.Upsample(scale_factor=2), conv).to(CPU, dtype).eval()
+        self.dtype = dtype
+        self.device = CPU
+        self.input_channels = 1
+        self.output_channels = 1
+        self.scale = 2
+        self.architecture = SimpleNamespace(name="Test")
+        self.broken = broken
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.module(x)
+        if self.broken:
+            out = out * float("nan")
+        return out
+
+
+class GetInferenceDtypeTests(unittest.TestCase):
+    def test_fp32_is_always_fp32(self):
+        self.assertEqual(get_inference_dtype(Precision.FP32, _fake_model(), CPU), torch.float32)
+
+    def test_auto_on_cpu_is_fp32(self):
+        self.assertEqual(get_inference_dtype(Precision.AUTO, _fake_model(), CPU), torch.float32)
+
+    def test_fp16_on_cpu_falls_back_to_fp32(self):
+        self.assertEqual(get_inference_dtype(Precision.FP16, _fake_model(), CPU), torch.float32)
+
+    def test_bf16_on_cpu(self):
+        self.assertEqual(get_inference_dtype(Precision.BF16, _fake_model(), CPU), torch.bfloat16)
+
+    def test_bf16_falls_back_per_model(self):
+        model = _fake_model(supports_bfloat16=False)
+        self.assertEqual(get_inference_dtype(Precision.BF16, model, CPU), torch.float32)
+
+
+class PrecisionParityTests(unittest.TestCase):
+    def test_bf16_matches_fp32_on_cpu(self):
+        reference = _FakeDescriptor(torch.float32)
+        model = _FakeDescriptor(torch.bfloat16)
+        self.assertLess(measure_precision_parity(reference, model, CPU), 2 / 255)
+        self.assertTrue(check_precision_parity(reference, model, CPU))
+
+    def test_non_finite_output_fails_parity(self):
+        reference = _FakeDescriptor(torch.float32)
+        model = _FakeDescriptor(torch.bfloat16, broken=True)
+        self.assertEqual(measure_precision_parity(reference, model, CPU), float("inf"))
+        self.assertFalse(check_precision_parity(reference, model, CPU))
@@ -0,0 +1,98 @@
+import threading
+import unittest
+
+import numpy as np
+import torch
+
+from inference_implementation.api.progress import Aborted, ProgressController
+from inference_implementation.pytorch.auto_split import pytorch_auto_split, pytorch_batch_upscale
+from inference_implementation.upscale.tiler import MaxTileSize
+
+from .test_precision import CPU, _FakeDescriptor
+
+
+class _CountingProgress(ProgressController):
+    """Counts the checks, and pauses (or aborts) after the given number of them."""
+
+    def __init__(self, pause_after: int | None = None, abort_after: int | None = None):
+        super().__init__()
+        self.checks = 0
+        self.pause_after = pause_after
+        self.abort_after = abort_after
+        self.suspended = threading.Event()
+
+    def check_aborted(self) -> None:
+        self.checks += 1
+        if self.checks == self.pause_after:
+            self.pause()
+        if self.checks == self.abort_after:
+            self.abort()
+        super().check_aborted()
+
+    def suspend(self) -> None:
+        self.suspended.set()
+        super().suspend()
+
+
+def _page(h: int = 96, w: int = 128) -> np.ndarray:
+    return np.random.default_rng(0).integers(0, 255, (h, w, 1), dtype=np.uint8)
+
+
+class ProgressTests(unittest.TestCase):
+    def setUp(self):
+        self.model = _FakeDescriptor(torch.float32)
+
+    def _upscale(self, page: np.ndarray, **kwargs) -> np.ndarray:
+        return pytorch_auto_split(page, self.model, CPU, False, MaxTileSize(48), **kwargs)  # type: ignore
+
+    def test_every_tile_is_checked(self):
+        progress = _CountingProgress()
+        result = self._upscale(_page(), progress=progress)
+        np.testing.assert_array_equal(result, self._upscale(_page()))
+        # 3x2 tiles
+        self.assertEqual(progress.checks, 6)
+
+    def test_abort_stops_between_tiles(self):
+        for kwargs in ({}, {"tile_batch_size": 2}, {"tile_batch_size": 2, "device_blend": True}):
+            progress = _CountingProgress(abort_after=2)
+            with self.assertRaises(Aborted, msg=kwargs):
+                self._upscale(_page(), progress=progress, **kwargs)
+            self.assertEqual(progress.checks, 2, kwargs)
+
+    def test_pause_waits_until_resumed(self):
+        progress = _CountingProgress(pause_after=3)
+        result: list[np.ndarray] = []
+        worker = threading.Thread(target=lambda: result.append(self._upscale(_page(), progress=progress)))
+        worker.start()
+
+        self.assertTrue(progress.suspended.wait(5))
+        self.assertTrue(worker.is_alive())
+        self.assertEqual(progress.checks, 3)
+        progress.resume()
+        worker.join(5)
+
+        self.assertFalse(worker.is_alive())
+        np.testing.assert_array_equal(result[0], self._upscale(_page()))
+
+    def test_abort_wakes_up_a_paused_upscale(self):
+        progress = _CountingProgress(pause_after=1)
+        errors: list[BaseException] = []
+
+        def run():
+            try:
+                pytorch_batch_upscale([_page(32, 32)] * 3, self.model, CPU, False, MaxTileSize(48), 1, progress=progress)  # type: ignore
+            except Aborted as e:
+                errors.append(e)
+
+        worker = threading.Thread(target=run)
+        worker.start()
+        self.assertTrue(progress.suspended.wait(5))
+        progress.abort()
+        worker.join(5)
+
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+from contextlib import contextmanager
+from typing import Iterator
+from unittest import mock
+
+import numpy as np
+import torch
+
+from inference_implementation.pytorch import auto_split as pytorch_auto_split_module
+from inference_implementation.pytorch.auto_split import pytorch_auto_split, pytorch_batch_upscale
+from inference_implementation.pytorch.staging import PinnedBufferPool
+from inference_implementation.upscale.tiler import MaxTileSize
+
+from .test_precision import CPU, _FakeDescriptor
+
+
+def _cpu_download(t: torch.Tensor, pool: PinnedBufferPool) -> np.ndarray:
+    # like `staging.download`, without the CUDA event
+    staging = pool.get("download", tuple(t.shape), t.dtype)
+    staging.copy_(t)
+    return staging.numpy()
+
+
+@contextmanager
+def cpu_staging() -> Iterator[PinnedBufferPool]:
+    """Makes the CPU "device" use a (pageable) staging pool, like CUDA devices do."""
+    pool = PinnedBufferPool(pin_memory=False)
+    with mock.patch.object(pytorch_auto_split_module, "_get_staging_pool", lambda device: pool), mock.patch.object(
+        pytorch_auto_split_module, "download", _cpu_download
+    ):
+        yield pool
+
+
+class _BatchOutOfMemoryDescriptor(_FakeDescriptor):
+    """Runs out of memory for every batch of more than one tile."""
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if x.shape[0] > 1:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return super().__call__(x)
+
+
+def _page(h: int = 96, w: int = 128) -> np.ndarray:
+    return np.random.default_rng(0).random((h, w, 1), dtype=np.float32)
+
+
+class PinnedBufferPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = PinnedBufferPool(max_buffers=3, pin_memory=False)
+
+    def test_buffers_are_reused_by_purpose_shape_and_dtype(self):
+        buffer = self.pool.get("upload", (4, 4, 1), torch.uint8)
+        self.assertIs(self.pool.get("upload", (4, 4, 1), torch.uint8), buffer)
+        self.assertIsNot(self.pool.get("download", (4, 4, 1), torch.uint8), buffer)
+        self.assertIsNot(self.pool.get("upload", (4, 4, 3), torch.uint8), buffer)
+        self.assertEqual(self.pool.get("upload", (4, 4, 1), torch.float32).dtype, torch.float32)
+
+    def test_least_recently_used_buffers_are_dropped(self):
+        first = self.pool.get("a", (2,), torch.uint8)
+        second = self.pool.get("b", (2,), torch.uint8)
+        self.pool.get("c", (2,), torch.uint8)
+        self.assertIs(self.pool.get("a", (2,), torch.uint8), first)
+        self.pool.get("d", (2,), torch.uint8)
+        self.assertIsNot(self.pool.get("b", (2,), torch.uint8), second)
+
+    def test_owns_views_of_its_buffers_only(self):
+        buffer = self.pool.get("download", (8, 8, 1), torch.float32).numpy()
+        self.assertTrue(self.pool.owns(buffer))
+        self.assertTrue(self.pool.owns(buffer[2:4]))
+        self.assertFalse(self.pool.owns(buffer.copy()))
+        self.assertFalse(self.pool.owns(np.zeros((8, 8, 1), dtype=np.float32)))
+        self.pool.clear()
+        self.assertFalse(self.pool.owns(buffer))
+
+
+class StagedResultTests(unittest.TestCase):
+    def test_single_tiles_after_a_batch_out_of_memory(self):
+        expected = pytorch_auto_split(_page(), _FakeDescriptor(torch.float32), CPU, False, MaxTileSize(48))  # type: ignore
+        model = _BatchOutOfMemoryDescriptor(torch.float32)
+        with cpu_staging():
+            result = pytorch_auto_split(_page(), model, CPU, False, MaxTileSize(48), tile_batch_size=4)  # type: ignore
+        np.testing.assert_allclose(result, expected, atol=1e-5)
+
+    def test_results_are_detached_from_the_staging_buffers(self):
+        model = _FakeDescriptor(torch.float32)
+        cases = [
+            # whole image, tiles, batched tiles and tiles blended on the device
+            {},
+            {"tiler": MaxTileSize(48)},
+            {"tiler": MaxTileSize(48), "tile_batch_size": 4},
+            {"tiler": MaxTileSize(48), "tile_batch_size": 4, "device_blend": True},
+        ]
+        for case in cases:
+            kwargs = dict(case)
+            tiler = kwargs.pop("tiler", MaxTileSize(256))
+            for dtype in (np.uint8, np.float32):
+                page = _page() if dtype == np.float32 else (_page() * 255).astype(np.uint8)
+                expected = pytorch_auto_split(page, model, CPU, False, tiler, **kwargs)  # type: ignore
+                with cpu_staging() as pool:
+                    result = pytorch_auto_split(page, model, CPU, False, tiler, **kwargs)  # type: ignore
+                    self.assertFalse(pool.owns(result), (case, dtype))
+                    # later uploads and downloads don't change it
+                    pytorch_auto_split(255 - page if dtype == np.uint8 else 1 - page, model, CPU, False, tiler, **kwargs)  # type: ignore
+                np.testing.assert_allclose(result, expected, atol=1e-5, err_msg=str((case, dtype)))
+
+    def test_batch_results_are_detached_from_the_staging_buffers(self):
+        pages = [_page(32, 32), 1 - _page(32, 32), _page(32, 32) / 2]
+        # in one batch, and one by one after running out of memory
+        for model in (_FakeDescriptor(torch.float32), _BatchOutOfMemoryDescriptor(torch.float32)):
+            expected = [pytorch_auto_split(page, model, CPU, False, MaxTileSize(256)) for page in pages]  # type: ignore
+            with cpu_staging() as pool:
+                results, _ = pytorch_batch_upscale(pages, model, CPU, False, MaxTileSize(256), 3)  # type: ignore
+                self.assertFalse(any(pool.owns(result) for result in results), type(model))
+            for result, reference in zip(results, expected):
+                np.testing.assert_allclose(result, reference, atol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+import unittest
+
+import numpy as np
+
+from inference_implementation.upscale.auto_split import Split, auto_split
+from inference_implementation.upscale.tile_blending import (
+    BlendDirection,
+    RowCollector,
+    RowSink,
+    StreamingTileBlender,
+    TileBlender,
+    TileOverlap,
+    _fast_mix,
+    get_blend_curve,
+    half_sin_blend_fn,
+)
+from inference_implementation.upscale.tiler import ExactTileSize, MaxTileSize
+
+
+def _upscale_2x(img: np.ndarray) -> np.ndarray:
+    return np.repeat(np.repeat(img, 2, axis=0), 2, axis=1) * 0.5
+
+
+class _RecordingSink(RowSink):
+    def __init__(self, events: list[str]):
+        self.events = events
+        self.rows: list[np.ndarray] = []
+
+    def begin(self, width, height, channels):
+        self.rows = []
+
+    def write(self, rows):
+        self.events.append("write")
+        self.rows.append(rows.copy())
+
+
+def _strips(img: np.ndarray, height: int, overlap: int) -> list[tuple[np.ndarray, TileOverlap]]:
+    strips = []
+    for y in range(0, img.shape[0], height):
+        top = min(overlap, y)
+        bottom = min(overlap, img.shape[0] - y - height)
+        bottom = max(bottom, 0)
+        strips.append((img[y - top : y + height + bottom], TileOverlap(top, bottom)))
+    return strips
+
+
+class StreamingTileBlenderTests(unittest.TestCase):
+    def _compare_with_tile_blender(self, img: np.ndarray):
+        h, w, c = img.shape
+        # perturb the strips, so that the overlaps actually have to be blended
+        rng = np.random.default_rng(1)
+        strips = []
+        for strip, overlap in _strips(img, 50, 12):
+            noise = rng.integers(0, 3, strip.shape) if img.dtype == np.uint8 else rng.random(strip.shape) * 0.1
+            strips.append(((strip + noise).astype(img.dtype), overlap))
+
+        expected = TileBlender(w, h, c, BlendDirection.Y, half_sin_blend_fn, dtype=img.dtype)
+        collector = RowCollector()
+        actual = StreamingTileBlender(w, h, c, collector, half_sin_blend_fn)
+        for strip, overlap in strips:
+            expected.add_tile(strip, overlap)
+            actual.add_tile(strip, overlap)
+        actual.finish()
+
+        np.testing.assert_array_equal(collector.get_result(), expected.get_result())
+
+    def test_same_result_as_tile_blender_float32(self):
+        self._compare_with_tile_blender(np.random.default_rng(0).random((230, 40, 1), dtype=np.float32))
+
+    def test_same_result_as_tile_blender_uint8(self):
+        self._compare_with_tile_blender(np.random.default_rng(0).integers(0, 250, (230, 40, 3), dtype=np.uint8))
+
+    def test_rows_are_emitted_before_the_last_strip(self):
+        img = np.random.default_rng(0).random((200, 30, 1), dtype=np.float32)
+        events: list[str] = []
+        sink = _RecordingSink(events)
+        blender = StreamingTileBlender(30, 200, 1, sink, half_sin_blend_fn)
+        for strip, overlap in _strips(img, 50, 8):
+            events.append("strip")
+            blender.add_tile(strip, overlap)
+        blender.finish()
+
+        self.assertEqual(events[:2], ["strip", "write"])
+        self.assertEqual(sum(rows.shape[0] for rows in sink.rows), 200)
+        np.testing.assert_allclose(np.concatenate(sink.rows), img, atol=1e-6)
+
+    def test_collector_stores_compact_dtypes(self):
+        img = np.random.default_rng(0).random((64, 16, 1), dtype=np.float32)
+        for dtype in (np.float16, np.uint8):
+            collector = RowCollector(dtype)
+            collector.begin(16, 64, 1)
+            collector.write(img[:20])
+            collector.write(img[20:])
+            result = collector.get_result()
+            self.assertEqual(result.dtype, dtype)
+            scale = 255 if dtype == np.uint8 else 1
+            np.testing.assert_allclose(result.astype(np.float32) / scale, img, atol=1 / 255)
+
+
+class BlendEngineTests(unittest.TestCase):
+    def test_blend_curves_are_shared_and_read_only(self):
+        curve = get_blend_curve(half_sin_blend_fn, 32)
+        self.assertIs(get_blend_curve(half_sin_blend_fn, 32), curve)
+        self.assertEqual(curve.shape, (32,))
+        self.assertFalse(curve.flags.writeable)
+
+    def test_in_place_mix_matches_the_reference(self):
+        rng = np.random.default_rng(0)
+        blend = get_blend_curve(half_sin_blend_fn, 24).reshape((1, 24, 1))
+        a = rng.random((40, 24, 3), dtype=np.float32)
+        b = rng.random((40, 24, 3), dtype=np.float32)
+        expected = a * (1 - blend) + b * blend
+
+        np.testing.assert_allclose(_fast_mix(a, b, blend), expected, atol=1e-6)
+        _fast_mix(a, b, blend, out=a)
+        np.testing.assert_allclose(a, expected, atol=1e-6)
+
+        a8 = rng.integers(0, 256, (40, 24, 3), dtype=np.uint8)
+        b8 = rng.integers(0, 256, (40, 24, 3), dtype=np.uint8)
+        expected8 = np.rint(a8 * (1 - blend) + b8 * blend)
+        _fast_mix(a8, b8, blend, out=b8)
+        np.testing.assert_array_equal(b8, expected8)
+
+
+class StreamingAutoSplitTests(unittest.TestCase):
+    def setUp(self):
+        self.img = np.random.default_rng(0).random((200, 150, 1), dtype=np.float32)
+
+    def test_row_sink_receives_the_whole_image(self):
+        events: list[str] = []
+        sink = _RecordingSink(events)
+
+        def upscale(tile, _):
+            events.append("tile")
+            return _upscale_2x(tile)
+
+        self.assertIsNone(auto_split(self.img, upscale, MaxTileSize(64), row_sink=sink))
+
+        # the first rows are written long before the last tile is upscaled
+        self.assertLess(events.index("write"), len(events) // 2)
+        np.testing.assert_allclose(np.concatenate(sink.rows), _upscale_2x(self.img), atol=1e-6)
+
+    def test_split_in_the_middle_of_the_image(self):
+        calls = []
+
+        def upscale(tile, _):
+            calls.append(tile.shape)
+            # the device "runs out of memory" once some rows are done already
+            if len(calls) == 12 and max(tile.shape[:2]) > 40:
+                return Split()
+            return _upscale_2x(tile)
+
+        result = auto_split(self.img, upscale, MaxTileSize(64))
+
+        self.assertGreater(len(calls), 12)
+        self.assertEqual(result.shape, (400, 300, 1))
+        np.testing.assert_allclose(result, _upscale_2x(self.img), atol=1e-6)
+
+    def test_exact_split_removes_padding_while_streaming(self):
+        small = self.img[:50, :40]
+        events: list[str] = []
+        sink = _RecordingSink(events)
+
+        auto_split(small, lambda tile, _: _upscale_2x(tile), ExactTileSize((64, 64)), row_sink=sink)
+
+        # padded single channel images lose their channel axis (like create_border does)
+        np.testing.assert_allclose(np.concatenate(sink.rows).reshape(100, 80, 1), _upscale_2x(small), atol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+import numpy as np
+
+from inference_implementation.upscale.tile_blending import BlendDirection
+from inference_implementation.upscale.tile_plan import exact_tile_plan, max_tile_plan
+
+
+def _coverage(plan) -> np.ndarray:
+    covered = np.zeros((plan.height, plan.width), dtype=np.int32)
+    for tile in plan.tiles:
+        r = tile.region
+        covered[r.y : r.y + r.height, r.x : r.x + r.width] += 1
+    return covered
+
+
+class TilePlanTests(unittest.TestCase):
+    def test_plans_are_cached_and_hashable(self):
+        plan = max_tile_plan(1720, 2420, (512, 512), 16)
+        self.assertIs(max_tile_plan(1720, 2420, (512, 512), 16), plan)
+        self.assertEqual({plan: 1}[max_tile_plan(1720, 2420, (512, 512), 16)], 1)
+        self.assertIsNot(max_tile_plan(1720, 2420, (256, 256), 16), plan)
+
+    def test_max_plan_covers_the_image_once(self):
+        plan = max_tile_plan(1720, 2420, (512, 512), 16)
+        self.assertEqual(plan.tile_count, (4, 5))
+        np.testing.assert_array_equal(_coverage(plan), 1)
+        for tile in plan.tiles:
+            padded = tile.padded
+            self.assertGreaterEqual(padded.x, 0)
+            self.assertLessEqual(padded.x + padded.width, plan.width)
+            self.assertLessEqual(max(tile.padding.top, tile.padding.left), 16)
+
+    def test_max_plan_can_start_below_the_top(self):
+        plan = max_tile_plan(300, 400, (64, 64), 16, start_y=150)
+        self.assertEqual(plan.rows[0][0].region.y, 150)
+        self.assertEqual(plan.rows[0][0].padding.top, 16)
+        self.assertEqual(sum(row[0].region.height for row in plan.rows), 250)
+
+    def test_exact_plan_has_exactly_sized_tiles(self):
+        plan = exact_tile_plan(300, 200, (64, 64), 16)
+        self.assertTrue(plan.exact)
+        self.assertEqual(plan.padded_sizes, ((64, 64),))
+        np.testing.assert_array_equal(_coverage(plan), 1)
+
+    def test_seams(self):
+        plan = max_tile_plan(200, 100, (100, 50), 8)
+        seams = plan.seams(scale=2)
+        self.assertEqual(
+            [(s.direction, s.row, s.offset, s.blend_size) for s in seams],
+            [
+                (BlendDirection.X, 0, 200, 32),
+                (BlendDirection.Y, 1, 100, 32),
+                (BlendDirection.X, 1, 200, 32),
+            ],
+        )
+        self.assertIn("2x2 tiles", plan.describe())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from inference_implementation.upscale.auto_split import Split, auto_split
+from inference_implementation.upscale.tile_size_memory import TileSizeMemory
+from inference_implementation.upscale.tiler import LearnedTileSize
+
+
+def _upscale_below(limit: int):
+    """An identity "model" that runs out of memory for tiles larger than `limit`."""
+    failures = []
+
+    def upscale(img: np.ndarray, _: object):
+        if max(img.shape[:2]) > limit:
+            failures.append(img.shape[:2])
+            return Split()
+        return img
+
+    return upscale, failures
+
+
+class LearnedTileSizeTests(unittest.TestCase):
+    def test_later_images_start_at_the_reduced_tile_size(self):
+        img = np.zeros((300, 200, 1), dtype=np.float32)
+        upscale, failures = _upscale_below(100)
+        tiler = LearnedTileSize()
+
+        auto_split(img, upscale, tiler)
+        self.assertTrue(tiler.did_split)
+        self.assertGreater(len(failures), 0)
+        learned = tiler.tile_size
+
+        failures.clear()
+        auto_split(img, upscale, tiler)
+        # no failed attempts the second time
+        self.assertEqual(failures, [])
+        self.assertEqual(tiler.tile_size, learned)
+
+
+class TileSizeMemoryTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "tile_sizes.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_pages_of_similar_size_share_a_bucket(self):
+        memory = TileSizeMemory(bucket=256)
+        a = memory.key_for("hash", "cuda:0", "torch.float16", 1700, 2420, 1)
+        b = memory.key_for("hash", "cuda:0", "torch.float16", 1650, 2400, 1)
+        c = memory.key_for("hash", "cuda:0", "torch.float32", 1650, 2400, 1)
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_tile_sizes_persist_across_instances(self):
+        memory = TileSizeMemory(self.path)
+        key = memory.key_for("hash", "cuda:0", "torch.float16", 1700, 2420, 1)
+        self.assertIsNone(memory.get(key))
+        memory.record(key, 512)
+
+        other = TileSizeMemory(self.path)
+        self.assertEqual(other.get(key), 512)
+        self.assertEqual(other.tiler_for(key).tile_size, 512)
+        self.assertEqual(len(other.entries()), 1)
+
+    def test_concurrent_writers_are_merged(self):
+        first = TileSizeMemory(self.path)
+        second = TileSizeMemory(self.path)
+        a = first.key_for("a", "cuda:0", "torch.float16", 1700, 2420, 1)
+        b = second.key_for("b", "cuda:0", "torch.float16", 1700, 2420, 1)
+        first.record(a, 512)
+        second.record(b, 256)
+
+        self.assertEqual(TileSizeMemory(self.path).get(a), 512)
+        self.assertEqual(TileSizeMemory(self.path).get(b), 256)
+
+    def test_unsplit_small_pages_do_not_shrink_the_bucket(self):
+        memory = TileSizeMemory()
+        key = memory.key_for("hash", "cpu", "torch.float32", 300, 300, 1)
+        memory.record(key, 310)
+
+        tiler = memory.tiler_for(key)
+        tiler.starting_tile_size(260, 260, 1)
+        memory.remember(key, tiler)
+        self.assertEqual(memory.get(key), 310)
+
+    def test_unreadable_file_is_ignored(self):
+        with open(self.path, "w") as f:
+            f.write("not json")
+        self.assertEqual(TileSizeMemory(self.path).entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
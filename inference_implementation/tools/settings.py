@@ -1,8 +1,26 @@
+import os
 from dataclasses import dataclass
+from enum import Enum
 
 import torch
 from sanic.log import logger
 
+
+class Precision(Enum):
+    FP32 = "fp32"
+    FP16 = "fp16"
+    BF16 = "bf16"
+    AUTO = "auto"
+
+
+class CompileMode(Enum):
+    OFF = "off"
+    # torch.compile with the default (inductor) backend
+    COMPILE = "compile"
+    # torch.compile with CUDA graphs on CUDA devices, plain torch.compile everywhere else
+    CUDA_GRAPHS = "cudagraphs"
+
+
 @dataclass(frozen=True)
 class PyTorchSettings:
     use_cpu: bool
@@ -10,12 +28,20 @@ class PyTorchSettings:
     gpu_index: int
     budget_limit: int
     force_cache_wipe: bool = False
+    precision: Precision = Precision.FP32
+    compile_mode: CompileMode = CompileMode.OFF
 
     # PyTorch 2.0 does not support FP16 when using CPU
     def __post_init__(self):
         if self.use_cpu and self.use_fp16:
             object.__setattr__(self, "use_fp16", False)
             logger.info("Falling back to FP32 mode.")
+        if self.use_fp16 and self.precision == Precision.FP32:
+            # the legacy flag still selects half precision
+            object.__setattr__(self, "precision", Precision.FP16)
+        if self.use_cpu and self.precision == Precision.FP16:
+            object.__setattr__(self, "precision", Precision.FP32)
+            logger.info("Falling back to FP32 mode.")
 
     @property
     def device(self) -> torch.device:
@@ -51,9 +77,11 @@ def get_settings() -> PyTorchSettings:
     #     force_cache_wipe=settings.get_bool("force_cache_wipe", False),
     # )
     return PyTorchSettings(
-        use_cpu=False,
+        use_cpu=os.environ.get("INFERENCE_USE_CPU", "false").lower() in ("1", "true", "yes"),
         use_fp16=False,
         gpu_index=0,
         budget_limit=0,
         force_cache_wipe=False,
+        precision=Precision(os.environ.get("INFERENCE_PRECISION", Precision.AUTO.value)),
+        compile_mode=CompileMode(os.environ.get("INFERENCE_COMPILE", CompileMode.OFF.value)),
     )
@@ -9,6 +9,8 @@ from sanic.log import logger
 from spandrel import ImageModelDescriptor, ModelTiling
 
 from ..pytorch.auto_split import pytorch_auto_split
+from ..pytorch.memory_profile import get_resident_profile
+from ..pytorch.precision import get_inference_dtype
 from ..upscale.auto_split_tiles import (
     NO_TILING,
     TileSize,
@@ -31,9 +33,9 @@ def upscale(
         # Borrowed from iNNfer
         logger.debug("Upscaling image")
 
-        # TODO: use bfloat16 if RTX
-        use_fp16 = options.use_fp16 and model.supports_half
         device = options.device
+        dtype = get_inference_dtype(options.precision, model, device)
+        use_fp16 = dtype == torch.float16
 
         if model.tiling == ModelTiling.INTERNAL:
             # disable tiling if the model already does it internally
@@ -45,8 +47,12 @@ def upscale(
                 model_bytes = sum(p.numel() * 4 for p in model.model.parameters())
                 MODEL_BYTES_CACHE[model] = model_bytes
 
+            profile = get_resident_profile(model)
+            if profile is not None and profile.dtype != str(dtype):
+                profile = None
+
             if "cuda" in device.type:
-                if options.use_fp16:
+                if dtype != torch.float32:
                     model_bytes = model_bytes // 2
                 mem_info: tuple[int, int] = torch.cuda.mem_get_info(device)  # type: ignore
                 _free, total = mem_info
@@ -62,7 +68,8 @@ def upscale(
                         budget,
                         model_bytes,
                         img,
-                        2 if use_fp16 else 4,
+                        dtype.itemsize,
+                        profile,
                     )
                 )
             elif device.type == "cpu":
@@ -76,6 +83,7 @@ def upscale(
                         model_bytes,
                         img,
                         4,
+                        profile,
                     )
                 )
             return MaxTileSize()
@@ -86,6 +94,7 @@ def upscale(
             device=device,
             use_fp16=use_fp16,
             tiler=parse_tile_size_input(tile_size, estimate),
+            dtype=dtype,
             # progress=progress,
         )
         logger.debug("Done upscaling")
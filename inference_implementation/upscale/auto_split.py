@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import math
 from typing import Callable, Union
 
 import numpy as np
@@ -8,7 +7,16 @@ from sanic.log import logger
 
 from ..tools.utils import Region, Size, get_h_w_c
 from .exact_split import exact_split
-from .tile_blending import BlendDirection, TileBlender, TileOverlap, half_sin_blend_fn
+from .tile_blending import (
+    BlendDirection,
+    RowCollector,
+    RowSink,
+    StreamingTileBlender,
+    TileBlender,
+    TileOverlap,
+    half_sin_blend_fn,
+)
+from .tile_plan import TilePlan, max_tile_plan
 from .tiler import Tiler
 
 
@@ -17,6 +25,7 @@ class Split:
 
 
 SplitImageOp = Callable[[np.ndarray, Region], Union[np.ndarray, Split]]
+SplitBatchOp = Callable[[list[np.ndarray], list[Region]], Union[list[np.ndarray], Split]]
 
 
 def auto_split(
@@ -24,7 +33,11 @@ def auto_split(
     upscale: SplitImageOp,
     tiler: Tiler,
     overlap: int = 16,
-) -> np.ndarray:
+    upscale_batch: SplitBatchOp | None = None,
+    batch_size: int = 1,
+    row_sink: RowSink | None = None,
+    result_dtype: np.dtype | type | None = None,
+) -> np.ndarray | None:
     """
     Splits the image into tiles according to the given tiler.
 
@@ -37,18 +50,64 @@ def auto_split(
 
     If the given tiler allows smaller tile sizes, then it is guaranteed that no padding will be added.
     Otherwise, no padding is only guaranteed if the starting tile size is not larger than the size of the given image.
+
+    ## Batching
+
+    If `upscale_batch` is given and `batch_size` is larger than 1, the whole tile plan is cut up front,
+    and tiles of the same (padded) size are upscaled together, up to `batch_size` at a time.
+    If a batch requests a split, the batch size is halved first. Only if a single tile requests a split,
+    the tile size is lowered. Tiles are blended in the same order and way as without batching.
+
+    ## Streaming
+
+    Tiles are blended into rows, and rows are blended into the result from top to bottom.
+    If `row_sink` is given, the rows of the result are handed to it as soon as they are final
+    (e.g. to encode them right away) and None is returned. Otherwise, they are collected into
+    the returned image, stored as `result_dtype` (see `RowCollector`) if it is given.
     """
 
     h, w, c = get_h_w_c(img)
-    split = _max_split if tiler.allow_smaller_tile_size() else _exact_split
-
-    return split(
-        img,
-        upscale=upscale,
-        starting_tile_size=tiler.starting_tile_size(w, h, c),
-        split_tile_size=tiler.split,
-        overlap=overlap,
-    )
+    starting_tile_size = tiler.starting_tile_size(w, h, c)
+    sink = row_sink if row_sink is not None else RowCollector(result_dtype)
+
+    if upscale_batch is not None and batch_size > 1:
+        if tiler.allow_smaller_tile_size():
+            _max_split_batched(
+                img,
+                upscale=upscale,
+                upscale_batch=upscale_batch,
+                batch_size=batch_size,
+                starting_tile_size=starting_tile_size,
+                split_tile_size=tiler.split,
+                overlap=overlap,
+                sink=sink,
+            )
+        else:
+            _exact_split(
+                img,
+                upscale=upscale,
+                starting_tile_size=starting_tile_size,
+                split_tile_size=tiler.split,
+                overlap=overlap,
+                sink=sink,
+                upscale_batch=upscale_batch,
+                batch_size=batch_size,
+            )
+    else:
+        split = _max_split if tiler.allow_smaller_tile_size() else _exact_split
+        split(
+            img,
+            upscale=upscale,
+            starting_tile_size=starting_tile_size,
+            split_tile_size=tiler.split,
+            overlap=overlap,
+            sink=sink,
+        )
+
+    if row_sink is not None:
+        return None
+    assert isinstance(sink, RowCollector)
+    return sink.get_result()
 
 
 class _SplitEx(Exception):
@@ -61,7 +120,10 @@ def _exact_split(
     starting_tile_size: Size,
     split_tile_size: Callable[[Size], Size],
     overlap: int,
-) -> np.ndarray:
+    sink: RowSink,
+    upscale_batch: SplitBatchOp | None = None,
+    batch_size: int = 1,
+) -> None:
     h, w, c = get_h_w_c(img)
     logger.debug(
         f"Exact size split image ({w}x{h}px @ {c}) with exact tile size {starting_tile_size[0]}x{starting_tile_size[1]}px."
@@ -73,17 +135,29 @@ def _exact_split(
             raise _SplitEx
         return result
 
+    no_split_upscale_batch = None
+    if upscale_batch is not None:
+
+        def no_split_upscale_batch(tiles: list[np.ndarray], regions: list[Region]) -> list[np.ndarray] | None:
+            # None asks exact_split for a smaller batch, a single tile goes through no_split_upscale
+            result = upscale_batch(tiles, regions)
+            return None if isinstance(result, Split) else result
+
     MAX_ITER = 20  # noqa: N806
 
     for _ in range(MAX_ITER):
         try:
             max_overlap = min(*starting_tile_size) // 4
-            return exact_split(
+            exact_split(
                 img=img,
                 exact_size=starting_tile_size,
                 upscale=no_split_upscale,
                 overlap=min(max_overlap, overlap),
+                upscale_batch=no_split_upscale_batch,
+                batch_size=batch_size,
+                row_sink=sink,
             )
+            return
         except _SplitEx:
             starting_tile_size = split_tile_size(starting_tile_size)
 
@@ -96,7 +170,8 @@ def _max_split(
     starting_tile_size: Size,
     split_tile_size: Callable[[Size], Size],
     overlap: int,
-) -> np.ndarray:
+    sink: RowSink,
+) -> None:
     """
     Splits the image into tiles with at most the given tile size.
 
@@ -116,79 +191,54 @@ def _max_split(
         # the image might be small enough so that we don't have to split at all
         upscale_result = upscale(img, img_region)
         if not isinstance(upscale_result, Split):
-            return upscale_result
+            sink.write_image(upscale_result)
+            return
 
         # the image was too large
         max_tile_size = split_tile_size(max_tile_size)
 
-        logger.warn(
+        logger.warning(
             f"Unable to upscale the whole image at once. Reduced tile size to {max_tile_size}."
         )
 
     # The upscale method is allowed to request splits at any time.
-    # When a split occurs, we have to "restart" the loop and
-    # this variable allow us to split the already processed tiles.
+    # When a split occurs, we have to "restart" the loop. Rows that were already
+    # added to the result are final, so only the rest of the image is split again,
+    # starting at this pixel row.
     start_y = 0
 
     # To allocate the result image, we need to know the upscale factor first,
     # and we only get to know this factor after the first successful upscale.
-    result: TileBlender | None = None
+    result: StreamingTileBlender | None = None
     scale: int = 0
     out_channels: int = 0
+    out_dtype: np.dtype = np.dtype(np.float32)
 
     restart = True
     while restart:
         restart = False
 
-        # This is a bit complex.
-        # We don't actually use the current tile size to partition the image.
-        # If we did, then tile_size=1024 and w=1200 would result in very uneven tiles.
-        # Instead, we use tile_size to calculate how many tiles we get in the x and y direction
-        # and then calculate the optimal tile size for the x and y direction using the counts.
-        # This yields optimal tile sizes which should prevent unnecessary splitting.
-        tile_count_x = math.ceil(w / max_tile_size[0])
-        tile_count_y = math.ceil(h / max_tile_size[1])
-        tile_size_x = math.ceil(w / tile_count_x)
-        tile_size_y = math.ceil(h / tile_count_y)
-
-        logger.debug(
-            f"Currently {tile_count_x}x{tile_count_y} tiles each {tile_size_x}x{tile_size_y}px."
-        )
-
-        prev_row_result: TileBlender | None = None
-
-        for y in range(tile_count_y):
-            if y < start_y:
-                continue
+        # pages of the same size share their plan
+        plan = max_tile_plan(w, h, max_tile_size, overlap, start_y)
+        _log_plan(plan)
 
+        for row in plan.rows:
             row_result: TileBlender | None = None
             row_overlap: TileOverlap | None = None
 
-            for x in range(tile_count_x):
-                tile = Region(
-                    x * tile_size_x, y * tile_size_y, tile_size_x, tile_size_y
-                ).intersect(img_region)
-                pad = img_region.child_padding(tile).min(overlap)
-                padded_tile = tile.add_padding(pad)
+            for tile in row:
+                padded_tile = tile.padded
 
                 upscale_result = upscale(padded_tile.read_from(img), padded_tile)
 
                 if isinstance(upscale_result, Split):
                     max_tile_size = split_tile_size(max_tile_size)
-
-                    new_tile_count_y = math.ceil(h / max_tile_size[1])
-                    new_tile_size_y = math.ceil(h / new_tile_count_y)
-                    start_y = (y * tile_size_x) // new_tile_size_y
+                    start_y = tile.region.y
 
                     logger.debug(
-                        f"Split occurred. New tile size is {max_tile_size}. Starting at row {start_y}."
+                        f"Split occurred. New tile size is {max_tile_size}. Continuing at pixel row {start_y}."
                     )
 
-                    # reset result
-                    if result is not None:
-                        # we already added at least one row, so we have to set the offset back
-                        result.offset = start_y * new_tile_size_y
-
                     restart = True
                     break
 
@@ -203,23 +253,21 @@ def _max_split(
                     # allocate the result image
                     scale = current_scale
                     out_channels = up_c
+                    out_dtype = upscale_result.dtype
                     row_result = TileBlender(
                         width=w * scale,
                         height=padded_tile.height * scale,
                         channels=out_channels,
                         direction=BlendDirection.X,
                         blend_fn=half_sin_blend_fn,
-                        _prev=prev_row_result,
+                        dtype=out_dtype,
                     )
-                    prev_row_result = row_result
-                    row_overlap = TileOverlap(pad.top * scale, pad.bottom * scale)
+                    row_overlap = tile.overlap_y(scale)
 
                 assert current_scale == scale
 
                 # add to row
-                row_result.add_tile(
-                    upscale_result, TileOverlap(pad.left * scale, pad.right * scale)
-                )
+                row_result.add_tile(upscale_result, tile.overlap_x(scale))
 
             if restart:
                 break
@@ -228,11 +276,11 @@ def _max_split(
             assert row_overlap is not None
 
             if result is None:
-                result = TileBlender(
+                result = StreamingTileBlender(
                     width=w * scale,
                     height=h * scale,
                     channels=out_channels,
-                    direction=BlendDirection.Y,
+                    sink=sink,
                     blend_fn=half_sin_blend_fn,
                 )
 
@@ -240,4 +288,147 @@ def _max_split(
             result.add_tile(row_result.get_result(), row_overlap)
 
     assert result is not None
-    return result.get_result()
+    result.finish()
+
+
+def _log_plan(plan: TilePlan) -> None:
+    count_x, count_y = plan.tile_count
+    tile_w, tile_h = plan.rows[0][0].region.size
+    logger.debug(f"Currently {count_x}x{count_y} tiles each {tile_w}x{tile_h}px.")
+
+
+def _upscale_tiles_batched(
+    img: np.ndarray,
+    tiles: list[Region],
+    upscale: SplitImageOp,
+    upscale_batch: SplitBatchOp,
+    batch_size: int,
+) -> tuple[list[np.ndarray] | Split, int]:
+    """
+    Upscales the given tiles, batching tiles of the same size.
+
+    Returns the upscaled tiles (in the given order), or `Split` if a single tile requested a split,
+    and the last batch size that worked.
+    """
+    groups: dict[Size, list[int]] = {}
+    for index, tile in enumerate(tiles):
+        groups.setdefault(tile.size, []).append(index)
+
+    results: list[np.ndarray | None] = [None] * len(tiles)
+    for indexes in groups.values():
+        start = 0
+        while start < len(indexes):
+            chunk = indexes[start : start + batch_size]
+            if len(chunk) == 1:
+                single = upscale(tiles[chunk[0]].read_from(img), tiles[chunk[0]])
+                if isinstance(single, Split):
+                    return Split(), batch_size
+                # the result may be a view of a staging buffer that the next tile of the same size
+                # is downloaded into, and the tiles are only blended once all of them are upscaled
+                batch_result = [np.array(single, copy=True)]
+            else:
+                batch_result = upscale_batch(
+                    [tiles[i].read_from(img) for i in chunk], [tiles[i] for i in chunk]
+                )
+                if isinstance(batch_result, Split):
+                    batch_size = max(1, batch_size // 2)
+                    logger.debug(f"Tile batch did not fit. Reduced batch size to {batch_size}.")
+                    continue
+
+            for index, tile_result in zip(chunk, batch_result):
+                results[index] = tile_result
+            start += len(chunk)
+
+    return results, batch_size  # type: ignore
+
+
+def _max_split_batched(
+    img: np.ndarray,
+    upscale: SplitImageOp,
+    upscale_batch: SplitBatchOp,
+    batch_size: int,
+    starting_tile_size: Size,
+    split_tile_size: Callable[[Size], Size],
+    overlap: int,
+    sink: RowSink,
+) -> None:
+    """
+    Like `_max_split`, but the tiles of the whole image are upscaled in batches before blending.
+
+    If a batch requests a split, the batch size is halved. The tile size is only lowered
+    if a single tile requests a split.
+    """
+
+    h, w, c = get_h_w_c(img)
+
+    max_tile_size = starting_tile_size
+    logger.debug(
+        f"Auto split image ({w}x{h}px @ {c}) with initial tile size {max_tile_size}, in batches of {batch_size}."
+    )
+
+    if w <= max_tile_size[0] and h <= max_tile_size[1]:
+        # the image might be small enough so that we don't have to split at all
+        upscale_result = upscale(img, Region(0, 0, w, h))
+        if not isinstance(upscale_result, Split):
+            sink.write_image(upscale_result)
+            return
+
+        # the image was too large
+        max_tile_size = split_tile_size(max_tile_size)
+
+        logger.warning(
+            f"Unable to upscale the whole image at once. Reduced tile size to {max_tile_size}."
+        )
+
+    while True:
+        plan = max_tile_plan(w, h, max_tile_size, overlap)
+        _log_plan(plan)
+        tiles = [tile.padded for tile in plan.tiles]
+        tile_results, batch_size = _upscale_tiles_batched(
+            img, tiles, upscale, upscale_batch, batch_size
+        )
+        if not isinstance(tile_results, Split):
+            break
+
+        max_tile_size = split_tile_size(max_tile_size)
+        logger.debug(f"Split occurred. New tile size is {max_tile_size}.")
+
+    # blend the tiles in the same order as _max_split
+    first_h, first_w, out_channels = get_h_w_c(tile_results[0])
+    scale = first_h // tiles[0].height
+    assert scale > 0
+    out_dtype = tile_results[0].dtype
+
+    result = StreamingTileBlender(
+        width=w * scale,
+        height=h * scale,
+        channels=out_channels,
+        sink=sink,
+        blend_fn=half_sin_blend_fn,
+    )
+    tile_index = 0
+    for y, row in enumerate(plan.rows):
+        row_height = row[0].padded.height
+        row_result = TileBlender(
+            width=w * scale,
+            height=row_height * scale,
+            channels=out_channels,
+            direction=BlendDirection.X,
+            blend_fn=half_sin_blend_fn,
+            dtype=out_dtype,
+        )
+
+        for tile in row:
+            padded_tile = tile.padded
+            upscale_result = tile_results[tile_index]
+            # blended tiles are dropped right away, so that they don't outlive their row
+            tile_results[tile_index] = None  # type: ignore
+            tile_index += 1
+            up_h, up_w, _ = get_h_w_c(upscale_result)
+            assert padded_tile.height * scale == up_h
+            assert padded_tile.width * scale == up_w
+            row_result.add_tile(upscale_result, tile.overlap_x(scale))
+
+        result.add_tile(row_result.get_result(), plan.row_overlap(y, scale))
+
+    result.finish()
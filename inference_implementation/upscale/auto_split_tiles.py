@@ -1,4 +1,6 @@
-from typing import Callable, NewType
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable, NewType
 
 import numpy as np
 from sanic.log import logger
@@ -6,6 +8,9 @@ from sanic.log import logger
 from ..tools.utils import get_h_w_c
 from .tiler import MaxTileSize, NoTiling, Tiler
 
+if TYPE_CHECKING:
+    from ..pytorch.memory_profile import MemoryProfile
+
 GB_AMT = 1024**3
 
 
@@ -14,7 +19,17 @@ def estimate_tile_size(
     model_size: int,
     img: np.ndarray,
     img_element_size: int = 4,
+    profile: MemoryProfile | None = None,
 ) -> int:
+    if profile is not None:
+        # the calibrated profile knows the actual memory usage of the model
+        tile_size = profile.tile_size_for(budget)
+        logger.debug(
+            f"Estimating tile size from memory profile: {profile.bytes_per_pixel:.0f} bytes per pixel,"
+            f" {budget/GB_AMT:.2f} GB free. Estimated tile size: {tile_size}"
+        )
+        return tile_size
+
     h, w, c = get_h_w_c(img)
     img_bytes = h * w * c * img_element_size
     mem_required_estimation = (model_size / (1024 * 52)) * img_bytes
@@ -1,15 +1,23 @@
 from __future__ import annotations
 
 import math
-from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Iterator, Optional
 
 import numpy as np
 from sanic.log import logger
 
 from ..tools.utils import Padding, Region, Size, get_h_w_c
 from ..tools.image_utils import BorderType, create_border
-from .tile_blending import BlendDirection, TileBlender, TileOverlap, half_sin_blend_fn
+from .tile_blending import (
+    BlendDirection,
+    RowCollector,
+    RowSink,
+    StreamingTileBlender,
+    TileBlender,
+    TileOverlap,
+    half_sin_blend_fn,
+)
+from .tile_plan import exact_tile_plan
 
 
 def _pad_image(img: np.ndarray, min_size: Size):
@@ -24,102 +32,36 @@ def _pad_image(img: np.ndarray, min_size: Size):
     return create_border(img, BorderType.REFLECT_MIRROR, padding), padding
 
 
-@dataclass
-class _Segment:
-    start: int
-    end: int
-    start_padding: int
-    end_padding: int
+UpscaleBatch = Callable[[list[np.ndarray], list[Region]], Optional[list[np.ndarray]]]
 
-    @property
-    def length(self) -> int:
-        return self.end - self.start
 
-    @property
-    def padded_length(self) -> int:
-        return self.end + self.end_padding - (self.start - self.start_padding)
-
-
-def _exact_split_into_segments(length: int, exact: int, overlap: int) -> list[_Segment]:
-    """
-    Splits the given length into segments of `exact` (padded) length.
-    Segments will overlap into each other with at least the given overlap.
+def _upscale_batched(
+    img: np.ndarray,
+    tiles: list[Region],
+    upscale: Callable[[np.ndarray, Region], np.ndarray],
+    upscale_batch: UpscaleBatch,
+    batch_size: int,
+) -> Iterator[np.ndarray]:
     """
-    if length == exact:
-        # trivial
-        return [_Segment(0, exact, 0, 0)]
-
-    assert length > exact
-    assert exact > overlap * 2
-
-    result: list[_Segment] = []
-
-    def add(s: _Segment):
-        assert s.padded_length == exact
-        result.append(s)
-
-    # The current strategy is to go from left to right and to align segments
-    # such that we use the least overlap possible. The last segment will then
-    # be the smallest with potentially a lot of overlap.
-    # While this is easy to implement, it's actually not ideal. Ideally, we
-    # would want for the overlap to be distributed evenly between segments.
-    # However, this is complex to implement and the current method also works.
-
-    # we know that the first segment looks like this
-    add(_Segment(0, exact - overlap, 0, overlap))
+    Upscales the given tiles (which all have the same size) in batches of at most `batch_size`.
 
-    while result[-1].end < length:
-        start_padding = overlap
-        start = result[-1].end
-        end = start + exact - overlap * 2
-        end_padding = overlap
-
-        if end + end_padding >= length:
-            # last segment
-            end_padding = 0
-            end = length
-            start_padding = exact - (end - start)
-
-        add(_Segment(start, end, start_padding, end_padding))
-
-    return result
-
-
-def _exact_split_into_regions(
-    w: int,
-    h: int,
-    exact_w: int,
-    exact_h: int,
-    overlap: int,
-) -> list[list[tuple[Region, Padding]]]:
-    """
-    Returns a list of disjoint regions along with padding.
-    Each region plus its padding is guaranteed to have the given exact size.
-    The padding (if not zero) is guaranteed to be at least the given overlap value.
+    If `upscale_batch` returns None, the batch was too large and the batch size is halved.
+    Single tiles are passed to `upscale`.
     """
-
-    # we can split x and y independently from each other and then combine the results
-    x_segments = _exact_split_into_segments(w, exact_w, overlap)
-    y_segments = _exact_split_into_segments(h, exact_h, overlap)
-
-    logger.info(
-        f"Image is split into {len(x_segments)}x{len(y_segments)} tiles each exactly {exact_w}x{exact_h}px."
-    )
-
-    result: list[list[tuple[Region, Padding]]] = []
-    for y in y_segments:
-        row: list[tuple[Region, Padding]] = []
-        for x in x_segments:
-            row.append(
-                (
-                    Region(x.start, y.start, x.length, y.length),
-                    Padding(
-                        y.start_padding, x.end_padding, y.end_padding, x.start_padding
-                    ),
-                )
-            )
-        result.append(row)
-    return result
+    start = 0
+    while start < len(tiles):
+        chunk = tiles[start : start + batch_size]
+        if len(chunk) == 1:
+            batch_result = [upscale(chunk[0].read_from(img), chunk[0])]
+        else:
+            batch_result = upscale_batch([tile.read_from(img) for tile in chunk], chunk)
+            if batch_result is None:
+                batch_size = max(1, batch_size // 2)
+                logger.debug(f"Tile batch did not fit. Reduced batch size to {batch_size}.")
+                continue
+
+        yield from batch_result
+        start += len(chunk)
 
 
 def _exact_split_without_padding(
@@ -127,30 +69,55 @@ def _exact_split_without_padding(
     exact_size: Size,
     upscale: Callable[[np.ndarray, Region], np.ndarray],
     overlap: int,
-) -> np.ndarray:
+    sink: RowSink,
+    upscale_batch: UpscaleBatch | None = None,
+    batch_size: int = 1,
+) -> None:
     h, w, _ = get_h_w_c(img)
     exact_w, exact_h = exact_size
     assert w >= exact_w and h >= exact_h
 
     if (w, h) == exact_size:
-        return upscale(img, Region(0, 0, w, h))
+        sink.write_image(upscale(img, Region(0, 0, w, h)))
+        return
 
     # To allocate the result image, we need to know the upscale factor first,
     # and we only get to know this factor after the first successful upscale.
-    result: TileBlender | None = None
+    result: StreamingTileBlender | None = None
     scale: int = 0
     out_channels: int = 0
+    out_dtype: np.dtype = np.dtype(np.float32)
 
-    regions = _exact_split_into_regions(w, h, exact_w, exact_h, overlap)
-    for row in regions:
+    # pages of the same size share their plan
+    plan = exact_tile_plan(w, h, exact_size, overlap)
+    count_x, count_y = plan.tile_count
+    logger.info(
+        f"Image is split into {count_x}x{count_y} tiles each exactly {exact_w}x{exact_h}px."
+    )
+
+    batched_results: Iterator[np.ndarray] | None = None
+    if upscale_batch is not None and batch_size > 1:
+        # all tiles have the same size, so they are upscaled in batches and blended as they come in
+        batched_results = _upscale_batched(
+            img,
+            [tile.padded for tile in plan.tiles],
+            upscale,
+            upscale_batch,
+            batch_size,
+        )
+
+    for row in plan.rows:
         row_result: TileBlender | None = None
         row_overlap: TileOverlap | None = None
 
-        for tile, pad in row:
-            padded_tile = tile.add_padding(pad)
+        for tile in row:
+            padded_tile = tile.padded
             assert padded_tile.size == exact_size
 
-            upscale_result = upscale(padded_tile.read_from(img), padded_tile)
+            if batched_results is not None:
+                upscale_result = next(batched_results)
+            else:
+                upscale_result = upscale(padded_tile.read_from(img), padded_tile)
 
             # figure out by how much the image was upscaled by
             up_h, up_w, up_c = get_h_w_c(upscale_result)
@@ -163,38 +130,75 @@ def _exact_split_without_padding(
                 # allocate the result image
                 scale = current_scale
                 out_channels = up_c
+                out_dtype = upscale_result.dtype
                 row_result = TileBlender(
                     width=w * scale,
                     height=exact_h * scale,
                     channels=out_channels,
                     direction=BlendDirection.X,
                     blend_fn=half_sin_blend_fn,
+                    dtype=out_dtype,
                 )
-                row_overlap = TileOverlap(pad.top * scale, pad.bottom * scale)
+                row_overlap = tile.overlap_y(scale)
 
             assert current_scale == scale
 
-            row_result.add_tile(
-                upscale_result, TileOverlap(pad.left * scale, pad.right * scale)
-            )
+            row_result.add_tile(upscale_result, tile.overlap_x(scale))
 
         assert row_result is not None
         assert row_overlap is not None
         if result is None:
-            result = TileBlender(
+            result = StreamingTileBlender(
                 width=w * scale,
                 height=h * scale,
                 channels=out_channels,
-                direction=BlendDirection.Y,
+                sink=sink,
                 blend_fn=half_sin_blend_fn,
             )
 
         result.add_tile(row_result.get_result(), row_overlap)
 
     assert result is not None
+    result.finish()
 
-    # remove initially added padding
-    return result.get_result()
+
+class _CroppingRowSink(RowSink):
+    """
+    Removes the padding `exact_split` added to the image (at the scale of the result) before
+    passing the rows on.
+    """
+
+    def __init__(self, sink: RowSink, padding: Padding, height: int) -> None:
+        self.sink: RowSink = sink
+        self.padding: Padding = padding
+        # height of the padded image, to figure out the scale
+        self.padded_height: int = height
+        self.scale: int = 0
+        self.width: int = 0
+        self.height: int = 0
+        self.row: int = 0
+
+    def begin(self, width: int, height: int, channels: int) -> None:
+        p = self.padding
+        self.scale = height // self.padded_height
+        self.width = width
+        self.height = height
+        self.row = 0
+        self.sink.begin(
+            width - (p.left + p.right) * self.scale,
+            height - (p.top + p.bottom) * self.scale,
+            channels,
+        )
+
+    def write(self, rows: np.ndarray) -> None:
+        p = self.padding
+        first = max(self.row, p.top * self.scale)
+        last = min(self.row + rows.shape[0], self.height - p.bottom * self.scale)
+        if first < last:
+            self.sink.write(
+                rows[first - self.row : last - self.row, p.left * self.scale : self.width - p.right * self.scale, ...]
+            )
+        self.row += rows.shape[0]
 
 
 def exact_split(
@@ -202,24 +206,37 @@ def exact_split(
     exact_size: Size,
     upscale: Callable[[np.ndarray, Region], np.ndarray],
     overlap: int = 16,
-) -> np.ndarray:
+    upscale_batch: UpscaleBatch | None = None,
+    batch_size: int = 1,
+    row_sink: RowSink | None = None,
+) -> np.ndarray | None:
     """
     Splits the image into tiles with exactly the given tile size.
 
     If the image is smaller than the given size, then it will be padded.
+
+    If `upscale_batch` is given and `batch_size` is larger than 1, tiles are upscaled in batches of
+    up to `batch_size` tiles. `upscale_batch` returns None if a batch is too large, the batch size is
+    then halved.
+
+    If `row_sink` is given, the rows of the result are handed to it as soon as they are final
+    and None is returned, see `auto_split`.
     """
 
     # ensure that the image is at least as large as the given size
     img, base_padding = _pad_image(img, exact_size)
     h, w, _ = get_h_w_c(img)
 
-    result = _exact_split_without_padding(img, exact_size, upscale, overlap)
-    scale = get_h_w_c(result)[0] // h
-
+    sink = row_sink if row_sink is not None else RowCollector()
     if base_padding.empty:
-        return result
-
-    # remove initially added padding
-    return (
-        Region(0, 0, w, h).remove_padding(base_padding).scale(scale).read_from(result)
-    )
+        _exact_split_without_padding(img, exact_size, upscale, overlap, sink, upscale_batch, batch_size)
+    else:
+        # remove initially added padding
+        _exact_split_without_padding(
+            img, exact_size, upscale, overlap, _CroppingRowSink(sink, base_padding, h), upscale_batch, batch_size
+        )
+
+    if row_sink is not None:
+        return None
+    assert isinstance(sink, RowCollector)
+    return sink.get_result()
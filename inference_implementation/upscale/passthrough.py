@@ -1,3 +1,7 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
 import numpy as np
 
 from ..tools.utils import get_h_w_c
@@ -38,3 +42,51 @@ def passthrough_single_color(img: np.ndarray, scale: int, op: ImageOp) -> np.nda
             return np.dstack(channels)
 
     return op(img)
+
+
+@dataclass
+class FlatTileStats:
+    """How many tiles (or whole pages) of a page were flat and skipped the model."""
+
+    tiles: int = 0
+    skipped: int = 0
+
+    @property
+    def skipped_ratio(self) -> float:
+        return self.skipped / self.tiles if self.tiles > 0 else 0.0
+
+    def add(self, other: FlatTileStats) -> None:
+        self.tiles += other.tiles
+        self.skipped += other.skipped
+
+
+def flat_color(img: np.ndarray, tolerance: float) -> np.ndarray | None:
+    """
+    Returns the mean color (one float32 value per channel) of the given image if it is flat, None otherwise.
+
+    An image is flat if no channel varies by more than `tolerance`, in [0, 1] (scaled to [0, 255] for uint8 images).
+    Unlike `passthrough_single_color`, this also catches JPEG noise in the white margins and gutters of scans.
+    """
+    if img.ndim == 2:
+        img = img[:, :, np.newaxis]
+    limit = tolerance * 255 if img.dtype == np.uint8 else tolerance
+
+    def is_flat(pixels: np.ndarray) -> bool:
+        # tiles are views into the page, so reduce over the axes instead of reshaping (which would copy)
+        lo = pixels.min(axis=(0, 1)).astype(np.float32)
+        hi = pixels.max(axis=(0, 1)).astype(np.float32)
+        return not np.any(hi - lo > limit)
+
+    # most tiles aren't flat, a sparse sample of pixels usually tells so
+    if not is_flat(img[::7, ::7]) or not is_flat(img):
+        return None
+    return img.mean(axis=(0, 1), dtype=np.float32)
+
+
+def fill_flat(color: np.ndarray, width: int, height: int, dtype: np.dtype | type) -> np.ndarray:
+    """Returns a (height, width, c) image of the given color, e.g. a flat tile at the output scale."""
+    if np.dtype(dtype) == np.uint8:
+        color = np.clip(np.rint(color), 0, 255)
+    result = np.empty((height, width, len(color)), dtype=dtype)
+    result[...] = color.astype(dtype)
+    return result
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import math
 from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
 from typing import Callable
 
@@ -35,16 +36,45 @@ class TileOverlap:
         return self.start + self.end
 
 
-def _fast_mix(a: np.ndarray, b: np.ndarray, blend: np.ndarray) -> np.ndarray:
+@lru_cache(maxsize=64)
+def get_blend_curve(blend_fn: Callable[[np.ndarray], np.ndarray], blend_size: int) -> np.ndarray:
+    """
+    Returns the 1-D float32 weights of a seam of the given size, shared by the whole process.
+
+    The returned array is read-only, it is reshaped to broadcast along the seam.
+    """
+    curve = np.asarray(
+        blend_fn(np.arange(blend_size, dtype=np.float32) / (blend_size - 1)), dtype=np.float32
+    )
+    curve.setflags(write=False)
+    return curve
+
+
+def _fast_mix(
+    a: np.ndarray, b: np.ndarray, blend: np.ndarray, out: np.ndarray | None = None
+) -> np.ndarray:
     """
     Returns `a * (1 - blend) + b * blend`
+
+    `blend` only has to broadcast to the shape of `a` and `b`. If `out` is given (it may be `a` or `b`),
+    the result is written into it and integer results are rounded.
     """
     # a * (1 - blend) + b * blend
-    # a - a * blend + b * blend
-    r = b * blend
-    r += a
-    r -= a * blend  # type: ignore
-    return r
+    # a + (b - a) * blend
+    r = np.subtract(b, a, dtype=np.result_type(a.dtype, b.dtype, np.float32))
+    r *= blend
+    if out is None:
+        r += a
+        return r
+
+    if out.dtype.kind in "ui":
+        # integer results (e.g. uint8) are blended in float and rounded back
+        r += a
+        np.rint(r, out=r)
+        np.copyto(out, r, casting="unsafe")
+    else:
+        np.add(a, r, out=out, casting="unsafe")
+    return out
 
 
 class TileBlender:
@@ -56,12 +86,12 @@ class TileBlender:
         direction: BlendDirection,
         blend_fn: Callable[[np.ndarray], np.ndarray] = sin_blend_fn,
         _prev: TileBlender | None = None,
+        dtype: np.dtype | type = np.float32,
     ) -> None:
         self.direction: BlendDirection = direction
         self.blend_fn: Callable[[np.ndarray], np.ndarray] = blend_fn
         self.offset: int = 0
         self.last_end_overlap: int = 0
-        self._last_blend: np.ndarray | None = None
 
         if (
             _prev is not None
@@ -69,13 +99,11 @@ class TileBlender:
             and _prev.width == width
             and _prev.height == height
             and _prev.channels == channels
+            and _prev.result.dtype == dtype
         ):
-            if _prev.blend_fn == blend_fn:
-                # reuse blend
-                self._last_blend = _prev._last_blend  # noqa: SLF001
             result = _prev.result
         else:
-            result = np.zeros((height, width, channels), dtype=np.float32)
+            result = np.zeros((height, width, channels), dtype=dtype)
         self.result: np.ndarray = result
 
     @property
@@ -91,29 +119,11 @@ class TileBlender:
         return self.result.shape[2]
 
     def _get_blend(self, blend_size: int) -> np.ndarray:
+        # the weights only vary along the blend direction, they are broadcast along the seam
+        curve = get_blend_curve(self.blend_fn, blend_size)
         if self.direction == BlendDirection.X:
-            if self._last_blend is not None and self._last_blend.shape[1] == blend_size:
-                return self._last_blend
-
-            blend = self.blend_fn(
-                np.arange(blend_size, dtype=np.float32) / (blend_size - 1)
-            )
-            blend = blend.reshape((1, blend_size, 1))
-            blend = np.repeat(blend, repeats=self.height, axis=0)
-            blend = np.repeat(blend, repeats=self.channels, axis=2)
-        else:
-            if self._last_blend is not None and self._last_blend.shape[0] == blend_size:
-                return self._last_blend
-
-            blend = self.blend_fn(
-                np.arange(blend_size, dtype=np.float32) / (blend_size - 1)
-            )
-            blend = blend.reshape((blend_size, 1, 1))
-            blend = np.repeat(blend, repeats=self.width, axis=1)
-            blend = np.repeat(blend, repeats=self.channels, axis=2)
-
-        self._last_blend = blend
-        return blend
+            return curve.reshape((1, blend_size, 1))
+        return curve.reshape((blend_size, 1, 1))
 
     def add_tile(self, tile: np.ndarray, overlap: TileOverlap) -> None:
         h, w, c = get_h_w_c(tile)
@@ -156,9 +166,7 @@ class TileBlender:
                 ]
                 right = tile[:, :blend_size, ...]
 
-                self.result[:, self.offset - o.start : self.offset + o.start, ...] = (
-                    _fast_mix(left, right, blend)
-                )
+                _fast_mix(left, right, blend, out=left)
 
                 self.offset += w - o.total
                 self.last_end_overlap = o.end
@@ -198,9 +206,7 @@ class TileBlender:
                 ]
                 right = tile[: o.start * 2, :, ...]
 
-                self.result[self.offset - o.start : self.offset + o.start, :, ...] = (
-                    _fast_mix(left, right, blend)
-                )
+                _fast_mix(left, right, blend, out=left)
 
                 self.offset += h - o.total
                 self.last_end_overlap = o.end
@@ -212,3 +218,168 @@ class TileBlender:
             assert self.offset == self.height
 
         return self.result
+
+
+class RowSink:
+    """
+    Receives the rows of an image from top to bottom, as soon as they are final.
+
+    `begin` is called before the first rows with the size of the whole image. It may be called again
+    (e.g. when the tile size had to be lowered), then everything written so far is discarded.
+    Rows are only valid during the call to `write`, a sink has to copy what it wants to keep.
+    """
+
+    def begin(self, width: int, height: int, channels: int) -> None:
+        raise NotImplementedError
+
+    def write(self, rows: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def write_image(self, img: np.ndarray) -> None:
+        h, w, c = get_h_w_c(img)
+        self.begin(w, h, c)
+        self.write(img)
+
+
+class RowCollector(RowSink):
+    """
+    Collects the rows into one image.
+
+    `dtype` is the dtype the image is stored as. Float rows (in [0, 1]) may be stored as float16,
+    or quantized to uint8 like a saved page is. None keeps the dtype of the rows.
+
+    An image that is written in one go is kept as is, without copying it.
+    """
+
+    def __init__(self, dtype: np.dtype | type | None = None) -> None:
+        self.dtype: np.dtype | None = np.dtype(dtype) if dtype is not None else None
+        self._shape: tuple[int, int, int] | None = None
+        self._result: np.ndarray | None = None
+        self._offset: int = 0
+
+    def begin(self, width: int, height: int, channels: int) -> None:
+        self._shape = (height, width, channels)
+        self._result = None
+        self._offset = 0
+
+    def _convert(self, rows: np.ndarray) -> np.ndarray:
+        if self.dtype is None or rows.dtype == self.dtype:
+            return rows
+        if self.dtype == np.uint8 and rows.dtype.kind == "f":
+            return np.clip(rows * 255.0, 0, 255).astype(np.uint8)
+        return rows.astype(self.dtype)
+
+    def write(self, rows: np.ndarray) -> None:
+        assert self._shape is not None, "begin has to be called first"
+        rows = self._convert(rows)
+        count = rows.shape[0]
+
+        if self._result is None:
+            if count == self._shape[0]:
+                # the whole image at once
+                self._result = rows
+                self._offset = count
+                return
+            self._result = np.empty(self._shape, dtype=rows.dtype)
+
+        assert self._offset + count <= self._shape[0], "More rows than the image has"
+        self._result[self._offset : self._offset + count] = rows.reshape((count, *self._shape[1:]))
+        self._offset += count
+
+    def get_result(self) -> np.ndarray:
+        assert self._shape is not None and self._result is not None
+        assert self._offset == self._shape[0], "Not all rows were written"
+        return self._result
+
+
+class StreamingTileBlender:
+    """
+    Blends horizontal strips into an image from top to bottom, like a `TileBlender` in the Y direction,
+    without holding the whole image.
+
+    Only the rows that the next strip may still be blended into are kept, every other row is passed to
+    the sink as soon as it is final.
+
+    Strips are taken over as they are and blended into in place, so the caller must not reuse them.
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        channels: int,
+        sink: RowSink,
+        blend_fn: Callable[[np.ndarray], np.ndarray] = sin_blend_fn,
+    ) -> None:
+        self.width: int = width
+        self.height: int = height
+        self.channels: int = channels
+        self.sink: RowSink = sink
+        self.blend_fn: Callable[[np.ndarray], np.ndarray] = blend_fn
+        self.offset: int = 0
+        self.last_end_overlap: int = 0
+        # the rows [emitted, emitted + len(_pending)) are not final yet
+        self.emitted: int = 0
+        self._pending: np.ndarray | None = None
+
+        sink.begin(width, height, channels)
+
+    def add_tile(self, tile: np.ndarray, overlap: TileOverlap) -> None:
+        h, w, c = get_h_w_c(tile)
+        assert w == self.width
+        assert c == self.channels
+        assert h > overlap.total
+        o = overlap
+
+        if self._pending is None:
+            # the first strip is taken as is
+            assert o.start == 0
+            self._pending = tile.reshape((h, w, c))
+        else:
+            assert self.offset < self.height, "All tiles were filled in already"
+
+            if self.last_end_overlap < o.start:
+                # we can't use all the overlap of the current tile, so we have to cut it off
+                diff = o.start - self.last_end_overlap
+                tile = tile[diff:, :, ...]
+                h, w, c = get_h_w_c(tile)
+                o = TileOverlap(self.last_end_overlap, o.end)
+
+            pending = self._pending
+            start = self.offset - o.start - self.emitted
+            assert start >= 0
+            blend_size = o.start * 2
+
+            # every row above the current strip is final
+            if start > 0:
+                self.sink.write(pending[:start])
+                self.emitted += start
+
+            strip = tile.reshape((h, w, c))
+            _fast_mix(
+                pending[start : start + blend_size],
+                strip[:blend_size],
+                get_blend_curve(self.blend_fn, blend_size).reshape((blend_size, 1, 1)),
+                out=strip[:blend_size],
+            )
+            self._pending = strip
+
+        self.offset += h - o.total
+        self.last_end_overlap = o.end
+
+        if self.offset >= self.height:
+            assert self.offset == self.height
+            final = self.height
+        else:
+            # the next strip can't reach further up than the end overlap of this one
+            final = self.offset - self.last_end_overlap
+
+        count = final - self.emitted
+        if count > 0:
+            self.sink.write(self._pending[:count])
+            self._pending = self._pending[count:]
+            self.emitted = final
+
+    def finish(self) -> None:
+        assert self.offset == self.height, "Not all tiles were filled in"
+        assert self.emitted == self.height
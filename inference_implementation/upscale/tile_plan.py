@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+
+from ..tools.utils import Padding, Region, Size
+from .tile_blending import BlendDirection, TileOverlap
+
+
+@dataclass(frozen=True)
+class PlannedTile:
+    """
+    A tile of a `TilePlan`.
+
+    `region` is the part of the image the tile contributes to the result, `padding` is the context around it
+    that is upscaled along with it and blended with the neighboring tiles.
+    """
+
+    region: Region
+    padding: Padding
+
+    @property
+    def padded(self) -> Region:
+        return self.region.add_padding(self.padding)
+
+    def overlap_x(self, scale: int = 1) -> TileOverlap:
+        return TileOverlap(self.padding.left * scale, self.padding.right * scale)
+
+    def overlap_y(self, scale: int = 1) -> TileOverlap:
+        return TileOverlap(self.padding.top * scale, self.padding.bottom * scale)
+
+
+@dataclass(frozen=True)
+class Seam:
+    """Where two tiles (X) or two rows of tiles (Y) are blended into each other."""
+
+    direction: BlendDirection
+    # the row of the seam, for Y seams the row below it
+    row: int
+    # the first pixel (column for X, row for Y) of the region after the seam
+    offset: int
+    # number of pixels that are blended, centered on `offset`
+    blend_size: int
+
+
+@dataclass(frozen=True)
+class TilePlan:
+    """
+    The tiles an image is split into, row by row, and where they are blended.
+
+    Plans only depend on the size of the image, the tile size and the overlap. Pages of a volume
+    almost always have the same size, so plans are computed once and shared, see `max_tile_plan`
+    and `exact_tile_plan`. Plans are immutable and hashable.
+    """
+
+    width: int
+    height: int
+    tile_size: Size
+    overlap: int
+    # whether every padded tile has exactly `tile_size`
+    exact: bool
+    rows: tuple[tuple[PlannedTile, ...], ...]
+    # the first pixel row of the plan, rows above it are not part of the plan
+    start_y: int = 0
+
+    @property
+    def tile_count(self) -> Size:
+        return len(self.rows[0]), len(self.rows)
+
+    @property
+    def tiles(self) -> tuple[PlannedTile, ...]:
+        return tuple(tile for row in self.rows for tile in row)
+
+    @property
+    def padded_sizes(self) -> tuple[Size, ...]:
+        """The distinct sizes of the padded tiles, tiles of the same size can be upscaled as one batch."""
+        return tuple(dict.fromkeys(tile.padded.size for tile in self.tiles))
+
+    def row_overlap(self, row: int, scale: int = 1) -> TileOverlap:
+        return self.rows[row][0].overlap_y(scale)
+
+    def seams(self, scale: int = 1) -> tuple[Seam, ...]:
+        """The seams in blending order, at the given scale."""
+        seams: list[Seam] = []
+        for y, row in enumerate(self.rows):
+            if y > 0:
+                above = self.rows[y - 1][0].padding.bottom
+                seams.append(
+                    Seam(BlendDirection.Y, y, row[0].region.y * scale, min(above, row[0].padding.top) * 2 * scale)
+                )
+            for x in range(1, len(row)):
+                left = row[x - 1].padding.right
+                seams.append(
+                    Seam(BlendDirection.X, y, row[x].region.x * scale, min(left, row[x].padding.left) * 2 * scale)
+                )
+        return tuple(seams)
+
+    def describe(self) -> str:
+        """A human readable summary of the plan, for debugging."""
+        count_x, count_y = self.tile_count
+        lines = [
+            f"{'Exact' if self.exact else 'Max'} tile plan for {self.width}x{self.height}px"
+            f" (from row {self.start_y}), tile size {self.tile_size[0]}x{self.tile_size[1]}px,"
+            f" overlap {self.overlap}px: {count_x}x{count_y} tiles,"
+            f" padded sizes {', '.join(f'{w}x{h}' for w, h in self.padded_sizes)}."
+        ]
+        for y, row in enumerate(self.rows):
+            cells = " ".join(
+                f"[{t.region.x},{t.region.y} {t.region.width}x{t.region.height}"
+                f" pad {t.padding.top},{t.padding.right},{t.padding.bottom},{t.padding.left}]"
+                for t in row
+            )
+            lines.append(f"  row {y}: {cells}")
+        return "\n".join(lines)
+
+
+@lru_cache(maxsize=128)
+def max_tile_plan(width: int, height: int, max_tile_size: Size, overlap: int, start_y: int = 0) -> TilePlan:
+    """
+    The plan `auto_split` uses for tilers that allow smaller tile sizes: tiles of at most the given size,
+    padded with up to `overlap` pixels of the image around them.
+
+    Rows above `start_y` are left out, they were already upscaled with a different plan.
+    """
+    img_region = Region(0, 0, width, height)
+    remaining = height - start_y
+
+    # We don't actually use the current tile size to partition the image.
+    # If we did, then tile_size=1024 and w=1200 would result in very uneven tiles.
+    # Instead, we use tile_size to calculate how many tiles we get in the x and y direction
+    # and then calculate the optimal tile size for the x and y direction using the counts.
+    # This yields optimal tile sizes which should prevent unnecessary splitting.
+    tile_count_x = math.ceil(width / max_tile_size[0])
+    tile_count_y = math.ceil(remaining / max_tile_size[1])
+    tile_size_x = math.ceil(width / tile_count_x)
+    tile_size_y = math.ceil(remaining / tile_count_y)
+
+    rows: list[tuple[PlannedTile, ...]] = []
+    for y in range(tile_count_y):
+        row: list[PlannedTile] = []
+        for x in range(tile_count_x):
+            tile = Region(
+                x * tile_size_x, start_y + y * tile_size_y, tile_size_x, tile_size_y
+            ).intersect(img_region)
+            pad = img_region.child_padding(tile).min(overlap)
+            row.append(PlannedTile(tile, pad))
+        rows.append(tuple(row))
+
+    return TilePlan(width, height, max_tile_size, overlap, False, tuple(rows), start_y)
+
+
+@dataclass(frozen=True)
+class _Segment:
+    start: int
+    end: int
+    start_padding: int
+    end_padding: int
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start
+
+    @property
+    def padded_length(self) -> int:
+        return self.end + self.end_padding - (self.start - self.start_padding)
+
+
+def _exact_split_into_segments(length: int, exact: int, overlap: int) -> list[_Segment]:
+    """
+    Splits the given length into segments of `exact` (padded) length.
+    Segments will overlap into each other with at least the given overlap.
+    """
+    if length == exact:
+        # trivial
+        return [_Segment(0, exact, 0, 0)]
+
+    assert length > exact
+    assert exact > overlap * 2
+
+    result: list[_Segment] = []
+
+    def add(s: _Segment):
+        assert s.padded_length == exact
+        result.append(s)
+
+    # The current strategy is to go from left to right and to align segments
+    # such that we use the least overlap possible. The last segment will then
+    # be the smallest with potentially a lot of overlap.
+    # While this is easy to implement, it's actually not ideal. Ideally, we
+    # would want for the overlap to be distributed evenly between segments.
+    # However, this is complex to implement and the current method also works.
+
+    # we know that the first segment looks like this
+    add(_Segment(0, exact - overlap, 0, overlap))
+
+    while result[-1].end < length:
+        start_padding = overlap
+        start = result[-1].end
+        end = start + exact - overlap * 2
+        end_padding = overlap
+
+        if end + end_padding >= length:
+            # last segment
+            end_padding = 0
+            end = length
+            start_padding = exact - (end - start)
+
+        add(_Segment(start, end, start_padding, end_padding))
+
+    return result
+
+
+@lru_cache(maxsize=128)
+def exact_tile_plan(width: int, height: int, exact_size: Size, overlap: int) -> TilePlan:
+    """
+    The plan `exact_split` uses: disjoint regions along with padding, such that every region plus its
+    padding has exactly the given size. The padding (if not zero) is at least the given overlap.
+
+    The image has to be at least as large as the given size.
+    """
+    exact_w, exact_h = exact_size
+
+    # we can split x and y independently from each other and then combine the results
+    x_segments = _exact_split_into_segments(width, exact_w, overlap)
+    y_segments = _exact_split_into_segments(height, exact_h, overlap)
+
+    rows: list[tuple[PlannedTile, ...]] = []
+    for y in y_segments:
+        rows.append(
+            tuple(
+                PlannedTile(
+                    Region(x.start, y.start, x.length, y.length),
+                    Padding(y.start_padding, x.end_padding, y.end_padding, x.start_padding),
+                )
+                for x in x_segments
+            )
+        )
+
+    return TilePlan(width, height, exact_size, overlap, True, tuple(rows))
+
+
+__all__ = [
+    "PlannedTile",
+    "Seam",
+    "TilePlan",
+    "max_tile_plan",
+    "exact_tile_plan",
+]
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+from filelock import FileLock
+from sanic.log import logger
+
+from .tiler import LearnedTileSize
+
+_VERSION = 1
+
+
+@dataclass(frozen=True)
+class TileSizeKey:
+    model_hash: str
+    device: str
+    dtype: str
+    # (width, height, channels) of the input, width and height rounded up to the bucket size
+    shape_bucket: tuple[int, int, int]
+
+    def as_str(self) -> str:
+        w, h, c = self.shape_bucket
+        return f"{self.model_hash}|{self.device}|{self.dtype}|{w}x{h}x{c}"
+
+
+class TileSizeMemory:
+    """
+    Remembers the last tile size that worked, per model, device, dtype and input shape bucket.
+
+    Later pages (and jobs) start directly at the remembered tile size instead of running into
+    the same out-of-memory errors again. If a path is given, the table is persisted as JSON and
+    shared by all workers using the same file.
+    """
+
+    def __init__(self, path: str | None = None, bucket: int = 256) -> None:
+        assert bucket > 0
+        self.path: str | None = path
+        self.bucket: int = bucket
+        self._entries: dict[str, dict] = {}
+        self._mtime: float | None = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def key_for(
+        self,
+        model_hash: str,
+        device: object,
+        dtype: object,
+        width: int,
+        height: int,
+        channels: int,
+    ) -> TileSizeKey:
+        def round_up(x: int) -> int:
+            return math.ceil(x / self.bucket) * self.bucket
+
+        return TileSizeKey(
+            model_hash, str(device), str(dtype), (round_up(width), round_up(height), channels)
+        )
+
+    def get(self, key: TileSizeKey) -> int | None:
+        """Returns the last tile size that worked for the given key, if any."""
+        with self._lock:
+            self._reload_if_changed()
+            entry = self._entries.get(key.as_str())
+        return entry["tile_size"] if entry is not None else None
+
+    def tiler_for(self, key: TileSizeKey) -> LearnedTileSize:
+        """Returns a tiler that starts at the remembered tile size (or the whole image)."""
+        known = self.get(key)
+        return LearnedTileSize(known) if known is not None else LearnedTileSize()
+
+    def record(self, key: TileSizeKey, tile_size: int) -> None:
+        """Remembers that the given tile size worked for the given key."""
+        assert tile_size > 0
+        with self._lock:
+            entry = self._entries.get(key.as_str())
+            if entry is not None and entry["tile_size"] == tile_size:
+                return
+
+            if entry is None or entry["tile_size"] > tile_size:
+                logger.info(f"Remembering tile size {tile_size} for {key.as_str()}.")
+            self._entries[key.as_str()] = {
+                **asdict(key),
+                "shape_bucket": list(key.shape_bucket),
+                "tile_size": tile_size,
+                "updated_at": time.time(),
+            }
+            self._save(key.as_str())
+
+    def remember(self, key: TileSizeKey, tiler: LearnedTileSize) -> None:
+        """
+        Records the tile size the given tiler ended up with after a successful upscale.
+
+        The starting tile size of a tiler that never had to split is only recorded for new keys,
+        so that a small page doesn't shrink the tile size remembered for its whole bucket.
+        """
+        if tiler.last_tile_size is None:
+            return
+        if tiler.did_split or self.get(key) is None:
+            self.record(key, max(tiler.last_tile_size))
+
+    def forget(self, key: TileSizeKey | None = None) -> None:
+        """Forgets the given key, or everything."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key.as_str(), None)
+            self._save(None, replace=True)
+
+    def entries(self) -> list[dict]:
+        with self._lock:
+            self._reload_if_changed()
+            return sorted(self._entries.values(), key=lambda e: e["updated_at"], reverse=True)
+
+    def _read_file(self) -> dict[str, dict]:
+        assert self.path is not None
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") != _VERSION:
+                return {}
+            return data.get("entries", {})
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable tile size memory {self.path}: {e}")
+            return {}
+
+    def _load(self) -> None:
+        if self.path is None:
+            return
+        self._entries = self._read_file()
+        self._mtime = self._get_mtime()
+
+    def _get_mtime(self) -> float | None:
+        try:
+            return os.stat(self.path).st_mtime  # type: ignore
+        except OSError:
+            return None
+
+    def _reload_if_changed(self) -> None:
+        # another worker may have learned something in the meantime
+        if self.path is not None and self._get_mtime() != self._mtime:
+            self._load()
+
+    def _save(self, changed_key: str | None, replace: bool = False) -> None:
+        if self.path is None:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with FileLock(f"{self.path}.lock"):
+            if not replace:
+                # merge with what other workers wrote, our change wins
+                on_disk = self._read_file()
+                if changed_key is not None:
+                    on_disk[changed_key] = self._entries[changed_key]
+                self._entries = on_disk
+
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"version": _VERSION, "entries": self._entries}, f, indent=2)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+            self._mtime = self._get_mtime()
+
+
+__all__ = ["TileSizeKey", "TileSizeMemory"]
@@ -55,6 +55,31 @@ class MaxTileSize(Tiler):
         return size, size
 
 
+class LearnedTileSize(MaxTileSize):
+    """
+    A `MaxTileSize` that keeps the tile size it had to split down to.
+
+    Later images start directly at the reduced tile size instead of running out of memory again.
+    """
+
+    def __init__(self, tile_size: int = 2**31) -> None:
+        super().__init__(tile_size)
+        self.last_tile_size: Size | None = None
+        self.did_split: bool = False
+
+    def starting_tile_size(self, width: int, height: int, channels: int) -> Size:
+        size = super().starting_tile_size(width, height, channels)
+        self.last_tile_size = size
+        return size
+
+    def split(self, tile_size: Size) -> Size:
+        size = super().split(tile_size)
+        self.tile_size = max(size)
+        self.last_tile_size = size
+        self.did_split = True
+        return size
+
+
 class ExactTileSize(Tiler):
     def __init__(self, exact_size: Size) -> None:
         self.exact_size = exact_size
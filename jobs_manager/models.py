@@ -1,10 +1,13 @@
 from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
 
 class Job(models.Model):
     # Prototype: Model that represents an upscaling job
     STATUS_CHOICES = [
         ('original', 'Original'),
         ('partial', 'Partial'),
+        ('paused', 'Paused'),
+        ('canceled', 'Canceled'),
         ('completed', 'Completed'),
         ('failed', 'Failed')
     ]
@@ -15,6 +18,12 @@ class Job(models.Model):
         ('enhancement', 'Enhancement'),
         ('finalization', 'Finalization')
     ]
+    PRECISIONS = [
+        ('auto', 'Auto'),
+        ('fp32', 'FP32'),
+        ('fp16', 'FP16'),
+        ('bf16', 'BF16')
+    ]
 
     id = models.AutoField(primary_key=True)
     title_name = models.CharField(max_length=255)
@@ -26,4 +35,47 @@ class Job(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     used_model_name = models.TextField()
+    # 'auto' lets the worker pick the precision of the model and device
+    precision = models.CharField(max_length=10, choices=PRECISIONS, default='auto')
     last_task_id = models.CharField(max_length=255, null=True, blank=True)
+    # 0 (served first) to 9 (served last), the tasks of the job are queued with this broker priority
+    priority = models.IntegerField(default=5, validators=[MinValueValidator(0), MaxValueValidator(9)])
+    # the job runs as chunks of pages, possibly on several workers at once
+    chunks_total = models.IntegerField(default=0)
+    chunks_done = models.IntegerField(default=0)
+    chunks_failed = models.IntegerField(default=0)
+    # chunks that stopped because the job was canceled
+    chunks_canceled = models.IntegerField(default=0)
+
+class Page(models.Model):
+    # Ledger entry of a page of a volume: where it comes from, where it goes and how far it got.
+    # Workers and progress queries rely on it instead of checking the output files.
+    STATES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed')
+    ]
+
+    id = models.AutoField(primary_key=True)
+    book = models.ForeignKey('library.Book', on_delete=models.CASCADE, related_name='pages')
+    # the job that processed the page last
+    job = models.ForeignKey(Job, on_delete=models.SET_NULL, null=True, blank=True, related_name='pages')
+    # name of the page inside the volume archive
+    source_member = models.TextField()
+    source_path = models.TextField()
+    output_path = models.TextField()
+    state = models.CharField(max_length=20, choices=STATES, default='pending')
+    # sha256 of the output file, once the page is done
+    checksum = models.CharField(max_length=64, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'source_member'], name='unique_page_per_book')
+        ]
+        indexes = [
+            models.Index(fields=['book', 'state'])
+        ]
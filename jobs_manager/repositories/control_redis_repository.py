@@ -0,0 +1,56 @@
+import redis
+from typing import Tuple
+from django.conf import settings
+
+class ControlRedisRepository:
+    '''
+    Control channel between the API and the workers of a job, kept in Redis.
+    Every run of a job gets an id, workers of an older run see that they were superseded.
+    The command of the current run is 'pause', 'cancel' or none.
+    '''
+
+    COMMANDS = ('pause', 'cancel')
+
+    def __init__(self, client: redis.Redis | None = None):
+        self.client = client or redis.Redis.from_url(getattr(settings, 'JOBS_REDIS_URL', 'redis://redis:6379/1'))
+
+    def _run_key(self, job_id: int) -> str:
+        return f'jobs:{job_id}:run'
+
+    def _command_key(self, job_id: int) -> str:
+        return f'jobs:{job_id}:control'
+
+    def start_run(self, job_id: int, run_id: str) -> None:
+        pipe = self.client.pipeline()
+        pipe.set(self._run_key(job_id), run_id)
+        pipe.delete(self._command_key(job_id))
+        pipe.execute()
+
+    def set_command(self, job_id: int, command: str) -> None:
+        assert command in self.COMMANDS, f'Unknown job command {command}'
+        self.client.set(self._command_key(job_id), command)
+
+    def clear_command(self, job_id: int) -> None:
+        self.client.delete(self._command_key(job_id))
+
+    def get_state(self, job_id: int) -> Tuple[str | None, str | None]:
+        '''
+        Returns the current run id and command of a job, in one round trip.
+        '''
+        run_id, command = self.client.mget(self._run_key(job_id), self._command_key(job_id))
+        return (
+            run_id.decode() if run_id is not None else None,
+            command.decode() if command is not None else None,
+        )
+
+    def expire(self, job_id: int, seconds: int) -> None:
+        '''
+        Lets the run and command of a job expire, once its workers had the time to see them.
+        '''
+        pipe = self.client.pipeline()
+        pipe.expire(self._run_key(job_id), seconds)
+        pipe.expire(self._command_key(job_id), seconds)
+        pipe.execute()
+
+    def delete(self, job_id: int) -> None:
+        self.client.delete(self._run_key(job_id), self._command_key(job_id))
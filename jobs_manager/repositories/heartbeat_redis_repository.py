@@ -0,0 +1,41 @@
+import json
+import time
+import redis
+from typing import Any, Dict
+from django.conf import settings
+
+class HeartbeatRedisRepository:
+    '''
+    Heartbeats of the workers processing a job, kept in Redis: one hash per job, with one field per worker
+    (chunk task) holding its JSON state and the time of its last beat.
+    Reading the status of a job is a single HGETALL, however many workers there are. The hash expires
+    `retention` seconds after the last beat, the fields of dead workers stay until then, with a stale time.
+    '''
+
+    def __init__(self, client: redis.Redis | None = None, retention: int = 24 * 3600):
+        self.client = client or redis.Redis.from_url(getattr(settings, 'JOBS_REDIS_URL', 'redis://redis:6379/1'))
+        self.retention = retention
+
+    def _key(self, job_id: int) -> str:
+        return f'jobs:{job_id}:heartbeat'
+
+    def beat(self, job_id: int, worker: str, state: Dict[str, Any]) -> None:
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(job_id), worker, json.dumps(dict(state, at=time.time())))
+        pipe.expire(self._key(job_id), self.retention)
+        pipe.execute()
+
+    def clear(self, job_id: int, worker: str) -> None:
+        self.client.hdel(self._key(job_id), worker)
+
+    def get_heartbeats(self, job_id: int) -> Dict[str, Dict[str, Any]]:
+        '''
+        Returns the last state of every worker of a job, with the time of its last beat (`at`, a UNIX timestamp).
+        '''
+        return {
+            worker.decode(): json.loads(state)
+            for worker, state in self.client.hgetall(self._key(job_id)).items()
+        }
+
+    def delete(self, job_id: int) -> None:
+        self.client.delete(self._key(job_id))
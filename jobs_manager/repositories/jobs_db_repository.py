@@ -1,6 +1,8 @@
 from jobs_manager.models import Job
 from typing import List
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F
+from django.utils import timezone
 
 class JobsDBRepository:
     '''Repository for managing jobs in the database.'''
@@ -25,6 +27,40 @@ class JobsDBRepository:
         job_instance.save()
         return job_instance
 
+    def transition_job_status(self, job_id: int, status: str, from_status: str | None = None) -> bool:
+        '''
+        Sets the status of a job with a single UPDATE, which writes nothing if the job already has it,
+        or (if `from_status` is given) if the job doesn't have that status.
+        Returns whether the status changed.
+        '''
+        jobs = Job._default_manager.filter(id=job_id)
+        if from_status is not None:
+            jobs = jobs.filter(status=from_status)
+        return jobs.exclude(status=status).update(status=status) > 0
+
+    def start_job_chunks(self, job_id: int, chunks_total: int) -> None:
+        '''
+        Resets the chunk counters of a job once its pages are split into chunks.
+        '''
+        Job._default_manager.filter(id=job_id).update(
+            chunks_total=chunks_total, chunks_done=0, chunks_failed=0, chunks_canceled=0, step='enhancement', completed_at=None
+        )
+
+    def record_chunk(self, job_id: int, failed: bool = False, canceled: bool = False) -> None:
+        '''
+        Counts a finished chunk. Chunks finish concurrently on several workers, so the counters are
+        incremented in the database instead of being read, modified and saved.
+        '''
+        if canceled:
+            Job._default_manager.filter(id=job_id).update(chunks_canceled=F('chunks_canceled') + 1)
+        elif failed:
+            Job._default_manager.filter(id=job_id).update(chunks_failed=F('chunks_failed') + 1)
+        else:
+            Job._default_manager.filter(id=job_id).update(chunks_done=F('chunks_done') + 1)
+
+    def finish_job(self, job_id: int, status: str) -> None:
+        Job._default_manager.filter(id=job_id).update(status=status, step='finalization', completed_at=timezone.now())
+
     def delete_job(self, job_id: int) -> bool:
         try:
             job = Job._default_manager.get(id=job_id)
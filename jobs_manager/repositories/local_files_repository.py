@@ -1,3 +1,4 @@
+import hashlib
 import os
 from typing import List
 
@@ -56,6 +57,16 @@ class LocalFilesRepository:
         return extraction_dir
 
 
+    def checksum(self, file_path: str) -> str:
+        '''
+        Returns the sha256 of a file, e.g. of a freshly written page so that the ledger can tell it from a truncated one.
+        '''
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
     def archive(self):
         '''TODO: Archives the extracted files into a .cbz file.'''
         pass
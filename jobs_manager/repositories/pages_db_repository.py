@@ -0,0 +1,74 @@
+from jobs_manager.models import Page
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+class PagesDBRepository:
+    '''Repository for the per-page work ledger, every method is a single (bulk) query.'''
+
+    def register_pages(self, book_id: int, pages: Iterable[Tuple[str, str, str]]) -> None:
+        '''
+        Adds the (source_member, source_path, output_path) pages of a volume to the ledger.
+        Pages already in the ledger keep their state, so volumes can be registered again on every run.
+        '''
+        Page._default_manager.bulk_create(
+            [
+                Page(book_id=book_id, source_member=member, source_path=source_path, output_path=output_path)
+                for member, source_path, output_path in pages
+            ],
+            ignore_conflicts=True,
+        )
+
+    def get_page_ids_to_process(self, book_id: int) -> List[int]:
+        return list(
+            Page._default_manager.filter(book_id=book_id).exclude(state='done').order_by('source_member').values_list('id', flat=True)
+        )
+
+    def get_pages_to_process(self, page_ids: List[int]) -> List[Page]:
+        return list(Page._default_manager.filter(id__in=page_ids).exclude(state='done').order_by('source_member'))
+
+    def start_pages(self, page_ids: List[int], job_id: int) -> None:
+        Page._default_manager.filter(id__in=page_ids).update(
+            state='processing', job_id=job_id, attempts=F('attempts') + 1, started_at=timezone.now(), finished_at=None
+        )
+
+    def finish_page(self, page_id: int, checksum: str) -> None:
+        Page._default_manager.filter(id=page_id).update(state='done', checksum=checksum, finished_at=timezone.now())
+
+    def finish_pages(self, pages: List[Tuple[int, str, datetime]]) -> None:
+        '''
+        Marks the given (page_id, checksum, finished_at) pages as done with a single UPDATE.
+        '''
+        if not pages:
+            return
+        Page._default_manager.bulk_update(
+            [
+                Page(id=page_id, state='done', checksum=checksum, finished_at=finished_at)
+                for page_id, checksum, finished_at in pages
+            ],
+            ['state', 'checksum', 'finished_at'],
+        )
+
+    def fail_pages(self, page_ids: List[int]) -> None:
+        '''
+        Marks the given pages as failed, unless they were finished in the meantime.
+        '''
+        Page._default_manager.filter(id__in=page_ids).exclude(state='done').update(state='failed', finished_at=timezone.now())
+
+    def release_pages(self, page_ids: List[int]) -> None:
+        '''
+        Puts the given pages back to pending, unless they were finished in the meantime, e.g. after a pause or cancel.
+        '''
+        Page._default_manager.filter(id__in=page_ids).exclude(state='done').update(state='pending', started_at=None)
+
+    def get_books_progress(self, book_ids: List[int]) -> Dict[int, Tuple[int, int]]:
+        '''
+        Returns the (done, total) pages of every given book that has pages in the ledger.
+        '''
+        rows = (
+            Page._default_manager.filter(book_id__in=book_ids)
+            .values('book_id')
+            .annotate(total=Count('id'), done=Count('id', filter=Q(state='done')))
+        )
+        return {row['book_id']: (row['done'], row['total']) for row in rows}
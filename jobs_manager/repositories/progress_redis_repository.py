@@ -0,0 +1,68 @@
+import redis
+from typing import Dict, List, Tuple
+from django.conf import settings
+
+class ProgressRedisRepository:
+    '''
+    Per-volume processed/total page counters of jobs, kept in Redis.
+    Workers update them page by page, so that reading the progress of a job costs one round trip,
+    however many pages it has. The counters are a cache of the page ledger, see `set_volumes`.
+    '''
+
+    def __init__(self, client: redis.Redis | None = None):
+        self.client = client or redis.Redis.from_url(getattr(settings, 'JOBS_REDIS_URL', 'redis://redis:6379/1'))
+
+    def _volumes_key(self, job_id: int) -> str:
+        return f'jobs:{job_id}:volumes'
+
+    def _counters_key(self, job_id: int) -> str:
+        return f'jobs:{job_id}:progress'
+
+    def set_volumes(self, job_id: int, volumes: List[Tuple[int, int, int]]) -> None:
+        '''
+        Replaces the counters of a job with the given (book_id, done, total) volumes, in display order.
+        '''
+        pipe = self.client.pipeline()
+        pipe.delete(self._volumes_key(job_id), self._counters_key(job_id))
+        if volumes:
+            pipe.rpush(self._volumes_key(job_id), *[book_id for book_id, _, _ in volumes])
+            counters: Dict[str, int] = {}
+            for book_id, done, total in volumes:
+                counters[f'{book_id}:done'] = done
+                counters[f'{book_id}:total'] = total
+            pipe.hset(self._counters_key(job_id), mapping=counters)
+        pipe.execute()
+
+    def set_volume(self, job_id: int, book_id: int, done: int, total: int) -> None:
+        self.client.hset(self._counters_key(job_id), mapping={f'{book_id}:done': done, f'{book_id}:total': total})
+
+    def increment_done(self, job_id: int, book_id: int, amount: int = 1) -> None:
+        self.client.hincrby(self._counters_key(job_id), f'{book_id}:done', amount)
+
+    def get_progress(self, job_id: int) -> List[float] | None:
+        '''
+        Returns the percentage of processed pages of every volume of a job, None if the job has no counters yet.
+        '''
+        pipe = self.client.pipeline()
+        pipe.lrange(self._volumes_key(job_id), 0, -1)
+        pipe.hgetall(self._counters_key(job_id))
+        book_ids, counters = pipe.execute()
+        if not book_ids:
+            return None
+
+        progress: List[float] = []
+        for book_id in book_ids:
+            book_id = book_id.decode()
+            done = int(counters.get(f'{book_id}:done'.encode(), 0))
+            total = int(counters.get(f'{book_id}:total'.encode(), 0))
+            progress.append(round(float((min(done, total) / total) * 100), 2) if total > 0 else 0)
+        return progress
+
+    def try_reconcile(self, job_id: int, interval: int) -> bool:
+        '''
+        Returns True at most once per `interval` seconds and job, to rate-limit full recounts.
+        '''
+        return bool(self.client.set(f'jobs:{job_id}:reconciled', 1, nx=True, ex=max(1, interval)))
+
+    def delete(self, job_id: int) -> None:
+        self.client.delete(self._volumes_key(job_id), self._counters_key(job_id), f'jobs:{job_id}:reconciled')
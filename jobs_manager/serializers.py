@@ -20,6 +20,12 @@ class JobPreviewSerializer(serializers.ModelSerializer):
             'created_at',
             'completed_at',
             'used_model_name',
+            'precision',
+            'priority',
+            'chunks_total',
+            'chunks_done',
+            'chunks_failed',
+            'chunks_canceled',
         ]
 
 class JobsListSerializer(serializers.ModelSerializer):
@@ -0,0 +1,82 @@
+import time
+from typing import Callable
+from inference_implementation.api.progress import Aborted, Progress
+from jobs_manager.repositories.control_redis_repository import ControlRedisRepository
+
+class JobPaused(Aborted):
+    '''
+    Raised by `JobControlToken.suspend` once a job stayed paused for longer than the worker may wait for it.
+    '''
+
+class JobControlToken(Progress):
+    '''
+    The pause / resume / cancel state of a job run, as seen by a worker.
+
+    The inference checks it before every tile, so the state is read from Redis at most once every
+    `poll_seconds` seconds. A run is aborted when it is canceled or when a newer run of the job was started.
+    While paused, `suspend` blocks the worker, which keeps its model loaded, for at most `max_suspend_seconds`
+    (forever if None). It raises `JobPaused` after that, so that the worker can serve other jobs.
+    '''
+
+    def __init__(
+        self,
+        job_id: int,
+        run_id: str | None,
+        poll_seconds: float = 0.5,
+        max_suspend_seconds: float | None = None,
+        control_redis_repo: ControlRedisRepository | None = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.job_id = job_id
+        self.run_id = run_id
+        self.poll_seconds = poll_seconds
+        self.max_suspend_seconds = max_suspend_seconds
+        self.controlRedisRepository = control_redis_repo or ControlRedisRepository()
+        self._clock = clock
+        self._sleep = sleep
+        self._polled_at: float | None = None
+        self._paused = False
+        self._superseded = False
+        self._canceled = False
+
+    def _poll(self) -> None:
+        now = self._clock()
+        # an aborted run stays aborted
+        if self._superseded or self._canceled or (self._polled_at is not None and now - self._polled_at < self.poll_seconds):
+            return
+        self._polled_at = now
+        run_id, command = self.controlRedisRepository.get_state(self.job_id)
+        # jobs started before run ids existed only know commands
+        self._superseded = self.run_id is not None and run_id is not None and run_id != self.run_id
+        self._canceled = command == 'cancel'
+        self._paused = command == 'pause'
+
+    @property
+    def superseded(self) -> bool:
+        '''Whether a newer run of the job was started, which then owns the status of the job.'''
+        self._poll()
+        return self._superseded
+
+    @property
+    def canceled(self) -> bool:
+        self._poll()
+        return self._canceled
+
+    @property
+    def paused(self) -> bool:
+        self._poll()
+        return self._paused and not self.aborted
+
+    @property
+    def aborted(self) -> bool:
+        self._poll()
+        return self._superseded or self._canceled
+
+    def suspend(self) -> None:
+        suspended_at = self._clock()
+        while self.paused:
+            if self.max_suspend_seconds is not None and self._clock() - suspended_at >= self.max_suspend_seconds:
+                raise JobPaused()
+            self._sleep(self.poll_seconds)
+        self.check_aborted()
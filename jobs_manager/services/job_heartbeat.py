@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import Any, Callable, Dict
+from inference_implementation.api.progress import Progress
+from jobs_manager.repositories.heartbeat_redis_repository import HeartbeatRedisRepository
+
+class JobHeartbeat:
+    '''
+    Publishes the state of a worker processing a chunk of a job every `interval` seconds.
+
+    Beats come from a background thread, so that long pages and pauses don't look like a dead worker,
+    but stop with the worker process. Used as a context manager around the processing of the chunk,
+    the heartbeat of the worker is removed once the chunk is done (or failed).
+    '''
+
+    def __init__(
+        self,
+        job_id: int,
+        worker: str,
+        interval: float = 5.0,
+        control: Progress | None = None,
+        heartbeat_redis_repo: HeartbeatRedisRepository | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.job_id = job_id
+        self.worker = worker
+        self.interval = interval
+        self.control = control
+        self.heartbeatRedisRepository = heartbeat_redis_repo or HeartbeatRedisRepository()
+        self._clock = clock
+        self._started = clock()
+        self._volume_id: int | None = None
+        self._volume: str | None = None
+        # the last page the worker finished
+        self._page: str | None = None
+        self._pages_done = 0
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def set_volume(self, volume_id: int, volume: str) -> None:
+        self._volume_id = volume_id
+        self._volume = volume
+
+    def page_done(self, page: str) -> None:
+        self._page = page
+        self._pages_done += 1
+
+    def state(self) -> Dict[str, Any]:
+        elapsed = self._clock() - self._started
+        return {
+            'state': 'paused' if self.control is not None and self.control.paused else 'running',
+            'volume_id': self._volume_id,
+            'volume': self._volume,
+            'page': self._page,
+            'pages_done': self._pages_done,
+            'pages_per_second': round(self._pages_done / elapsed, 3) if elapsed > 0 else 0.0,
+        }
+
+    def beat(self) -> None:
+        try:
+            self.heartbeatRedisRepository.beat(self.job_id, self.worker, self.state())
+        except Exception as e:
+            # a missed beat must not fail the chunk
+            print(f"Error sending the heartbeat of job {self.job_id}: {e}")
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.beat()
+
+    def __enter__(self) -> 'JobHeartbeat':
+        self.beat()
+        self._thread = threading.Thread(target=self._run, name=f'job-{self.job_id}-heartbeat', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.heartbeatRedisRepository.clear(self.job_id, self.worker)
+        except Exception as e:
+            print(f"Error clearing the heartbeat of job {self.job_id}: {e}")
@@ -0,0 +1,74 @@
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+from datetime import datetime
+from django.utils import timezone
+from jobs_manager.repositories.jobs_db_repository import JobsDBRepository
+from jobs_manager.repositories.pages_db_repository import PagesDBRepository
+from jobs_manager.repositories.progress_redis_repository import ProgressRedisRepository
+from library.repositories.books_db_repository import BooksDBRepository
+
+class JobProgressWriter:
+    '''
+    Write-behind layer for the state a worker reports while it processes the pages of a job.
+
+    Status changes of the job and its books are only written on actual transitions, as a single
+    UPDATE ... WHERE status differs. Finished pages (ledger and progress counters) are buffered and
+    written in one batch every `batch_pages` pages or `batch_seconds` seconds, and on `flush`, which
+    has to be called once the pages are done or failed.
+    '''
+
+    def __init__(
+        self,
+        job_id: int,
+        batch_pages: int = 16,
+        batch_seconds: float = 5.0,
+        jobs_db_repo: JobsDBRepository | None = None,
+        books_db_repo: BooksDBRepository | None = None,
+        pages_db_repo: PagesDBRepository | None = None,
+        progress_redis_repo: ProgressRedisRepository | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.job_id = job_id
+        self.batch_pages = max(1, batch_pages)
+        self.batch_seconds = batch_seconds
+        self.jobsDBRepository = jobs_db_repo or JobsDBRepository()
+        self.booksDBRepository = books_db_repo or BooksDBRepository()
+        self.pagesDBRepository = pages_db_repo or PagesDBRepository()
+        self.progressRedisRepository = progress_redis_repo or ProgressRedisRepository()
+        self._clock = clock
+        self._last_flush = clock()
+        # statuses known to be written already
+        self._job_status: str | None = None
+        self._book_statuses: Dict[int, str] = {}
+        # (page_id, book_id, checksum, finished_at) of the pages done since the last flush
+        self._finished: List[Tuple[int, int, str, datetime]] = []
+
+    def set_job_status(self, status: str) -> None:
+        if self._job_status != status:
+            self.jobsDBRepository.transition_job_status(self.job_id, status)
+            self._job_status = status
+
+    def set_book_status(self, book_id: int, status: str) -> None:
+        if self._book_statuses.get(book_id) != status:
+            self.booksDBRepository.transition_book_status(book_id, status)
+            self._book_statuses[book_id] = status
+
+    def page_done(self, page_id: int, book_id: int, checksum: str) -> bool:
+        '''
+        Buffers a finished page, returns True if this flushed the buffer.
+        '''
+        self._finished.append((page_id, book_id, checksum, timezone.now()))
+        if len(self._finished) >= self.batch_pages or self._clock() - self._last_flush >= self.batch_seconds:
+            self.flush()
+            return True
+        return False
+
+    def flush(self) -> None:
+        self._last_flush = self._clock()
+        if not self._finished:
+            return
+        finished, self._finished = self._finished, []
+        self.pagesDBRepository.finish_pages([(page_id, checksum, at) for page_id, _, checksum, at in finished])
+        for book_id, amount in Counter(book_id for _, book_id, _, _ in finished).items():
+            self.progressRedisRepository.increment_done(self.job_id, book_id, amount)
@@ -1,34 +1,73 @@
 import os
+import time
+import uuid
 from typing import Dict, List, Any
 from jobs_manager.models import Job
 from jobs_manager.repositories.jobs_db_repository import JobsDBRepository
 from jobs_manager.repositories.local_files_repository import LocalFilesRepository
+from jobs_manager.repositories.progress_redis_repository import ProgressRedisRepository
+from jobs_manager.repositories.control_redis_repository import ControlRedisRepository
+from jobs_manager.repositories.heartbeat_redis_repository import HeartbeatRedisRepository
 from library.repositories.books_db_repository import BooksDBRepository
 from jobs_manager.tasks import run_job_worker_task, calculate_job_progress, process_success, process_error
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from celery.result import AsyncResult
-from rg_server.celery import app as celery_app
 from celery import signature
+from django.conf import settings
+from inference_implementation.upscale.tile_size_memory import TileSizeMemory
 
 class JobsManagerService:
-    def __init__(self, jobs_db_repo=JobsDBRepository, local_files_repo=LocalFilesRepository, books_db_repo=BooksDBRepository):
+    def __init__(self, jobs_db_repo=JobsDBRepository, local_files_repo=LocalFilesRepository, books_db_repo=BooksDBRepository, progress_redis_repo=ProgressRedisRepository, control_redis_repo=ControlRedisRepository, heartbeat_redis_repo=HeartbeatRedisRepository):
         self.jobsDBRepository = jobs_db_repo()
         self.localFilesRepository = local_files_repo()
         self.booksDBRepository = books_db_repo()
+        self.progressRedisRepository = progress_redis_repo()
+        self.controlRedisRepository = control_redis_repo()
+        self.heartbeatRedisRepository = heartbeat_redis_repo()
 
     def get_jobs(self) -> List[Job]:
         return self.jobsDBRepository.get_jobs()
 
     def get_jobs_progress(self) -> bool:
+        '''
+        Sends the cached progress of every job, one Redis round trip per job.
+        Jobs without cached progress are recounted, subject to the reconcile rate limit.
+        '''
         try:
             jobs = self.jobsDBRepository.get_jobs()
+            channel_layer = get_channel_layer()
             for job in jobs:
-                calculate_job_progress(id=job.id, title_name=job.title_name)
+                percentages = self.progressRedisRepository.get_progress(job.id)
+                if percentages is None:
+                    self.reconcile_job_progress(job.id)
+                elif channel_layer:
+                    async_to_sync(channel_layer.group_send)(
+                        'process_group',
+                        {
+                            'type': 'process.progress',
+                            'id': job.id,
+                            'title_name': job.title_name,
+                            'percentages': percentages,
+                            'step': 'Verifying'
+                        }
+                    )
         except Exception as e:
             print(f"Error getting jobs progress: {e}")
         return True
 
+    def reconcile_job_progress(self, job_id: int) -> bool:
+        '''
+        Recounts the progress of a job from the page ledger, at most once per JOBS_PROGRESS_RECONCILE_INTERVAL seconds.
+        Returns False if the job was reconciled too recently.
+        '''
+        job = self.get_job(job_id)
+        interval = getattr(settings, 'JOBS_PROGRESS_RECONCILE_INTERVAL', 60)
+        if not self.progressRedisRepository.try_reconcile(job.id, interval):
+            return False
+        calculate_job_progress(id=job.id, title_name=job.title_name)
+        return True
+
     def get_job(self, job_id: int) -> Job:
         return self.jobsDBRepository.get_job(job_id)
 
@@ -41,39 +80,105 @@ class JobsManagerService:
             print(f"Job {job_id} stopped")
         else:
             print(f"Job {job_id} not stopped, probably not running")
+        self.progressRedisRepository.delete(job_id)
+        self.heartbeatRedisRepository.delete(job_id)
+        # the cancel command has to outlive the job, until its workers have seen it
+        self.controlRedisRepository.expire(job_id, 24 * 3600)
         return self.jobsDBRepository.delete_job(job_id)
 
     def test_inference(self, job_data: Dict) -> None:
         '''Only for testing purposes'''
         return run_job_worker_task()
 
-    def get_job_status(self, job_id: int):
-        job = self.get_job(job_id)
-        task_id = job.last_task_id
-        print(f"Getting status for task {task_id}")
+    def get_tile_sizes(self) -> List[Dict[str, Any]]:
+        '''
+        Returns the tile sizes learned by the job workers, most recently updated first.
+        '''
+        return TileSizeMemory(getattr(settings, 'INFERENCE_TILE_SIZE_MEMORY_PATH', None)).entries()
 
-        celery_worker = celery_app.control.inspect().active()
-        running_tasks = list(celery_worker.values())[0]
-        print(running_tasks)
-        for task in running_tasks:
-              if task["id"] == task_id:
-                    print(f"Task {task_id} is running")
-                    return True
+    def get_job_status(self, job_id: int) -> Dict[str, Any]:
+        '''
+        Returns the state of a job from the heartbeats of its workers, one Redis round trip:
+        'running' or 'paused' while a worker beats, 'dead' if its workers stopped beating without finishing
+        their chunks, 'waiting' if chunks are left but no worker has them (yet), otherwise the status of the job.
+        '''
+        job = self.get_job(job_id)
+        ttl = getattr(settings, 'JOBS_HEARTBEAT_TTL', 30)
+        now = time.time()
+
+        workers = []
+        for worker, heartbeat in self.heartbeatRedisRepository.get_heartbeats(job.id).items():
+            alive = now - heartbeat.get('at', 0) <= ttl
+            workers.append(dict(heartbeat, worker=worker, alive=alive, state=heartbeat.get('state') if alive else 'dead'))
+        alive = [worker for worker in workers if worker['alive']]
+
+        if alive:
+            state = 'paused' if all(worker['state'] == 'paused' for worker in alive) else 'running'
+        elif workers:
+            state = 'dead'
+        elif job.status in ('partial', 'paused') and job.chunks_done + job.chunks_failed + job.chunks_canceled < job.chunks_total:
+            state = 'waiting'
+        else:
+            state = job.status
 
-        print(f"Task {task_id} not running")
-        return False
+        return {
+            'running': len(alive) > 0,
+            'state': state,
+            'pages_per_second': round(sum(worker.get('pages_per_second', 0) for worker in alive), 3),
+            'workers': workers,
+        }
 
     def stop_job(self, job_id: int) -> bool:
+        '''
+        Cancels the current run of a job. Running chunks stop after their current tile and keep their
+        finished pages, queued chunks return right away. Workers are never terminated, so they keep their model.
+        '''
         job = self.get_job(job_id)
         task_id = job.last_task_id
         try:
             print(f"Canceling task {task_id}")
-            AsyncResult(task_id).revoke(terminate=True)
+            self.controlRedisRepository.set_command(job_id, 'cancel')
+            # only keeps the first task from starting if it is still queued
+            if task_id:
+                AsyncResult(task_id).revoke()
         except Exception as e:
             print(f"Error canceling task {task_id}: {e}")
             return False
         return True
 
+    def pause_job(self, job_id: int) -> bool:
+        '''
+        Pauses the current run of a job, its workers wait after their current tile with the model loaded.
+        Returns False if the job isn't running (queued, paused or finished jobs can't be paused).
+        '''
+        job = self.get_job(job_id)
+        # the status is checked and written in the same UPDATE
+        if not self.jobsDBRepository.transition_job_status(job.id, 'paused', from_status='partial'):
+            return False
+        try:
+            self.controlRedisRepository.set_command(job.id, 'pause')
+        except Exception as e:
+            print(f"Error pausing job {job_id}: {e}")
+            self.jobsDBRepository.transition_job_status(job.id, 'partial', from_status='paused')
+            return False
+        return True
+
+    def resume_job(self, job_id: int) -> bool:
+        '''
+        Resumes a paused job, a canceled job has to be started again instead.
+        '''
+        job = self.get_job(job_id)
+        try:
+            _, command = self.controlRedisRepository.get_state(job.id)
+            if command != 'pause':
+                return False
+            self.controlRedisRepository.clear_command(job.id)
+            self.jobsDBRepository.transition_job_status(job.id, 'partial')
+        except Exception as e:
+            print(f"Error resuming job {job_id}: {e}")
+            return False
+        return True
+
     def prepare_job_worker(self, job_data: Dict) -> bool:
         '''
         Verifies that a created job can be ran, and start the associated worker
@@ -96,9 +201,13 @@ class JobsManagerService:
         if not os.listdir(jobs_volumes_path):
             raise ValueError('Job volume is empty')
 
+        # chunks of an earlier run of the job see that they were superseded, and stop
+        job_data['run_id'] = uuid.uuid4().hex
+        self.controlRedisRepository.start_run(job_data['id'], job_data['run_id'])
 
         task_id = run_job_worker_task.apply_async(
             (job_data,),
+            priority=job_data.get('priority', 5),
             link=process_success.signature((job_data,)),
             link_error=process_error.signature((job_data,))
         )
@@ -1,6 +1,14 @@
-from celery import shared_task
+from celery import chord, group, shared_task
+from celery.exceptions import Ignore
+from celery.signals import worker_process_init
+from django.conf import settings
 from rg_server.celery import app
-from inference_implementation.inference import InferenceImplementation
+from inference_implementation.api.progress import Aborted
+from inference_implementation.device_pool import DevicePool
+from inference_implementation.pytorch.cpu_backend import CpuBackendSettings, configure_cpu_backend
+from billiard.process import current_process
+from inference_implementation.tools.settings import Precision
+from inference_implementation.upscale.tile_size_memory import TileSizeMemory
 from jobs_manager.repositories.local_files_repository import LocalFilesRepository
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
@@ -8,183 +16,387 @@ import os
 
 from library.repositories.books_db_repository import BooksDBRepository
 from jobs_manager.repositories.jobs_db_repository import JobsDBRepository
-from library.serializers import BookDetailSerializer
+from jobs_manager.repositories.pages_db_repository import PagesDBRepository
+from jobs_manager.repositories.progress_redis_repository import ProgressRedisRepository
+from jobs_manager.repositories.control_redis_repository import ControlRedisRepository
+from jobs_manager.repositories.heartbeat_redis_repository import HeartbeatRedisRepository
+from jobs_manager.services.job_control import JobControlToken, JobPaused
+from jobs_manager.services.job_heartbeat import JobHeartbeat
+from jobs_manager.services.job_progress_writer import JobProgressWriter
 
-inferenceImplementation = InferenceImplementation()
+inferenceDevicePool: DevicePool | None = None
 localFilesRepository = LocalFilesRepository()
 booksDBRepository = BooksDBRepository()
 jobsDBRepository = JobsDBRepository()
+pagesDBRepository = PagesDBRepository()
+progressRedisRepository = ProgressRedisRepository()
+controlRedisRepository = ControlRedisRepository()
+heartbeatRedisRepository = HeartbeatRedisRepository()
+
+UPSCALE_MODEL_FILE = "/app/inference_implementation/4x-eula-digimanga-bw-v2-nc1.pth"
+# retries of a failing chunk, retries of paused chunks are not limited
+CHUNK_MAX_RETRIES = 3
+
+def get_inference_device_pool() -> DevicePool:
+    '''
+    Returns the devices of this worker process, each with its own replica of the upscale model.
+    Created lazily, so that the pre-fork parent process never touches CUDA.
+    '''
+
+    global inferenceDevicePool
+    if inferenceDevicePool is None:
+        flat_tile_tolerance = getattr(settings, 'INFERENCE_FLAT_TILE_TOLERANCE', -1)
+        margin_tolerance = getattr(settings, 'INFERENCE_MARGIN_TRIM_TOLERANCE', -1)
+        inferenceDevicePool = DevicePool.from_spec(
+            getattr(settings, 'INFERENCE_DEVICES', 'auto'),
+            tile_size_memory=TileSizeMemory(getattr(settings, 'INFERENCE_TILE_SIZE_MEMORY_PATH', None)),
+            tile_batch_size=getattr(settings, 'INFERENCE_TILE_BATCH_SIZE', 1),
+            device_blend=getattr(settings, 'INFERENCE_DEVICE_BLEND', False),
+            flat_tolerance=flat_tile_tolerance if flat_tile_tolerance >= 0 else None,
+            margin_tolerance=margin_tolerance if margin_tolerance >= 0 else None,
+        )
+    return inferenceDevicePool
+
+def _get_job_control(job_data: dict) -> JobControlToken:
+    '''
+    Returns the pause / cancel state of the run of a job that `job_data` belongs to.
+    '''
+
+    return JobControlToken(
+        job_data['id'],
+        job_data.get('run_id'),
+        poll_seconds=getattr(settings, 'JOBS_CONTROL_POLL_SECONDS', 0.5),
+        max_suspend_seconds=getattr(settings, 'JOBS_PAUSE_SUSPEND_SECONDS', 60.0),
+        control_redis_repo=controlRedisRepository,
+    )
+
+def _record_aborted_chunk(job_data: dict, control: JobControlToken):
+    '''
+    Counts a chunk that stopped because its job was canceled. Chunks of a restarted job are not counted,
+    the counters already belong to the newer run.
+    '''
+
+    if not control.superseded:
+        jobsDBRepository.record_chunk(job_data['id'], canceled=True)
+
+@worker_process_init.connect
+def warm_inference_model(**kwargs):
+    '''
+    Loads the upscale model once per worker process and device, so that the first page of a job
+    does not pay for it.
+    '''
+
+    if not getattr(settings, 'INFERENCE_WARM_UP', True):
+        # cpu and io workers never run inference
+        return
+
+    try:
+        pool = get_inference_device_pool()
+        if any(device.type == 'cpu' for device in pool.devices):
+            # has to happen before the model is loaded
+            configure_cpu_backend(
+                CpuBackendSettings(
+                    intra_op_threads=getattr(settings, 'INFERENCE_CPU_THREADS', 0),
+                    inter_op_threads=getattr(settings, 'INFERENCE_CPU_INTEROP_THREADS', 1),
+                    channels_last=getattr(settings, 'INFERENCE_CPU_CHANNELS_LAST', True),
+                    onednn=getattr(settings, 'INFERENCE_CPU_ONEDNN', True),
+                    cores_per_worker=getattr(settings, 'INFERENCE_CPU_CORES_PER_WORKER', 0),
+                ),
+                worker_index=getattr(current_process(), 'index', 0) or 0,
+            )
+        pool.warm_up(UPSCALE_MODEL_FILE)
+    except Exception as e:
+        print(f"Error warming up inference model: {e}")
+
+def _send_to_process_group(event: dict):
+    channel_layer = get_channel_layer()
+    if channel_layer:
+        async_to_sync(channel_layer.group_send)('process_group', event)
+
+def _count_volumes_progress(job_id: int, volumes) -> list:
+    '''
+    Recounts the percentage of processed pages of every volume from the page ledger (a single query),
+    and resets the progress counters of the job to it.
+    '''
+
+    books_progress = pagesDBRepository.get_books_progress([volume.id for volume in volumes])
+    counters = [(volume.id, *books_progress.get(volume.id, (0, 0))) for volume in volumes]
+    progressRedisRepository.set_volumes(job_id, counters)
+    return [round(float((done / total) * 100), 2) if total > 0 else 0 for _, done, total in counters]
 
 @shared_task(bind=True, track_started=True)
 def calculate_job_progress(self, id: int, title_name: str) -> list:
     '''
-    This function calculates the progress of a job based on the number of processed files.
-    Intended to be used only to calculate the initial progress of a job.
+    Recounts the progress of a job from the page ledger and caches it in the progress counters.
+    Workers keep the counters up to date page by page, so this is only needed when a job starts or
+    ends, or as an explicit (rate-limited) reconcile, see JobsManagerService.reconcile_job_progress.
     '''
 
-    channel_layer = get_channel_layer()
     job_volumes_to_process = booksDBRepository.get_title_books_to_process(title_name)
-    job_volumes_progress = [0] * len(job_volumes_to_process)
-    for index, volume in enumerate(job_volumes_to_process):
-        print(str(volume.name))
-        if os.path.exists(f"/out/outputs/{volume.title.name}/{volume.name}"):
-            if os.path.exists(f"/out/{volume.title.name}/{volume.name}"):
-                current_volume_total_files = len(os.listdir(f"/out/{volume.title.name}/{volume.name}"))
-                current_volume_processed_files = len(os.listdir(f"/out/outputs/{volume.title.name}/{volume.name}"))
-                job_volumes_progress[index] = round(float((current_volume_processed_files / current_volume_total_files) * 100), 2)
-            else:
-                job_volumes_progress[index] = 0
+    job_volumes_progress = _count_volumes_progress(id, job_volumes_to_process)
 
-    if channel_layer:
-        async_to_sync(channel_layer.group_send)(
-            'process_group',
-            {
-                'type': 'process.progress',
-                'id': id,
-                'title_name': title_name,
-                'percentages': job_volumes_progress,
-                'step': 'Verifying'
-            }
-        )
+    _send_to_process_group({
+        'type': 'process.progress',
+        'id': id,
+        'title_name': title_name,
+        'percentages': job_volumes_progress,
+        'step': 'Verifying'
+    })
 
     return job_volumes_progress
 
 @app.task(bind=True, track_started=True)
 def run_job_worker_task(self, job_data: dict):
     '''
-    Orchestrate the whole processing of a job
-    Run inference tasks
+    Orchestrate the whole processing of a job.
+    The job is replaced by a chord: every volume is extracted by its own task, then the pages left to
+    process are upscaled in chunks by as many inference workers as are available, then the job is finalized.
+    The links of this task (process_success, process_error) are moved to the finalization.
     '''
 
-    channel_layer = get_channel_layer()
-    if channel_layer:
-        async_to_sync(channel_layer.group_send)(
-            'process_group',
-            {
-                'type': 'process.message',
-                'message': 'Job worker | Getting books'
-            }
-        )
+    _send_to_process_group({
+        'type': 'process.message',
+        'message': 'Job worker | Getting books'
+    })
 
     job_volumes_to_process = booksDBRepository.get_title_books_to_process(job_data["title_name"])
     job_volumes_names = [volume.name for volume in job_volumes_to_process]
     job_volumes_progress = calculate_job_progress(id=job_data["id"], title_name=job_data["title_name"])
 
-    # extracting books to process
-    if channel_layer:
-        async_to_sync(channel_layer.group_send)(
-            'process_group',
-            {
-                'type': 'process.message',
-                'message': 'Job worker | Found to process: ' + str(job_volumes_names),
-            }
-        )
-    else:
-        raise NotImplementedError("Channel layer is not available")
+    _send_to_process_group({
+        'type': 'process.message',
+        'message': 'Job worker | Found to process: ' + str(job_volumes_names),
+    })
+    _send_to_process_group({
+        'type': 'process.progress',
+        'id': job_data["id"],
+        'title_name': job_data["title_name"],
+        'percentages': job_volumes_progress,
+        'step': 'Initializing'
+    })
 
-    # HERE: Send process.progress message init progress status
-    if channel_layer:
-        async_to_sync(channel_layer.group_send)(
-            'process_group',
-            {
-                'type': 'process.progress',
-                'id': job_data["id"],
-                'title_name': job_data["title_name"],
-                'percentages': job_volumes_progress,
-                'step': 'Initializing'
-            }
-        )
+    priority = job_data.get('priority', 5)
+    raise self.replace(chord(
+        group([extract_volume_task.s(job_data, volume.id).set(priority=priority) for volume in job_volumes_to_process]),
+        dispatch_page_chunks_task.s(job_data).set(priority=priority),
+    ))
 
-    #=========
-    # Per volume worker
-    #=========
-    for index, volume in enumerate(job_volumes_to_process):
+@app.task(bind=True, track_started=True, autoretry_for=(OSError,), retry_backoff=True, retry_kwargs={'max_retries': 3})
+def extract_volume_task(self, job_data: dict, volume_id: int) -> dict:
+    '''
+    Extracts a volume of a job, registers its pages in the ledger and returns the ids of the pages
+    that are not processed yet. Volumes the ledger knows to be done are not extracted again.
+    '''
+
+    volume = booksDBRepository.get_book_by_id(volume_id)
+    if volume is None:
+        raise ValueError(f"Book with id {volume_id} does not exist")
+
+    done, total = pagesDBRepository.get_books_progress([volume_id]).get(volume_id, (0, 0))
+    if total == 0 or done < total:
         volume_extraction_path = localFilesRepository.extract(str(volume.title.name), str(volume.file_path))
+        pagesDBRepository.register_pages(volume_id, [
+            (
+                member,
+                os.path.join(volume_extraction_path, member),
+                f"/out/outputs/{volume.title.name}/{volume.name}/{os.path.splitext(member)[0]} processed.jpg",
+            )
+            for member in sorted(os.listdir(volume_extraction_path))
+        ])
+        done, total = pagesDBRepository.get_books_progress([volume_id]).get(volume_id, (0, 0))
+        progressRedisRepository.set_volume(job_data['id'], volume_id, done, total)
+    page_ids = pagesDBRepository.get_page_ids_to_process(volume_id)
+
+    _send_to_process_group({
+        'type': 'process.message',
+        'message': f'Extraction | {volume.name}: {len(page_ids)} images to process'
+    })
+
+    return {'volume_id': volume_id, 'pages': page_ids}
+
+@app.task(bind=True, track_started=True)
+def dispatch_page_chunks_task(self, volumes: list, job_data: dict):
+    '''
+    Splits the pages left to process into chunks of INFERENCE_CHUNK_SIZE pages, which are upscaled
+    independently of each other, and finalizes the job once every chunk is done.
+    '''
+
+    chunk_size = max(1, getattr(settings, 'INFERENCE_CHUNK_SIZE', 16))
+    priority = job_data.get('priority', 5)
+    chunks = [
+        infer_page_chunk_task.s(job_data, volume['volume_id'], volume['pages'][start:start + chunk_size]).set(priority=priority)
+        for volume in volumes
+        for start in range(0, len(volume['pages']), chunk_size)
+    ]
+    jobsDBRepository.start_job_chunks(job_data['id'], len(chunks))
+
+    _send_to_process_group({
+        'type': 'process.message',
+        'message': f'Inference | Processing {sum(len(volume["pages"]) for volume in volumes)} images in {len(chunks)} chunks'
+    })
+
+    if not chunks:
+        return finalize_job_task([], job_data)
+    raise self.replace(chord(group(chunks), finalize_job_task.s(job_data).set(priority=priority)))
+
+@app.task(bind=True, track_started=True, acks_late=True, max_retries=None)
+def infer_page_chunk_task(self, job_data: dict, volume_id: int, pages: list, failures: int = 0) -> dict:
+    '''
+    Upscales a chunk of pages (ledger ids) of a volume. A failing chunk is retried on its own, pages
+    that were already done by an earlier attempt are skipped.
+    Returns the number of processed and failed pages, a chunk that still fails after its retries
+    doesn't stop the other chunks of the job.
+    The chunk waits between tiles while the job is paused, and stops cleanly once it is canceled,
+    putting its unfinished pages back to pending. The model stays loaded for the next job.
+    Chunks of a paused job are queued again instead of holding the worker, including running chunks
+    once the pause lasts longer than JOBS_PAUSE_SUSPEND_SECONDS.
+    '''
+
+    volume = booksDBRepository.get_book_by_id(volume_id)
+    pages_to_process = pagesDBRepository.get_pages_to_process(pages)
+    processed = len(pages) - len(pages_to_process)
+    control = _get_job_control(job_data)
+    if control.aborted:
+        # canceled (or started again) while the chunk was queued
+        _record_aborted_chunk(job_data, control)
+        return {'volume_id': volume_id, 'processed': processed, 'failed': 0, 'aborted': True}
+    if control.paused:
+        # let the worker serve other jobs, the chunk keeps its place in the chord
+        raise self.retry(countdown=getattr(settings, 'JOBS_PAUSED_RETRY_SECONDS', 30), kwargs={'failures': failures})
+    pagesDBRepository.start_pages([page.id for page in pages_to_process], job_data['id'])
+    # status transitions are written once, finished pages in batches
+    writer = JobProgressWriter(
+        job_data['id'],
+        batch_pages=getattr(settings, 'JOBS_PROGRESS_BATCH_PAGES', 16),
+        batch_seconds=getattr(settings, 'JOBS_PROGRESS_BATCH_SECONDS', 5.0),
+        jobs_db_repo=jobsDBRepository,
+        books_db_repo=booksDBRepository,
+        pages_db_repo=pagesDBRepository,
+        progress_redis_repo=progressRedisRepository,
+    )
+
+    def send_progress():
+        _send_to_process_group({
+            'type': 'process.progress',
+            'id': job_data["id"],
+            'title_name': job_data["title_name"],
+            'percentages': progressRedisRepository.get_progress(job_data['id']),
+            'step': 'Inference'
+        })
+
+    # lets the status endpoint tell running, paused and dead workers apart
+    heartbeat = JobHeartbeat(
+        job_data['id'],
+        f'{self.request.hostname}/{self.request.id}',
+        interval=getattr(settings, 'JOBS_HEARTBEAT_SECONDS', 5.0),
+        control=control,
+        heartbeat_redis_repo=heartbeatRedisRepository,
+    )
+    heartbeat.set_volume(volume_id, volume.name)
+
+    with heartbeat:
+        try:
+            # 'auto' leaves the choice to the worker and model defaults
+            job_precision = job_data.get("precision", "auto")
+            precision = None if job_precision == "auto" else Precision(job_precision)
+
+            # decoding, inference and encoding overlap, pages of the same size are upscaled together
+            # and batches are spread over every device of the worker
+            pipeline = get_inference_device_pool().create_pipeline(
+                UPSCALE_MODEL_FILE,
+                precision,
+                prefetch_depth=getattr(settings, "INFERENCE_PREFETCH_DEPTH", 2),
+                encode_depth=getattr(settings, "INFERENCE_ENCODE_DEPTH", 2),
+                batch_size=getattr(settings, "INFERENCE_BATCH_SIZE", 4),
+                progress=control,
+            )
+            # the pipeline yields a page once its output is written, only then is it done in the ledger
+            for page in pipeline.run(
+                (page.source_path, os.path.splitext(page.output_path)[0], page) for page in pages_to_process
+            ):
+                processed += 1
+                writer.set_job_status('partial')
+                writer.set_book_status(volume_id, 'partial')
+
+                _send_to_process_group({
+                    'type': 'process.message',
+                    'message': f'Inference | Image processed !'
+                })
+                if writer.page_done(page.id, volume_id, localFilesRepository.checksum(page.output_path)):
+                    send_progress()
+                heartbeat.page_done(page.source_member)
+            writer.flush()
+            send_progress()
+            print(f"Volume {volume.name} chunk stage timings: {pipeline.stats.as_dict()}")
+            print(f"Volume {volume.name} device usage: {get_inference_device_pool().stats()}")
+        except JobPaused:
+            writer.flush()
+            send_progress()
+            pagesDBRepository.release_pages([page.id for page in pages_to_process])
+            print(f"Queued a chunk of {volume.name} again, job {job_data['id']} is paused")
+            raise self.retry(countdown=getattr(settings, 'JOBS_PAUSED_RETRY_SECONDS', 30), kwargs={'failures': failures})
+        except Aborted:
+            # pages finished before the cancel stay done, the others can be picked up by the next run
+            writer.flush()
+            send_progress()
+            pagesDBRepository.release_pages([page.id for page in pages_to_process])
+            print(f"Stopped a chunk of {volume.name}, job {job_data['id']} was canceled or restarted")
+            _record_aborted_chunk(job_data, control)
+            return {'volume_id': volume_id, 'processed': processed, 'failed': 0, 'aborted': True}
+        except Exception as e:
+            # pages finished before the failure stay done
+            writer.flush()
+            pagesDBRepository.fail_pages([page.id for page in pages_to_process])
+            if failures < CHUNK_MAX_RETRIES:
+                raise self.retry(exc=e, countdown=2 ** failures, kwargs={'failures': failures + 1})
+            print(f"Error processing a chunk of {volume.name}: {e}")
+            jobsDBRepository.record_chunk(job_data['id'], failed=True)
+            return {'volume_id': volume_id, 'processed': processed, 'failed': len(pages) - processed}
+
+        jobsDBRepository.record_chunk(job_data['id'])
+        return {'volume_id': volume_id, 'processed': processed, 'failed': len(pages) - processed}
+
+@app.task(bind=True, track_started=True)
+def finalize_job_task(self, chunk_results: list, job_data: dict):
+    '''
+    Marks the job (and its fully processed volumes) as completed once every chunk is done.
+    Raises if pages failed, so that process_error is sent instead of process_success.
+    Canceled runs neither send process_success nor process_error.
+    '''
+
+    failed = sum(result['failed'] for result in chunk_results)
+    job_volumes = booksDBRepository.get_title_books_to_process(job_data["title_name"])
+    job_volumes_progress = _count_volumes_progress(job_data['id'], job_volumes)
+    for volume, progress in zip(job_volumes, job_volumes_progress):
+        if progress >= 100:
+            booksDBRepository.transition_book_status(volume.id, 'completed')
+
+    control = _get_job_control(job_data)
+    if control.superseded:
+        # the newer run reports the status of the job
+        raise Ignore()
+    if control.canceled:
+        jobsDBRepository.finish_job(job_data['id'], 'canceled')
+        _send_to_process_group({
+            'type': 'process.message',
+            'message': f'Job canceled: {job_data["title_name"]}'
+        })
+        raise Ignore()
+
+    jobsDBRepository.finish_job(job_data['id'], 'failed' if failed else 'completed')
+    _send_to_process_group({
+        'type': 'process.progress',
+        'id': job_data["id"],
+        'title_name': job_data["title_name"],
+        'percentages': job_volumes_progress,
+        'step': 'Finalization'
+    })
 
-        print("Running inference task")
-
-
-        files_to_process = sorted([os.path.join(volume_extraction_path, f) for f in os.listdir(volume_extraction_path)])
-        current_volume_total_files = len(files_to_process)
-        current_volume_processed_files = 0
-        for image_full_path in files_to_process:
-            image_name = os.path.splitext(os.path.basename(image_full_path))[0]
-            if not os.path.exists(f"/out/outputs/{volume.title.name}/{volume.name}/{image_name} processed.jpg"):
-                if channel_layer:
-                    async_to_sync(channel_layer.group_send)(
-                        'process_group',
-                        {
-                            'type': 'process.message',
-                            'message': f'Inference | Processing image: {image_full_path}'
-                        }
-                    )
-                    async_to_sync(channel_layer.group_send)(
-                        'process_group',
-                        {
-                            'type': 'process.progress',
-                            'id': job_data["id"],
-                            'title_name': job_data["title_name"],
-                            'percentages': job_volumes_progress,
-                            'step': 'Inference'
-                        }
-                    )
-                inferenceImplementation.process_image(
-                    image_full_path,
-                    "/app/inference_implementation/4x-eula-digimanga-bw-v2-nc1.pth",
-                    f"/out/outputs/{volume.title.name}/{volume.name}/{image_name} processed"
-                )
-                if os.path.exists(f"/out/outputs/{volume.title.name}/{volume.name}/{image_name} processed.jpg"):
-                    # update job and book status etc
-                    current_volume_processed_files += 1
-                    serialized_book_data = BookDetailSerializer(volume).data
-                    job_data['status'] = 'partial'
-                    serialized_book_data['status'] = 'partial'
-                    jobsDBRepository.update_job(job_data)
-                    booksDBRepository.update_book(serialized_book_data)
-                    job_volumes_progress[index] = round(float((current_volume_processed_files / current_volume_total_files) * 100), 2)
-
-                    if channel_layer:
-                        async_to_sync(channel_layer.group_send)(
-                            'process_group',
-                            {
-                                'type': 'process.message',
-                                'message': f'Inference | Image processed !'
-                            }
-                        )
-                        async_to_sync(channel_layer.group_send)(
-                            'process_group',
-                            {
-                                'type': 'process.progress',
-                                'id': job_data["id"],
-                                'title_name': job_data["title_name"],
-                                'percentages': job_volumes_progress,
-                                'step': 'Inference'
-                            }
-                        )
-            else:
-                current_volume_processed_files += 1
-                job_volumes_progress[index] = round(float((current_volume_processed_files / current_volume_total_files) * 100), 2)
-
-                if channel_layer:
-                    async_to_sync(channel_layer.group_send)(
-                        'process_group',
-                        {
-                            'type': 'process.message',
-                            'message': f'Inference | Image {str(current_volume_processed_files)} already processed !'
-                        }
-                    )
-                    async_to_sync(channel_layer.group_send)(
-                        'process_group',
-                        {
-                            'type': 'process.progress',
-                            'id': job_data["id"],
-                            'title_name': job_data["title_name"],
-                            'percentages': job_volumes_progress,
-                            'step': 'Verifying'
-                        }
-                    )
-        # TODO
-        # localFilesRepository.archive()
+    # TODO
+    # localFilesRepository.archive()
+    if failed:
+        raise RuntimeError(f"{failed} pages of job {job_data['id']} could not be processed")
+    return job_data['id']
 
 @app.task(bind=True, track_started=True)
 def process_success(self, unknown_arg, job_data):
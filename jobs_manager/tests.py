@@ -1,3 +1,541 @@
-from django.test import TestCase
+import time
+import fakeredis
+from unittest import mock
+from celery.exceptions import Retry
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from jobs_manager import tasks
+from inference_implementation.api.progress import Aborted
+from jobs_manager.models import Job, Page
+from jobs_manager.repositories.jobs_db_repository import JobsDBRepository
+from jobs_manager.repositories.control_redis_repository import ControlRedisRepository
+from jobs_manager.repositories.pages_db_repository import PagesDBRepository
+from jobs_manager.repositories.progress_redis_repository import ProgressRedisRepository
+from jobs_manager.services.job_control import JobControlToken, JobPaused
+from jobs_manager.services.job_heartbeat import JobHeartbeat
+from jobs_manager.services.jobs_manager_service import JobsManagerService
+from jobs_manager.services.job_progress_writer import JobProgressWriter
+from library.models import Book, Title
+from rest_framework.test import APIClient
 
-# Create your tests here.
+class PagesDBRepositoryTest(TestCase):
+    def setUp(self):
+        self.repository = PagesDBRepository()
+        title = Title._default_manager.create(name='Test Series', directory_path='/books/Test Series')
+        self.book = Book._default_manager.create(name='Test Book 1', author='Test Author', title=title)
+        self.job = Job._default_manager.create(title_name='Test Series', title_path='/books/Test Series', used_model_name='model')
+        self.pages = [
+            (f'{index:03}.jpg', f'/out/Test Series/Test Book 1/{index:03}.jpg', f'/out/outputs/Test Series/Test Book 1/{index:03} processed.jpg')
+            for index in range(4)
+        ]
+
+    def test_register_pages_keeps_the_state_of_known_pages(self):
+        self.repository.register_pages(self.book.id, self.pages[:2])
+        page_ids = self.repository.get_page_ids_to_process(self.book.id)
+        self.repository.start_pages(page_ids[:1], self.job.id)
+        self.repository.finish_page(page_ids[0], 'checksum')
+
+        self.repository.register_pages(self.book.id, self.pages)
+
+        self.assertEqual(Page._default_manager.count(), 4)
+        self.assertEqual(len(self.repository.get_page_ids_to_process(self.book.id)), 3)
+        self.assertEqual(Page._default_manager.get(id=page_ids[0]).state, 'done')
+
+    def test_attempts_and_failures(self):
+        self.repository.register_pages(self.book.id, self.pages)
+        page_ids = self.repository.get_page_ids_to_process(self.book.id)
+        self.repository.start_pages(page_ids, self.job.id)
+        self.repository.finish_page(page_ids[0], 'checksum')
+        self.repository.fail_pages(page_ids)
+        self.repository.start_pages([page.id for page in self.repository.get_pages_to_process(page_ids)], self.job.id)
+
+        first = Page._default_manager.get(id=page_ids[0])
+        self.assertEqual((first.state, first.attempts, first.checksum), ('done', 1, 'checksum'))
+        second = Page._default_manager.get(id=page_ids[1])
+        self.assertEqual((second.state, second.attempts, second.job_id), ('processing', 2, self.job.id))
+
+    def test_books_progress(self):
+        self.repository.register_pages(self.book.id, self.pages)
+        page_ids = self.repository.get_page_ids_to_process(self.book.id)
+        self.repository.finish_page(page_ids[0], 'checksum')
+
+        self.assertEqual(self.repository.get_books_progress([self.book.id, self.book.id + 1]), {self.book.id: (1, 4)})
+
+
+class ProgressRedisRepositoryTest(SimpleTestCase):
+    def setUp(self):
+        self.repository = ProgressRedisRepository(fakeredis.FakeRedis())
+
+    def test_progress_of_volumes(self):
+        self.assertIsNone(self.repository.get_progress(1))
+
+        self.repository.set_volumes(1, [(12, 0, 4), (10, 1, 2), (11, 0, 0)])
+        self.assertEqual(self.repository.get_progress(1), [0, 50.0, 0])
+        self.repository.increment_done(1, 12)
+        self.repository.increment_done(1, 10, 3)
+        # pages processed twice (e.g. by a retried chunk) don't go over 100%
+        self.assertEqual(self.repository.get_progress(1), [25.0, 100.0, 0])
+
+        self.repository.set_volume(1, 11, 1, 3)
+        self.assertEqual(self.repository.get_progress(1), [25.0, 100.0, 33.33])
+        self.assertIsNone(self.repository.get_progress(2))
+
+        # the counters are replaced, not merged
+        self.repository.set_volumes(1, [(10, 2, 2)])
+        self.assertEqual(self.repository.get_progress(1), [100.0])
+        self.repository.delete(1)
+        self.assertIsNone(self.repository.get_progress(1))
+
+    def test_reconcile_is_rate_limited(self):
+        self.assertTrue(self.repository.try_reconcile(1, 60))
+        self.assertFalse(self.repository.try_reconcile(1, 60))
+        self.assertTrue(self.repository.try_reconcile(2, 60))
+        self.assertLessEqual(self.repository.client.ttl('jobs:1:reconciled'), 60)
+
+        self.repository.delete(1)
+        self.assertTrue(self.repository.try_reconcile(1, 60))
+
+class ReconcileJobProgressViewTest(TestCase):
+    def setUp(self):
+        title = Title._default_manager.create(name='Test Series', directory_path='/books/Test Series')
+        self.book = Book._default_manager.create(name='Test Book 1', author='Test Author', title=title)
+        self.job = Job._default_manager.create(title_name='Test Series', title_path='/books/Test Series', used_model_name='model', status='partial')
+        PagesDBRepository().register_pages(self.book.id, [('001.jpg', '/in/001.jpg', '/out/001 processed.jpg')])
+        self.progress = ProgressRedisRepository(fakeredis.FakeRedis())
+        for patch in (
+            mock.patch('jobs_manager.views.JobsManagerService', lambda: JobsManagerService(progress_redis_repo=lambda: self.progress)),
+            mock.patch.object(tasks, 'progressRedisRepository', self.progress),
+            mock.patch.object(tasks, '_send_to_process_group', lambda message: None),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model()._default_manager.create_user(username='user', password='password'))
+
+    def test_reconcile_is_rate_limited(self):
+        url = f'/api/jobs/progress/reconcile/{self.job.id}'
+        self.assertEqual(self.client.post(url).status_code, 200)
+        self.assertEqual(self.progress.get_progress(self.job.id), [0])
+
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('error', response.json())
+
+    def test_reconcile_needs_a_user(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.post(f'/api/jobs/progress/reconcile/{self.job.id}').status_code, 401)
+
+class _RecordingProgressRepository:
+    def __init__(self):
+        self.increments = []
+
+    def increment_done(self, job_id, book_id, amount=1):
+        self.increments.append((job_id, book_id, amount))
+
+    def set_volumes(self, job_id, volumes):
+        pass
+
+    def set_volume(self, job_id, book_id, done, total):
+        pass
+
+    def get_progress(self, job_id):
+        return []
+
+class JobProgressWriterTest(TestCase):
+    def setUp(self):
+        title = Title._default_manager.create(name='Test Series', directory_path='/books/Test Series')
+        self.book = Book._default_manager.create(name='Test Book 1', author='Test Author', title=title)
+        self.job = Job._default_manager.create(title_name='Test Series', title_path='/books/Test Series', used_model_name='model', status='original')
+        self.pages = PagesDBRepository()
+        self.pages.register_pages(self.book.id, [(f'{index:03}.jpg', f'{index:03}.jpg', f'{index:03} processed.jpg') for index in range(5)])
+        self.page_ids = self.pages.get_page_ids_to_process(self.book.id)
+        self.progress = _RecordingProgressRepository()
+        self.now = 0.0
+        self.writer = JobProgressWriter(self.job.id, batch_pages=2, batch_seconds=10, progress_redis_repo=self.progress, clock=lambda: self.now)  # type: ignore
+
+    def test_statuses_are_only_written_on_transitions(self):
+        with self.assertNumQueries(2):
+            for _ in range(3):
+                self.writer.set_job_status('partial')
+                self.writer.set_book_status(self.book.id, 'partial')
+
+        self.assertEqual(Job._default_manager.get(id=self.job.id).status, 'partial')
+        self.assertEqual(Book._default_manager.get(id=self.book.id).status, 'partial')
+        # an UPDATE that matches no row, the status is already set
+        self.assertFalse(JobsDBRepository().transition_job_status(self.job.id, 'partial'))
+
+    def test_finished_pages_are_written_in_batches(self):
+        with self.assertNumQueries(0):
+            self.assertFalse(self.writer.page_done(self.page_ids[0], self.book.id, 'a'))
+        self.assertTrue(self.writer.page_done(self.page_ids[1], self.book.id, 'b'))
+        self.assertEqual(self.progress.increments, [(self.job.id, self.book.id, 2)])
+
+        # or after some time
+        self.writer.page_done(self.page_ids[2], self.book.id, 'c')
+        self.now = 11
+        self.assertTrue(self.writer.page_done(self.page_ids[3], self.book.id, 'd'))
+
+        self.writer.page_done(self.page_ids[4], self.book.id, 'e')
+        self.writer.flush()
+        self.assertEqual(sum(amount for _, _, amount in self.progress.increments), 5)
+        self.assertEqual(self.pages.get_books_progress([self.book.id]), {self.book.id: (5, 5)})
+        self.assertEqual(Page._default_manager.get(id=self.page_ids[4]).checksum, 'e')
+
+class _FakeControlRepository:
+    def __init__(self, run_id=None, command=None):
+        self.run_id = run_id
+        self.command = command
+        self.reads = 0
+
+    def get_state(self, job_id):
+        self.reads += 1
+        return self.run_id, self.command
+
+class JobControlTokenTest(SimpleTestCase):
+    def setUp(self):
+        self.control = _FakeControlRepository(run_id='run-1')
+        self.now = 0.0
+        self.token = JobControlToken(1, 'run-1', poll_seconds=1, control_redis_repo=self.control, clock=lambda: self.now, sleep=self._sleep)  # type: ignore
+
+    def _sleep(self, seconds):
+        # the job is resumed while the worker waits
+        self.now += seconds
+        self.control.command = None
+
+    def test_state_is_read_at_most_once_per_poll_interval(self):
+        for _ in range(100):
+            self.token.check_aborted()
+        self.assertEqual(self.control.reads, 1)
+
+        self.control.command = 'cancel'
+        self.token.check_aborted()
+        self.now = 1
+        with self.assertRaises(Aborted):
+            self.token.check_aborted()
+        self.assertTrue(self.token.canceled)
+        self.assertFalse(self.token.superseded)
+
+    def test_a_newer_run_supersedes_the_token(self):
+        self.control.run_id = 'run-2'
+        self.assertTrue(self.token.aborted)
+        self.assertTrue(self.token.superseded)
+        # the command of the newer run doesn't matter anymore
+        self.control.run_id, self.now = 'run-1', 5
+        self.assertTrue(self.token.aborted)
+
+    def test_suspend_waits_until_resumed(self):
+        self.control.command = 'pause'
+        self.assertTrue(self.token.paused)
+        self.token.suspend()
+        self.assertFalse(self.token.paused)
+        self.assertEqual(self.now, 1)
+
+    def test_suspend_is_bounded(self):
+        token = JobControlToken(1, 'run-1', poll_seconds=1, max_suspend_seconds=5, control_redis_repo=self.control, clock=lambda: self.now, sleep=self._sleep_paused)  # type: ignore
+        self.control.command = 'pause'
+        with self.assertRaises(JobPaused):
+            token.suspend()
+        self.assertEqual(self.now, 5)
+        # the worker stops like on a cancel
+        self.assertTrue(issubclass(JobPaused, Aborted))
+
+    def _sleep_paused(self, seconds):
+        self.now += seconds
+
+class _FakeHeartbeatRepository:
+    def __init__(self, heartbeats=None):
+        self.heartbeats = heartbeats or {}
+        self.beats = []
+        self.cleared = []
+
+    def beat(self, job_id, worker, state):
+        self.beats.append((job_id, worker, state))
+
+    def clear(self, job_id, worker):
+        self.cleared.append((job_id, worker))
+
+    def get_heartbeats(self, job_id):
+        return self.heartbeats
+
+class JobHeartbeatTest(SimpleTestCase):
+    def test_state_is_published_while_the_chunk_runs(self):
+        repository = _FakeHeartbeatRepository()
+        control = JobControlToken(1, None, control_redis_repo=_FakeControlRepository(command='pause'))  # type: ignore
+        self.now = 0.0
+        heartbeat = JobHeartbeat(1, 'worker', interval=60, control=control, heartbeat_redis_repo=repository, clock=lambda: self.now)  # type: ignore
+        heartbeat.set_volume(2, 'Volume 1')
+
+        with heartbeat:
+            self.assertEqual(len(repository.beats), 1)
+            heartbeat.page_done('001.jpg')
+            heartbeat.page_done('002.jpg')
+            self.now = 4
+            state = heartbeat.state()
+        self.assertEqual(state, {
+            'state': 'paused', 'volume_id': 2, 'volume': 'Volume 1', 'page': '002.jpg', 'pages_done': 2, 'pages_per_second': 0.5,
+        })
+        self.assertEqual(repository.cleared, [(1, 'worker')])
+
+class JobStatusTest(TestCase):
+    def setUp(self):
+        self.job = Job._default_manager.create(title_name='Test Series', title_path='/books/Test Series', used_model_name='model', status='partial', chunks_total=4, chunks_done=1)
+        self.heartbeats = _FakeHeartbeatRepository()
+        self.service = JobsManagerService(heartbeat_redis_repo=lambda: self.heartbeats)
+
+    def _heartbeat(self, state, age, pages_per_second=1.0):
+        return {'state': state, 'at': time.time() - age, 'pages_per_second': pages_per_second}
+
+    def test_states_from_heartbeats(self):
+        self.assertEqual(self.service.get_job_status(self.job.id)['state'], 'waiting')
+
+        self.heartbeats.heartbeats = {'a': self._heartbeat('running', 1), 'b': self._heartbeat('paused', 2, 0.5), 'c': self._heartbeat('running', 600)}
+        status = self.service.get_job_status(self.job.id)
+        self.assertTrue(status['running'])
+        self.assertEqual(status['state'], 'running')
+        self.assertEqual(status['pages_per_second'], 1.5)
+        self.assertEqual([worker['state'] for worker in status['workers']], ['running', 'paused', 'dead'])
+
+        self.heartbeats.heartbeats = {'a': self._heartbeat('paused', 1)}
+        self.assertEqual(self.service.get_job_status(self.job.id)['state'], 'paused')
+
+        # the workers stopped beating without finishing their chunks
+        self.heartbeats.heartbeats = {'a': self._heartbeat('running', 600)}
+        status = self.service.get_job_status(self.job.id)
+        self.assertFalse(status['running'])
+        self.assertEqual(status['state'], 'dead')
+
+class PauseJobTest(TestCase):
+    def setUp(self):
+        self.job = Job._default_manager.create(title_name='Test Series', title_path='/books/Test Series', used_model_name='model', status='partial')
+        self.control = ControlRedisRepository(fakeredis.FakeRedis())
+        self.service = JobsManagerService(control_redis_repo=lambda: self.control)
+
+    def test_running_jobs_are_paused(self):
+        self.assertTrue(self.service.pause_job(self.job.id))
+        self.assertEqual(Job._default_manager.get(id=self.job.id).status, 'paused')
+        self.assertEqual(self.control.get_state(self.job.id), (None, 'pause'))
+
+    def test_jobs_that_are_not_running_are_not_paused(self):
+        for status in ('original', 'paused', 'canceled', 'completed', 'failed'):
+            Job._default_manager.filter(id=self.job.id).update(status=status)
+            self.assertFalse(self.service.pause_job(self.job.id), status)
+            self.assertEqual(Job._default_manager.get(id=self.job.id).status, status)
+        self.assertEqual(self.control.get_state(self.job.id), (None, None))
+
+    def test_pause_view_conflicts_for_jobs_that_are_not_running(self):
+        Job._default_manager.filter(id=self.job.id).update(status='completed')
+        client = APIClient()
+        client.force_authenticate(get_user_model()._default_manager.create_user(username='user', password='password'))
+        with mock.patch('jobs_manager.views.JobsManagerService', lambda: self.service):
+            response = client.post(f'/api/jobs/pause/{self.job.id}')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(response.json()['status'])
+
+class _FakePipeline:
+    '''Yields the pages it is given, optionally raising after `fail_after` of them.'''
+
+    def __init__(self, fail_after=None, error=None):
+        self.fail_after = fail_after
+        self.error = error
+        self.stats = mock.MagicMock()
+
+    def run(self, items):
+        for index, (_, _, page) in enumerate(items):
+            if index == self.fail_after:
+                raise self.error
+            yield page
+
+class _FakeDevicePool:
+    def __init__(self):
+        self.pipelines = []
+
+    def create_pipeline(self, *args, **kwargs):
+        return self.pipelines.pop(0)
+
+    def stats(self):
+        return []
+
+class _FakeFilesRepository:
+    def checksum(self, path):
+        return 'checksum'
+
+class _Replaced(Exception):
+    @property
+    def signature(self):
+        return self.args[0]
+
+class _TaskTestCase(TestCase):
+    '''
+    Runs the job tasks directly, with the database of the test and fakes for Redis and the channel layer.
+    '''
+
+    def setUp(self):
+        title = Title._default_manager.create(name='Test Series', directory_path='/books/Test Series')
+        self.book = Book._default_manager.create(name='Test Book 1', author='Test Author', title=title)
+        self.job = Job._default_manager.create(title_name='Test Series', title_path='/books/Test Series', used_model_name='model', status='partial')
+        self.job_data = {'id': self.job.id, 'title_name': 'Test Series', 'run_id': 'run-1'}
+        self.pages = PagesDBRepository()
+        self.pages.register_pages(self.book.id, [(f'{index:03}.jpg', f'/in/{index:03}.jpg', f'/out/{index:03} processed.jpg') for index in range(5)])
+        self.page_ids = self.pages.get_page_ids_to_process(self.book.id)
+        self.control = _FakeControlRepository(run_id='run-1')
+        self.progress = _RecordingProgressRepository()
+        self.events = []
+        self.device_pool = _FakeDevicePool()
+        for patch in (
+            mock.patch.object(tasks, 'get_inference_device_pool', lambda: self.device_pool),
+            mock.patch.object(tasks, 'localFilesRepository', _FakeFilesRepository()),
+            mock.patch.object(tasks, 'controlRedisRepository', self.control),
+            mock.patch.object(tasks, 'progressRedisRepository', self.progress),
+            mock.patch.object(tasks, 'heartbeatRedisRepository', _FakeHeartbeatRepository()),
+            mock.patch.object(tasks, '_send_to_process_group', self.events.append),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _replace(self, task):
+        '''Makes the given task raise the signature it would be replaced with.'''
+        # `replace` returns the exception that the task raises
+        patch = mock.patch.object(task, 'replace', side_effect=lambda signature: _Replaced(signature))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _retry(self, task):
+        '''Records the retries of the given task instead of running them.'''
+        retry = mock.MagicMock(side_effect=Retry())
+        patch = mock.patch.object(task, 'retry', retry)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return retry
+
+class InferPageChunkTaskTest(_TaskTestCase):
+    def test_chunks_of_a_paused_job_are_queued_again(self):
+        retry = self._retry(tasks.infer_page_chunk_task)
+        self.control.command = 'pause'
+        with self.settings(JOBS_PAUSED_RETRY_SECONDS=7):
+            with self.assertRaises(Retry):
+                tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids, failures=1)
+
+        retry.assert_called_once_with(countdown=7, kwargs={'failures': 1})
+        # the pages were not taken
+        self.assertEqual(self.pages.get_books_progress([self.book.id]), {self.book.id: (0, 5)})
+        self.assertFalse(Page._default_manager.filter(state='processing').exists())
+
+    def test_a_long_pause_releases_the_pages_of_a_running_chunk(self):
+        retry = self._retry(tasks.infer_page_chunk_task)
+        self.device_pool.pipelines.append(_FakePipeline(fail_after=2, error=JobPaused()))
+        with self.settings(JOBS_PAUSED_RETRY_SECONDS=7, JOBS_PROGRESS_BATCH_PAGES=1):
+            with self.assertRaises(Retry):
+                tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids)
+
+        retry.assert_called_once_with(countdown=7, kwargs={'failures': 0})
+        self.assertEqual(self.pages.get_books_progress([self.book.id]), {self.book.id: (2, 5)})
+        self.assertEqual(Page._default_manager.filter(state='pending').count(), 3)
+
+    def test_aborted_chunks_are_counted_for_canceled_jobs_only(self):
+        # canceled while queued
+        self.control.command = 'cancel'
+        self.assertTrue(tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids[:2])['aborted'])
+
+        # canceled while running, the inference stops after the first page
+        self.control.command = None
+        self.device_pool.pipelines.append(_FakePipeline(fail_after=1, error=Aborted()))
+        result = tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids[2:])
+        self.assertEqual((result['processed'], result['failed'], result['aborted']), (1, 0, True))
+        self.assertEqual(Page._default_manager.filter(state='pending').count(), 4)
+
+        job = Job._default_manager.get(id=self.job.id)
+        self.assertEqual((job.chunks_done, job.chunks_failed, job.chunks_canceled), (0, 0, 2))
+
+        # a newer run owns the counters
+        self.control.run_id = 'run-2'
+        tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids)
+        self.assertEqual(Job._default_manager.get(id=self.job.id).chunks_canceled, 2)
+
+    def test_failing_chunks_are_retried_then_counted(self):
+        retry = self._retry(tasks.infer_page_chunk_task)
+        self.device_pool.pipelines.append(_FakePipeline(fail_after=2, error=RuntimeError('decode failed')))
+        with self.settings(JOBS_PROGRESS_BATCH_PAGES=1):
+            with self.assertRaises(Retry):
+                tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids, failures=1)
+        self.assertEqual(retry.call_args.kwargs['countdown'], 2)
+        self.assertEqual(retry.call_args.kwargs['kwargs'], {'failures': 2})
+        self.assertEqual(Page._default_manager.filter(state='failed').count(), 3)
+
+        # the last attempt only has the failed pages left, and gives up on them
+        self.device_pool.pipelines.append(_FakePipeline(fail_after=0, error=RuntimeError('decode failed')))
+        result = tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids, failures=tasks.CHUNK_MAX_RETRIES)
+        self.assertEqual(result, {'volume_id': self.book.id, 'processed': 2, 'failed': 3})
+        job = Job._default_manager.get(id=self.job.id)
+        self.assertEqual((job.chunks_done, job.chunks_failed), (0, 1))
+        self.assertEqual(self.pages.get_books_progress([self.book.id]), {self.book.id: (2, 5)})
+
+    def test_chunks_are_done_page_by_page(self):
+        self.device_pool.pipelines.append(_FakePipeline())
+        result = tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids)
+        self.assertEqual(result, {'volume_id': self.book.id, 'processed': 5, 'failed': 0})
+        self.assertEqual(Job._default_manager.get(id=self.job.id).chunks_done, 1)
+        self.assertEqual(sum(amount for _, _, amount in self.progress.increments), 5)
+
+    def test_heartbeat_counts_the_pages(self):
+        heartbeats = []
+
+        class RecordingHeartbeat(JobHeartbeat):
+            def __enter__(self):
+                heartbeats.append(self)
+                return super().__enter__()
+
+        self.device_pool.pipelines.append(_FakePipeline())
+        with mock.patch.object(tasks, 'JobHeartbeat', RecordingHeartbeat):
+            tasks.infer_page_chunk_task.run(self.job_data, self.book.id, self.page_ids)
+
+        state = heartbeats[0].state()
+        self.assertEqual((state['volume'], state['page'], state['pages_done']), ('Test Book 1', '004.jpg', 5))
+        self.assertGreater(state['pages_per_second'], 0)
+
+class JobChordTasksTest(_TaskTestCase):
+    def test_jobs_are_replaced_by_a_chord_over_their_volumes(self):
+        other = Book._default_manager.create(name='Test Book 2', author='Test Author', title=self.book.title)
+        self._replace(tasks.run_job_worker_task)
+        with self.assertRaises(_Replaced) as replaced:
+            tasks.run_job_worker_task.run(dict(self.job_data, priority=2))
+
+        extract = replaced.exception.signature.tasks
+        self.assertEqual([task.args[1] for task in extract], [self.book.id, other.id])
+        self.assertEqual({task.task for task in extract}, {'jobs_manager.tasks.extract_volume_task'})
+        self.assertEqual({task.options['priority'] for task in extract}, {2})
+        self.assertEqual(replaced.exception.signature.body.task, 'jobs_manager.tasks.dispatch_page_chunks_task')
+
+    def test_pages_are_dispatched_in_chunks(self):
+        self._replace(tasks.dispatch_page_chunks_task)
+        volumes = [{'volume_id': self.book.id, 'pages': self.page_ids}, {'volume_id': self.book.id + 1, 'pages': [7]}]
+        with self.settings(INFERENCE_CHUNK_SIZE=2):
+            with self.assertRaises(_Replaced) as replaced:
+                tasks.dispatch_page_chunks_task.run(volumes, self.job_data)
+
+        chunks = replaced.exception.signature.tasks
+        self.assertEqual([task.args[1:] for task in chunks], [
+            (self.book.id, self.page_ids[0:2]),
+            (self.book.id, self.page_ids[2:4]),
+            (self.book.id, self.page_ids[4:]),
+            (self.book.id + 1, [7]),
+        ])
+        self.assertEqual(replaced.exception.signature.body.task, 'jobs_manager.tasks.finalize_job_task')
+        self.assertEqual(Job._default_manager.get(id=self.job.id).chunks_total, 4)
+
+    def test_jobs_without_pages_are_finalized_right_away(self):
+        self.pages.finish_pages([(page_id, 'checksum', timezone.now()) for page_id in self.page_ids])
+        result = tasks.dispatch_page_chunks_task.run([{'volume_id': self.book.id, 'pages': []}], self.job_data)
+
+        self.assertEqual(result, self.job.id)
+        job = Job._default_manager.get(id=self.job.id)
+        self.assertEqual((job.status, job.chunks_total), ('completed', 0))
+        self.assertEqual(Book._default_manager.get(id=self.book.id).status, 'completed')
+
+    def test_finalize_raises_if_pages_failed(self):
+        results = [{'volume_id': self.book.id, 'processed': 3, 'failed': 0}, {'volume_id': self.book.id, 'processed': 0, 'failed': 2}]
+        with self.assertRaises(RuntimeError):
+            tasks.finalize_job_task.run(results, self.job_data)
+        self.assertEqual(Job._default_manager.get(id=self.job.id).status, 'failed')
+        # the volume is not done
+        self.assertNotEqual(Book._default_manager.get(id=self.book.id).status, 'completed')
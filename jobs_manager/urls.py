@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import JobsManagerJobs, JobsManagerInferenceTest, JobsManagerInference, JobsManagerJobsCreate, JobsManagerJobsDelete, JobsManagerGetJobStatus, JobsManagerStopJob, JobsManagerJobsProgress
+from .views import JobsManagerJobs, JobsManagerInferenceTest, JobsManagerInference, JobsManagerJobsCreate, JobsManagerJobsDelete, JobsManagerGetJobStatus, JobsManagerStopJob, JobsManagerPauseJob, JobsManagerResumeJob, JobsManagerJobsProgress, JobsManagerReconcileJobProgress, JobsManagerTileSizes
 
 urlpatterns = [
     path('all/', JobsManagerJobs.as_view(), name='jobs-manager-jobs'),
@@ -9,5 +9,9 @@ urlpatterns = [
     path('delete/<int:job_id>', JobsManagerJobsDelete.as_view(), name='jobs-manager-delete'),
     path('status/<int:job_id>', JobsManagerGetJobStatus.as_view(), name='jobs-manager-status'),
     path('stop/<int:job_id>', JobsManagerStopJob.as_view(), name='jobs-manager-stop'),
+    path('pause/<int:job_id>', JobsManagerPauseJob.as_view(), name='jobs-manager-pause'),
+    path('resume/<int:job_id>', JobsManagerResumeJob.as_view(), name='jobs-manager-resume'),
     path('progress/', JobsManagerJobsProgress.as_view(), name='jobs-manager-progress'),
+    path('progress/reconcile/<int:job_id>', JobsManagerReconcileJobProgress.as_view(), name='jobs-manager-progress-reconcile'),
+    path('tile-sizes/', JobsManagerTileSizes.as_view(), name='jobs-manager-tile-sizes'),
 ]
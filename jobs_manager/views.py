@@ -27,6 +27,22 @@ class JobsManagerJobsProgress(APIView):
             return Response(status=200)
         return Response(status=500)
 
+class JobsManagerReconcileJobProgress(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request: Request, job_id: int, *args, **kwargs) -> Response:
+        jobsManagerService = JobsManagerService()
+        if jobsManagerService.reconcile_job_progress(job_id):
+            return Response(status=200)
+        return Response({'error': 'Progress was reconciled recently'}, status=429)
+
+class JobsManagerTileSizes(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request: Request, *args, **kwargs) -> Response:
+        jobsManagerService = JobsManagerService()
+        return Response({'tile_sizes': jobsManagerService.get_tile_sizes()}, status=200)
+
 class JobsManagerJobsCreate(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -57,7 +73,7 @@ class JobsManagerGetJobStatus(APIView):
     def get(self, request: Request, job_id: int, *args, **kwargs) -> Response:
         jobsManagerService = JobsManagerService()
         res = jobsManagerService.get_job_status(job_id)
-        return Response({'status': res}, status=200)
+        return Response({'status': res['running'], **res}, status=200)
 
 class JobsManagerStopJob(APIView):
     permission_classes = [IsAuthenticated]
@@ -67,6 +83,23 @@ class JobsManagerStopJob(APIView):
         res = jobsManagerService.stop_job(job_id)
         return Response({'status': res}, status=200)
 
+class JobsManagerPauseJob(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request: Request, job_id: int, *args, **kwargs) -> Response:
+        jobsManagerService = JobsManagerService()
+        if jobsManagerService.pause_job(job_id):
+            return Response({'status': True}, status=200)
+        return Response({'status': False, 'error': 'Only running jobs can be paused'}, status=409)
+
+class JobsManagerResumeJob(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request: Request, job_id: int, *args, **kwargs) -> Response:
+        jobsManagerService = JobsManagerService()
+        res = jobsManagerService.resume_job(job_id)
+        return Response({'status': res}, status=200)
+
 class JobsManagerInference(APIView):
     permission_classes = [IsAuthenticated]
 
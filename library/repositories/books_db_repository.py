@@ -54,6 +54,15 @@ class BooksDBRepository:
         book_instance.save()
         return book_instance
 
+    def transition_book_status(self, book_id: int, status: str) -> bool:
+        '''
+        Prototype: Sets the status of a book without reading it first.
+        Pre-conditions: 'book_id' is the ID of the book, 'status' its new status.
+        Post-conditions: Issues a single UPDATE that only writes if the status differs, returns whether it changed.
+        '''
+
+        return Book._default_manager.filter(id=book_id).exclude(status=status).update(status=status) > 0
+
     def get_title_by_filepath(self, title_filepath: str) -> Title | None:
         '''
         Retrieves a title by its file path in the database.
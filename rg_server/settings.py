@@ -73,6 +73,75 @@ CELERY_BROKER_URL = 'redis://redis:6379/0'
 
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 
+# gpu: inference (one worker process per device), cpu: volume extraction, io: scans, progress and orchestration.
+# Pages are decoded and encoded by the threads of the inference pipeline, next to the model.
+CELERY_TASK_DEFAULT_QUEUE = 'io'
+CELERY_TASK_ROUTES = {
+    'jobs_manager.tasks.infer_page_chunk_task': {'queue': 'gpu'},
+    'jobs_manager.tasks.extract_volume_task': {'queue': 'cpu'},
+    'jobs_manager.tasks.*': {'queue': 'io'},
+    'library.tasks.*': {'queue': 'io'},
+}
+# Job.priority is passed on to the broker, the Redis transport serves lower values first
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_TASK_INHERIT_PARENT_PRIORITY = True
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+    # unacknowledged (acks_late) chunks are only redelivered after this many seconds
+    'visibility_timeout': config("CELERY_VISIBILITY_TIMEOUT", default=6 * 3600, cast=int),
+}
+# Tasks are long, so a worker only reserves the task it is running
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Job state shared by the web server and the workers (progress counters, pause / cancel commands, heartbeats)
+JOBS_REDIS_URL = config("JOBS_REDIS_URL", default="redis://redis:6379/1")
+# Minimum number of seconds between two full recounts of the progress of a job
+JOBS_PROGRESS_RECONCILE_INTERVAL = config("JOBS_PROGRESS_RECONCILE_INTERVAL", default=60, cast=int)
+# Finished pages are written to the database and progress counters every N pages or T seconds
+JOBS_PROGRESS_BATCH_PAGES = config("JOBS_PROGRESS_BATCH_PAGES", default=16, cast=int)
+JOBS_PROGRESS_BATCH_SECONDS = config("JOBS_PROGRESS_BATCH_SECONDS", default=5.0, cast=float)
+# Workers check for pause and cancel commands before every tile, but read them at most every N seconds
+JOBS_CONTROL_POLL_SECONDS = config("JOBS_CONTROL_POLL_SECONDS", default=0.5, cast=float)
+# A running chunk waits up to N seconds for a paused job to resume, then it is queued again every T seconds
+# until the job is resumed, so that a paused job never holds a gpu worker for long
+JOBS_PAUSE_SUSPEND_SECONDS = config("JOBS_PAUSE_SUSPEND_SECONDS", default=60.0, cast=float)
+JOBS_PAUSED_RETRY_SECONDS = config("JOBS_PAUSED_RETRY_SECONDS", default=30, cast=int)
+# Workers publish their state every N seconds, a worker that missed its beats for T seconds is considered dead
+JOBS_HEARTBEAT_SECONDS = config("JOBS_HEARTBEAT_SECONDS", default=5.0, cast=float)
+JOBS_HEARTBEAT_TTL = config("JOBS_HEARTBEAT_TTL", default=30, cast=int)
+
+# Number of pages of a job upscaled by one task, chunks of a job run on every available worker
+INFERENCE_CHUNK_SIZE = config("INFERENCE_CHUNK_SIZE", default=16, cast=int)
+# Number of pages sent to the upscale model at once, pages of the same size are batched together
+INFERENCE_BATCH_SIZE = config("INFERENCE_BATCH_SIZE", default=4, cast=int)
+# Number of tiles sent to the upscale model at once, when a page is too large to be upscaled in one go
+INFERENCE_TILE_BATCH_SIZE = config("INFERENCE_TILE_BATCH_SIZE", default=4, cast=int)
+# Blends the tiles of a split page on the device and downloads only the finished page
+INFERENCE_DEVICE_BLEND = config("INFERENCE_DEVICE_BLEND", default=False, cast=bool)
+# Tiles whose pixels differ by at most this much (0-1) are filled with their color instead of upscaled, -1 disables.
+# This changes the output of pages, so it is off by default: set e.g. INFERENCE_FLAT_TILE_TOLERANCE=0.02 to opt in
+INFERENCE_FLAT_TILE_TOLERANCE = config("INFERENCE_FLAT_TILE_TOLERANCE", default=-1, cast=float)
+# Uniform page margins (within this tolerance, in percent) are trimmed before upscaling and restored after, -1 disables
+INFERENCE_MARGIN_TRIM_TOLERANCE = config("INFERENCE_MARGIN_TRIM_TOLERANCE", default=-1, cast=float)
+# Number of pages decoded ahead of the model, and number of finished pages queued for encoding
+INFERENCE_PREFETCH_DEPTH = config("INFERENCE_PREFETCH_DEPTH", default=2, cast=int)
+INFERENCE_ENCODE_DEPTH = config("INFERENCE_ENCODE_DEPTH", default=2, cast=int)
+# Whether worker processes load the upscale model when they start, only gpu queue workers need it
+INFERENCE_WARM_UP = config("INFERENCE_WARM_UP", default=True, cast=bool)
+# Devices used by every worker, "auto" for all CUDA devices, or a list like "cuda:0,cuda:1" (or "cpu,cpu")
+INFERENCE_DEVICES = config("INFERENCE_DEVICES", default="auto")
+# CPU backend of workers without a GPU (INFERENCE_DEVICES=cpu), BF16 is selected with INFERENCE_PRECISION=bf16
+INFERENCE_CPU_THREADS = config("INFERENCE_CPU_THREADS", default=0, cast=int)
+INFERENCE_CPU_INTEROP_THREADS = config("INFERENCE_CPU_INTEROP_THREADS", default=1, cast=int)
+INFERENCE_CPU_CHANNELS_LAST = config("INFERENCE_CPU_CHANNELS_LAST", default=True, cast=bool)
+INFERENCE_CPU_ONEDNN = config("INFERENCE_CPU_ONEDNN", default=True, cast=bool)
+# Pins every worker process to its own range of cores, 0 disables pinning
+INFERENCE_CPU_CORES_PER_WORKER = config("INFERENCE_CPU_CORES_PER_WORKER", default=0, cast=int)
+# Tile sizes known to fit on the device, per model and page size, shared by all workers
+INFERENCE_TILE_SIZE_MEMORY_PATH = config("INFERENCE_TILE_SIZE_MEMORY_PATH", default="/out/.relaxg/tile_sizes.json")
+
 ASGI_APPLICATION = "rg_server.asgi.application"
 
 # For development, use in-memory backend